@@ -1,6 +1,9 @@
 import asyncio
 import logging
-from typing import Dict, List, Optional, Tuple
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 import numpy as np
 import torch
 from pathlib import Path
@@ -8,20 +11,70 @@ from pathlib import Path
 from models.demucs_model import DemucsModel
 from utils.audio_utils import AudioUtils
 from utils.file_manager import FileManager
+from utils.mixdown import StreamingMixer, build_mix_tracks
+from utils.exporter import StemExporter
+from utils.checkpoint import CheckpointStore
+from utils.peaks import WaveformPeaks
+from utils.coalescing import SEPARATION_MODEL
+from utils.cancellation import CancelToken, JobInterrupted
+from utils.metrics import stage_timer, record_cache, record_file_bytes, REALTIME_FACTOR
 
 logger = logging.getLogger(__name__)
 
+# Avanzamento complessivo al termine di ogni fase
+STAGE_PROGRESS = {
+    "analysis": 0.1,
+    "separation": 0.7,
+    "post_process": 0.85,
+    "quality": 0.95,
+    "export": 1.0
+}
+
+# Strategie di mashup: stem -> traccia sorgente (1 o 2)
+MASHUP_STRATEGIES = {
+    # Voce da traccia 1, strumentale da traccia 2
+    "vocal_instrumental": {"vocals": 1, "drums": 2, "bass": 2, "other": 2},
+    # Scambia solo la batteria
+    "drums_swap": {"vocals": 1, "drums": 2, "bass": 1, "other": 1},
+    # Mix bilanciato (default): stems base della traccia 1
+    "balanced": {"vocals": 1, "drums": 1, "bass": 1, "other": 1}
+}
+
+# Thread per le fasi CPU della pipeline (l'inferenza usa l'executor del modello,
+# limitata da SEPARATION_CONCURRENCY): con più job in corso nello stesso worker
+# decodifica e analisi del job successivo procedono mentre il modello lavora
+PIPELINE_POOLS = {
+    "decode": int(os.getenv("PIPELINE_DECODE_WORKERS", "1")),
+    "analysis": int(os.getenv("PIPELINE_ANALYSIS_WORKERS", "1")),
+    "post_process": int(os.getenv("PIPELINE_POST_PROCESS_WORKERS", "2"))
+}
+
 class AudioProcessor:
     """Processore audio principale per orchestrare tutte le operazioni"""
     
-    def __init__(self):
+    def __init__(self, redis_client=None):
         self.demucs_model = DemucsModel()
         self.audio_utils = AudioUtils()
-        self.file_manager = FileManager()
+        self.file_manager = FileManager(redis_client=redis_client)
+        self.mixer = StreamingMixer()
+        self.exporter = StemExporter()
+        self.checkpoints = CheckpointStore(redis_client, self.file_manager.blobs)
+        self.peaks = WaveformPeaks()
         
         # Cache per risultati di elaborazione
         self._processing_cache = {}
         
+        # Budget di separazioni concorrenti per questo worker
+        self._separation_semaphore = asyncio.Semaphore(
+            int(os.getenv("SEPARATION_CONCURRENCY", "2"))
+        )
+        
+        # Pool dedicati per fase: una fase satura non rallenta le altre
+        self._pools = {
+            stage: ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=f"pipeline-{stage}")
+            for stage, workers in PIPELINE_POOLS.items()
+        }
+        
         # Statistiche performance
         self.stats = {
             "total_processed": 0,
@@ -36,7 +89,7 @@ class AudioProcessor:
             logger.info("Inizializzazione AudioProcessor...")
             
             # Carica modello Demucs
-            await self.demucs_model.load_model()
+            await self.demucs_model.load_model(SEPARATION_MODEL)
             
             logger.info("AudioProcessor inizializzato con successo")
             
@@ -45,8 +98,15 @@ class AudioProcessor:
             raise
     
     async def process_full_separation(self, audio_path: str, session_id: str, 
-                                    options: Optional[Dict] = None) -> Dict[str, any]:
-        """Elaborazione completa: analisi + separazione + post-processing"""
+                                    options: Optional[Dict] = None,
+                                    progress_callback: Optional[Callable[[str, float], Awaitable]] = None,
+                                    cancel: Optional[CancelToken] = None
+                                    ) -> Dict[str, any]:
+        """Elaborazione completa: analisi + separazione + post-processing
+        
+        Con cancel impostato il job si ferma al successivo confine di fase o di
+        segmento sollevando JobInterrupted; una nuova esecuzione riparte dai checkpoint.
+        """
         
         start_time = asyncio.get_event_loop().time()
         
@@ -63,30 +123,75 @@ class AudioProcessor:
                 "target_lufs": options.get("target_lufs", -23.0),
                 "fade_duration": options.get("fade_duration", 0.1),
                 "export_format": options.get("export_format", "wav"),
+                "export_bitrate": options.get("export_bitrate"),
                 "quality": options.get("quality", "high")
             }
             
+            # Upload nella blob store: scaricato nella cache locale se necessario
+            audio_path = await self.file_manager.localize(audio_path)
+            
+            # Ogni fase riparte dal checkpoint se input e artefatti coincidono
+            audio_hash = await self.file_manager.compute_file_hash(audio_path)
+            
             # 1. Analisi preliminare
             logger.info(f"Fase 1: Analisi audio - {session_id}")
-            audio_analysis = await self.audio_utils.analyze_audio(audio_path)
+            audio_analysis, analysis_hash = await self._run_stage(
+                session_id, "analysis", {"audio": audio_hash},
+                lambda: self._analyze_cached(audio_path),
+                progress_callback=progress_callback, cancel=cancel
+            )
             
-            # 2. Separazione AI
+            # 2. Separazione AI (fasi interne misurate dal modello)
             logger.info(f"Fase 2: Separazione AI - {session_id}")
-            stems_paths = await self.demucs_model.separate_audio(audio_path, session_id)
+            stems_paths, separation_hash = await self._run_stage(
+                session_id, "separation",
+                {"audio": audio_hash, "model": self.demucs_model.model_name},
+                lambda: self._get_or_separate(audio_path, session_id, cancel=cancel),
+                timed=False,
+                progress_callback=progress_callback, cancel=cancel
+            )
             
             # 3. Post-processing
             logger.info(f"Fase 3: Post-processing - {session_id}")
-            processed_stems = await self._post_process_stems(
-                stems_paths, session_id, processing_options
+            post_options = {
+                key: processing_options[key]
+                for key in ("normalize_output", "apply_fade", "target_lufs", "fade_duration")
+            }
+            processed_stems, post_hash = await self._run_stage(
+                session_id, "post_process",
+                {"separation": separation_hash, "options": post_options},
+                lambda: self._post_process_stems(stems_paths, session_id, processing_options),
+                progress_callback=progress_callback, cancel=cancel
             )
             
             # 4. Analisi qualità
             logger.info(f"Fase 4: Analisi qualità - {session_id}")
-            quality_analysis = await self._analyze_separation_quality(
-                audio_path, processed_stems
+            quality_analysis, _ = await self._run_stage(
+                session_id, "quality", {"post_process": post_hash},
+                lambda: self._analyze_separation_quality(audio_path, processed_stems),
+                progress_callback=progress_callback, cancel=cancel
             )
             
-            # 5. Generazione metadati
+            # 5. Esportazione nel formato richiesto (in parallelo, in cache)
+            exported_stems = processed_stems
+            if processing_options["export_format"] != "wav":
+                logger.info(f"Fase 5: Esportazione {processing_options['export_format']} - {session_id}")
+                exported_stems, _ = await self._run_stage(
+                    session_id, "export",
+                    {
+                        "post_process": post_hash,
+                        "format": processing_options["export_format"],
+                        "bitrate": processing_options["export_bitrate"]
+                    },
+                    lambda: self.exporter.export_stems(
+                        processed_stems,
+                        processing_options["export_format"],
+                        processing_options["export_bitrate"]
+                    ),
+                    progress_callback=progress_callback, cancel=cancel
+                )
+            
+            # 6. Generazione metadati
             processing_time = asyncio.get_event_loop().time() - start_time
             
             result = {
@@ -95,6 +200,7 @@ class AudioProcessor:
                 "processing_time": processing_time,
                 "original_analysis": audio_analysis,
                 "stems_paths": processed_stems,
+                "exported_stems": exported_stems,
                 "quality_analysis": quality_analysis,
                 "processing_options": processing_options,
                 "stems_count": len(processed_stems)
@@ -102,10 +208,19 @@ class AudioProcessor:
             
             # Aggiorna statistiche
             await self._update_stats(processing_time)
+            if audio_analysis.get("duration"):
+                REALTIME_FACTOR.labels(type="separation").observe(
+                    processing_time / audio_analysis["duration"]
+                )
             
             logger.info(f"Elaborazione completata: {session_id} ({processing_time:.2f}s)")
             return result
             
+        except JobInterrupted as e:
+            # Non è un errore: il job riprende altrove dai checkpoint
+            logger.info(f"Elaborazione interrotta {session_id}: {e.reason}")
+            raise
+            
         except Exception as e:
             processing_time = asyncio.get_event_loop().time() - start_time
             logger.error(f"Errore elaborazione {session_id}: {str(e)} (dopo {processing_time:.2f}s)")
@@ -117,60 +232,144 @@ class AudioProcessor:
                 "processing_time": processing_time
             }
     
+    async def _run_stage(self, session_id: str, stage: str, inputs: Dict,
+                       run: Callable[[], Awaitable], timed: bool = True,
+                       progress_callback: Optional[Callable[[str, float], Awaitable]] = None,
+                       cancel: Optional[CancelToken] = None):
+        """Esegue una fase o la riprende dal suo checkpoint durevole
+        
+        Ritorna (risultato, hash input) per concatenare gli input delle fasi successive.
+        """
+        
+        input_hash = self.checkpoints.fingerprint({"stage": stage, **inputs})
+        self.file_manager.touch_session(session_id)
+        
+        entry = await self.checkpoints.load(session_id, stage, input_hash)
+        record_cache("checkpoint", entry is not None)
+        if entry is not None:
+            logger.info(f"Ripresa da checkpoint: {stage} - {session_id}")
+            await self._report_progress(progress_callback, stage)
+            return entry["result"], input_hash
+        
+        # Confine di fase: le fasi precedenti sono già nei checkpoint
+        if cancel is not None:
+            cancel.raise_if_cancelled()
+        
+        if timed:
+            with stage_timer(stage):
+                result = await run()
+        else:
+            result = await run()
+        
+        # Artefatti: file prodotti dalla fase (mappe stem -> percorso)
+        artifacts = []
+        if isinstance(result, dict):
+            artifacts = [
+                value for value in result.values()
+                if isinstance(value, str) and os.path.isabs(value)
+            ]
+        
+        await self.checkpoints.save(session_id, stage, input_hash, result, artifacts)
+        await self._report_progress(progress_callback, stage)
+        if cancel is not None:
+            cancel.mark_progress()
+        
+        return result, input_hash
+    
+    async def _report_progress(self, progress_callback, stage: str):
+        """Notifica avanzamento (errori di notifica non interrompono la pipeline)"""
+        
+        if progress_callback is None:
+            return
+        
+        try:
+            await progress_callback(stage, STAGE_PROGRESS.get(stage, 0.0))
+        except Exception as e:
+            logger.warning(f"Errore notifica avanzamento {stage}: {str(e)}")
+    
     async def _post_process_stems(self, stems_paths: Dict[str, str], 
                                 session_id: str, options: Dict) -> Dict[str, str]:
-        """Post-processing delle tracce separate"""
-        
-        processed_stems = {}
+        """Post-processing delle tracce separate (in parallelo sul pool di post-processing)"""
         
         try:
-            for stem_name, stem_path in stems_paths.items():
-                logger.debug(f"Post-processing: {stem_name}")
-                
-                # Carica audio
-                import torchaudio
-                waveform, sample_rate = torchaudio.load(stem_path)
-                audio_np = waveform.numpy()[0]  # Converti a numpy, primo canale
-                
-                # Normalizzazione
-                if options.get("normalize_output", True):
-                    audio_np = self.audio_utils.normalize_audio(
-                        audio_np, 
-                        target_lufs=options.get("target_lufs", -23.0)
-                    )
-                
-                # Fade in/out
-                if options.get("apply_fade", True):
-                    fade_duration = options.get("fade_duration", 0.1)
-                    audio_np = self.audio_utils.apply_fade(
-                        audio_np, sample_rate, fade_duration, fade_duration
-                    )
-                
-                # Salva versione processata
-                processed_path = Path(stem_path).parent / f"{stem_name}_processed.wav"
-                
-                # Converti back a tensor per salvataggio
-                processed_tensor = torch.from_numpy(audio_np).unsqueeze(0)
-                torchaudio.save(
-                    str(processed_path),
-                    processed_tensor,
-                    sample_rate,
-                    format="wav"
+            output_dir = self.file_manager.session_dir(session_id) / "stems"
+            output_dir.mkdir(exist_ok=True)
+            
+            loop = asyncio.get_event_loop()
+            processed = await asyncio.gather(*(
+                loop.run_in_executor(
+                    self._pools["post_process"], self._post_process_stem,
+                    stem_name, stem_path, options, output_dir
                 )
-                
-                processed_stems[stem_name] = str(processed_path)
+                for stem_name, stem_path in stems_paths.items()
+            ))
+            processed_stems = dict(zip(stems_paths, processed))
+            
+            record_file_bytes("read", "post_process", *stems_paths.values())
+            record_file_bytes("write", "post_process", *processed_stems.values())
             
-            return processed_stems
+            return await self.file_manager.publish_files(session_id, processed_stems, "processed/")
             
         except Exception as e:
+            # Nessun fallback sugli stem grezzi: verrebbero salvati nel checkpoint
+            # della fase e riusati come post-processati nei tentativi successivi
             logger.error(f"Errore post-processing: {str(e)}")
-            # Fallback: ritorna stems originali
-            return stems_paths
+            raise
+    
+    def _post_process_stem(self, stem_name: str, stem_path: str, options: Dict,
+                           output_dir: Path) -> str:
+        """Normalizzazione, fade e piramide dei picchi di un singolo stem"""
+        
+        logger.debug(f"Post-processing: {stem_name}")
+        
+        # Carica audio
+        import torchaudio
+        waveform, sample_rate = torchaudio.load(stem_path)
+        audio_np = waveform.numpy()[0]  # Converti a numpy, primo canale
+        
+        # Normalizzazione
+        if options.get("normalize_output", True):
+            audio_np = self.audio_utils.normalize_audio(
+                audio_np, 
+                target_lufs=options.get("target_lufs", -23.0)
+            )
+        
+        # Fade in/out
+        if options.get("apply_fade", True):
+            fade_duration = options.get("fade_duration", 0.1)
+            audio_np = self.audio_utils.apply_fade(
+                audio_np, sample_rate, fade_duration, fade_duration
+            )
+        
+        # Salva versione processata
+        processed_path = output_dir / f"{stem_name}_processed.wav"
+        
+        # Converti back a tensor per salvataggio
+        processed_tensor = torch.from_numpy(audio_np).unsqueeze(0)
+        torchaudio.save(
+            str(processed_path),
+            processed_tensor,
+            sample_rate,
+            format="wav"
+        )
+        
+        # Piramide dei picchi per l'editor, dall'audio già in memoria
+        self.peaks.build_from_array(str(processed_path), audio_np, sample_rate)
+        
+        return str(processed_path)
     
     async def _analyze_separation_quality(self, original_path: str, 
                                         stems_paths: Dict[str, str]) -> Dict[str, any]:
-        """Analisi qualità della separazione"""
+        """Analisi qualità della separazione (fuori dall'event loop)"""
         
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._pools["post_process"], self._analyze_separation_quality_sync,
+            original_path, stems_paths
+        )
+    
+    def _analyze_separation_quality_sync(self, original_path: str,
+                                         stems_paths: Dict[str, str]) -> Dict[str, any]:
         try:
             quality_metrics = {
                 "overall_score": 0.0,
@@ -198,7 +397,7 @@ class AudioProcessor:
                     stem_segment = stem_audio[:min_len]
                     
                     # Calcola metriche qualità
-                    stem_quality = await self._calculate_stem_quality(
+                    stem_quality = self._calculate_stem_quality(
                         original_segment, stem_segment, sr
                     )
                     
@@ -219,7 +418,7 @@ class AudioProcessor:
             logger.error(f"Errore analisi qualità: {str(e)}")
             return {"error": str(e)}
     
-    async def _calculate_stem_quality(self, original: np.ndarray, 
+    def _calculate_stem_quality(self, original: np.ndarray, 
                                     stem: np.ndarray, sr: int) -> Dict[str, float]:
         """Calcola metriche di qualità per un singolo stem"""
         
@@ -280,19 +479,29 @@ class AudioProcessor:
         try:
             logger.info(f"Creazione mashup per sessione: {session_id}")
             
-            # Analizza entrambe le tracce
-            analysis1 = await self.audio_utils.analyze_audio(audio1_path)
-            analysis2 = await self.audio_utils.analyze_audio(audio2_path)
+            # Stems effettivamente usati dalla strategia scelta
+            mix_strategy = mashup_options.get("strategy", "vocal_instrumental")
+            stem_sources = MASHUP_STRATEGIES.get(mix_strategy, MASHUP_STRATEGIES["balanced"])
+            required1 = [stem for stem, track in stem_sources.items() if track == 1]
+            required2 = [stem for stem, track in stem_sources.items() if track == 2]
+            
+            audio1_path, audio2_path = await asyncio.gather(
+                self.file_manager.localize(audio1_path),
+                self.file_manager.localize(audio2_path)
+            )
             
-            # Allineamento tempo
-            target_tempo = mashup_options.get("target_tempo")
-            aligned_audio1, aligned_audio2, final_tempo = await self.audio_utils.align_tempo(
-                audio1_path, audio2_path, target_tempo
+            # Analisi e separazione di entrambe le tracce in parallelo
+            analysis1, analysis2, stems1, stems2 = await asyncio.gather(
+                self._analyze_cached(audio1_path),
+                self._analyze_cached(audio2_path),
+                self._get_or_separate(audio1_path, f"{session_id}_track1", required1),
+                self._get_or_separate(audio2_path, f"{session_id}_track2", required2)
             )
             
-            # Separazione di entrambe le tracce
-            stems1 = await self.demucs_model.separate_audio(audio1_path, f"{session_id}_track1")
-            stems2 = await self.demucs_model.separate_audio(audio2_path, f"{session_id}_track2")
+            # Tempo finale (i tempi sono già stimati dall'analisi)
+            final_tempo = mashup_options.get("target_tempo")
+            if final_tempo is None:
+                final_tempo = (analysis1["tempo"] + analysis2["tempo"]) / 2
             
             # Creazione mashup intelligente
             mashup_result = await self._create_intelligent_mashup(
@@ -313,6 +522,81 @@ class AudioProcessor:
             logger.error(f"Errore creazione mashup: {str(e)}")
             return {"session_id": session_id, "status": "error", "error": str(e)}
     
+    async def _get_or_separate(self, audio_path: str, session_id: str,
+                             required: Optional[List[str]] = None,
+                             cancel: Optional[CancelToken] = None) -> Dict[str, str]:
+        """Riusa stems già separati per lo stesso audio, altrimenti separa"""
+        
+        if required is not None and not required:
+            return {}
+        
+        content_hash = await self.file_manager.compute_file_hash(audio_path)
+        model_name = self.demucs_model.model_name
+        
+        cached = await self.file_manager.find_cached_stems(content_hash, model_name, required)
+        record_cache("stems", bool(cached))
+        if cached:
+            logger.info(f"Stems riutilizzati per {session_id} (hash: {content_hash[:12]})")
+            return await self._reuse_stems(session_id, cached)
+        
+        # Decodifica prima di occupare il modello (in parallelo all'inferenza di altri job)
+        waveform, sample_rate = await self.demucs_model.decode(audio_path, self._pools["decode"])
+        
+        # Rispetta il budget di separazioni concorrenti del worker: il semaforo
+        # copre solo l'inferenza, il salvataggio degli stems libera già il modello
+        async with self._separation_semaphore:
+            # Un'altra separazione dello stesso audio potrebbe essere appena terminata
+            cached = await self.file_manager.find_cached_stems(content_hash, model_name, required)
+            if cached:
+                return await self._reuse_stems(session_id, cached)
+            
+            # Segmenti pubblicati nella blob store per sessione, audio e modello:
+            # dopo un'interruzione il job riprende su qualsiasi nodo
+            segments_prefix = f"segments/{content_hash[:16]}_{model_name}/"
+            segments_dir = self.file_manager.session_dir(session_id) / segments_prefix
+            
+            async def publish_segment(path: Path):
+                await self.file_manager.publish_files(session_id, {path.name: str(path)}, segments_prefix)
+            
+            with self.file_manager.in_use(session_id):
+                restored = await self.file_manager.restore_files(session_id, segments_prefix, segments_dir)
+                if restored:
+                    logger.info(f"Segmenti ripristinati per {session_id}: {restored}")
+                sources = await self.demucs_model.infer(waveform, cancel, segments_dir, publish_segment)
+            shutil.rmtree(segments_dir, ignore_errors=True)
+            await self.file_manager.release_files(session_id, segments_prefix)
+        
+        del waveform
+        stems_paths = await self.demucs_model.save_stems(
+            sources, session_id, sample_rate, required, self._pools["post_process"],
+            self.file_manager.session_dir(session_id) / "stems"
+        )
+        stems_paths = await self.file_manager.publish_files(session_id, stems_paths, "stems/")
+        
+        await self.file_manager.register_stems(content_hash, model_name, stems_paths)
+        
+        return stems_paths
+    
+    async def _reuse_stems(self, session_id: str, cached: Dict[str, str]) -> Dict[str, str]:
+        """Stems di un'altra sessione: referenziati anche da questa e scaricati in locale"""
+        
+        await self.file_manager.retain_files(session_id, cached, "stems/")
+        return await self.file_manager.localize_all(cached)
+    
+    async def _analyze_cached(self, audio_path: str) -> Dict[str, any]:
+        """Analisi audio con cache per contenuto"""
+        
+        content_hash = await self.file_manager.compute_file_hash(audio_path)
+        cache_key = f"analysis:{content_hash}"
+        
+        record_cache("analysis", cache_key in self._processing_cache)
+        if cache_key not in self._processing_cache:
+            self._processing_cache[cache_key] = await self.audio_utils.analyze_audio(
+                audio_path, self._pools["analysis"]
+            )
+        
+        return self._processing_cache[cache_key]
+    
     async def _create_intelligent_mashup(self, stems1: Dict[str, str], 
                                        stems2: Dict[str, str], 
                                        options: Dict, session_id: str) -> Dict[str, any]:
@@ -320,26 +604,12 @@ class AudioProcessor:
         
         # Strategia di mixaggio basata su opzioni
         mix_strategy = options.get("strategy", "vocal_instrumental")
+        stem_sources = MASHUP_STRATEGIES.get(mix_strategy, MASHUP_STRATEGIES["balanced"])
         
-        if mix_strategy == "vocal_instrumental":
-            # Voce da traccia 1, strumentale da traccia 2
-            selected_stems = {
-                "vocals": stems1.get("vocals"),
-                "drums": stems2.get("drums"),
-                "bass": stems2.get("bass"),
-                "other": stems2.get("other")
-            }
-        elif mix_strategy == "drums_swap":
-            # Scambia solo la batteria
-            selected_stems = {
-                "vocals": stems1.get("vocals"),
-                "drums": stems2.get("drums"),
-                "bass": stems1.get("bass"),
-                "other": stems1.get("other")
-            }
-        else:
-            # Mix bilanciato
-            selected_stems = stems1  # Default
+        tracks = {1: stems1, 2: stems2}
+        selected_stems = {
+            stem: tracks[track].get(stem) for stem, track in stem_sources.items()
+        }
         
         # Combina stems selezionati
         mashup_path = await self._combine_stems(selected_stems, session_id, options)
@@ -348,46 +618,21 @@ class AudioProcessor:
     
     async def _combine_stems(self, stems: Dict[str, str], 
                            session_id: str, options: Dict) -> str:
-        """Combina stems in un mix finale"""
+        """Combina stems in un mix finale (streaming a blocchi)"""
         
         try:
-            import torchaudio
-            
-            combined_audio = None
-            sample_rate = None
-            
-            for stem_name, stem_path in stems.items():
-                if stem_path and Path(stem_path).exists():
-                    waveform, sr = torchaudio.load(stem_path)
-                    
-                    if sample_rate is None:
-                        sample_rate = sr
-                        combined_audio = waveform
-                    else:
-                        # Assicura stessa lunghezza
-                        min_len = min(combined_audio.shape[1], waveform.shape[1])
-                        combined_audio = combined_audio[:, :min_len] + waveform[:, :min_len]
-            
-            # Normalizza mix finale
-            if combined_audio is not None:
-                peak = torch.max(torch.abs(combined_audio))
-                if peak > 0.95:
-                    combined_audio = combined_audio * (0.95 / peak)
-                
-                # Salva mix finale
-                output_path = Path(f"/app/temp_files/{session_id}/mashup_final.wav")
-                output_path.parent.mkdir(exist_ok=True)
-                
-                torchaudio.save(
-                    str(output_path),
-                    combined_audio,
-                    sample_rate,
-                    format="wav"
-                )
-                
-                return str(output_path)
+            stems = await self.file_manager.localize_all(stems)
+            tracks = build_mix_tracks(stems, options)
+            output_path = str(self.file_manager.session_dir(session_id) / "mashup_final.wav")
+            
+            # Mixdown a memoria costante fuori dall'event loop
+            loop = asyncio.get_event_loop()
+            mashup_path = await loop.run_in_executor(
+                None, self.mixer.mix_to_file, tracks, output_path
+            )
             
-            raise ValueError("Nessun stem valido trovato per il mix")
+            published = await self.file_manager.publish_files(session_id, {"mashup": mashup_path})
+            return published["mashup"]
             
         except Exception as e:
             logger.error(f"Errore combinazione stems: {str(e)}")
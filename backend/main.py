@@ -1,25 +1,54 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
+import time
+_import_started = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+import sys
+from pydantic import BaseModel
 import os
 import uuid
 import asyncio
-from typing import List, Optional
-import redis
 import json
+from typing import Dict, List, Optional
 from datetime import datetime, timedelta
 import logging
 from pathlib import Path
 
-from audio_processor import AudioProcessor
-from models.demucs_model import DemucsModel
-from utils.file_manager import FileManager
+from utils.file_manager import FileManager, UploadTooLargeError, MAX_UPLOAD_SIZE
+from utils.multipart_upload import MultipartFileReceiver, MultipartUploadError
 from utils.audio_utils import AudioUtils
+from utils.mixdown import StreamingMixer, build_mix_tracks
+from utils.exporter import StemExporter, EXPORT_FORMATS
+from utils.metrics import (
+    CLUSTER_THROUGHPUT, HTTP_REQUEST_DURATION, QUEUE_LENGTH, QUEUE_OLDEST_WAIT, STARTUP_DURATION,
+    WORKERS_DESIRED, WORKERS_LIVE, record_cache
+)
+from utils.session_store import SessionStore
+from utils.job_queue import JobQueue
+from utils.admission import AdmissionController, AdmissionRejected, resolve_client
+from utils.worker_registry import WorkerRegistry
+from utils.coalescing import COALESCING_ENABLED, JobCoalescer, coalesce_key
+from utils.http_files import file_response, IMMUTABLE_CACHE_CONTROL
+from utils.peaks import WaveformPeaks
+from utils.session_events import (
+    SessionEventHub, status_payload, batch_status_payload, TERMINAL_STATUSES
+)
 
 # Configurazione logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Costo degli import del processo API (nessuna libreria di inferenza)
+STARTUP_DURATION.labels(phase="import").set(time.perf_counter() - _import_started)
+
+# Analisi completa (librosa) all'upload: disattiva di default, la esegue il worker
+API_FULL_ANALYSIS = os.getenv("API_FULL_ANALYSIS", "false").lower() == "true"
+
+# Moduli che il processo API non dovrebbe mai caricare
+HEAVY_MODULES = ("torch", "torchaudio", "librosa", "demucs")
+
 app = FastAPI(
     title="MusicAI Editor API",
     description="API per separazione audio AI con 16 tracce",
@@ -35,26 +64,109 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """Latenza richieste HTTP per route"""
+    start = time.perf_counter()
+    response = await call_next(request)
+    
+    # Template della route (non il path) per limitare la cardinalità
+    route = request.scope.get("route")
+    HTTP_REQUEST_DURATION.labels(
+        method=request.method,
+        route=route.path if route else "unmatched",
+        status=response.status_code
+    ).observe(time.perf_counter() - start)
+    
+    return response
+
 # Inizializzazione servizi
-redis_client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379"))
-audio_processor = AudioProcessor()
-file_manager = FileManager()
-demucs_model = DemucsModel()
+session_store = SessionStore()
+job_queue = JobQueue(session_store.client)
+admission = AdmissionController(session_store.client, job_queue)
+worker_registry = WorkerRegistry(session_store.client, job_queue)
+coalescer = JobCoalescer(session_store.client)
+event_hub = SessionEventHub(session_store.client, session_store.pubsub_client)
+file_manager = FileManager(redis_client=session_store.client)
+mixer = StreamingMixer()
+exporter = StemExporter()
+waveform_peaks = WaveformPeaks()
+
+class MixdownRequest(BaseModel):
+    """Parametri mixdown: stem -> {gain_db, pan, offset}"""
+    stems: Dict[str, Dict[str, float]]
+
+class SeparationRequest(BaseModel):
+    """Opzioni separazione: priorità di coda e opzioni di elaborazione"""
+    priority: str = "normal"
+    options: Dict = {}
 
 @app.on_event("startup")
 async def startup_event():
     """Inizializzazione dell'applicazione"""
+    started = time.perf_counter()
     logger.info("Avvio MusicAI Editor API...")
     
-    # Carica modello Demucs
-    await demucs_model.load_model()
+    # Nessun modello in questo processo: l'inferenza gira solo nei worker
+    
+    # Sottoscrizione condivisa agli eventi di stato delle sessioni
+    event_hub.start()
+    file_manager.start_cleanup()
     
     # Crea directory temporanee
     os.makedirs("/app/temp_files", exist_ok=True)
     os.makedirs("/app/models", exist_ok=True)
     
+    STARTUP_DURATION.labels(phase="startup").set(time.perf_counter() - started)
+    
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    if loaded:
+        logger.warning(f"Librerie pesanti caricate nel processo API: {', '.join(loaded)}")
+    
     logger.info("API avviata con successo!")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Chiusura connessioni"""
+    await event_hub.stop()
+    await session_store.close()
+
+async def get_session_or_404(session_id: str) -> Dict:
+    """Recupera dati sessione o risponde 404"""
+    session_data = await session_store.get(session_id)
+    if not session_data:
+        raise HTTPException(status_code=404, detail="Sessione non trovata")
+    return session_data
+
+async def admit_jobs(http_request: Request, jobs: int = 1) -> Dict:
+    """Controllo di ammissione: 429 con Retry-After se oltre capacità"""
+    client_id, limit = resolve_client(
+        http_request.headers.get("x-api-key"),
+        http_request.client.host if http_request.client else None
+    )
+    
+    try:
+        estimate = await admission.admit(client_id, limit, jobs)
+    except AdmissionRejected as e:
+        logger.warning(f"Richiesta rifiutata ({client_id}): {e.detail}")
+        raise HTTPException(
+            status_code=429,
+            detail=e.detail,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    
+    return {**estimate, "client_id": client_id}
+
+async def get_completed_session(session_id: str) -> Dict:
+    """Recupera sessione con elaborazione completata"""
+    session_data = await get_session_or_404(session_id)
+    if session_data["status"] != "completed":
+        raise HTTPException(status_code=400, detail="Elaborazione non completata")
+    
+    # Sessioni scaricate di recente restano fuori dall'eviction per spazio su disco
+    file_manager.touch_session(session_id)
+    return session_data
+
 @app.get("/")
 async def root():
     return {"message": "MusicAI Editor API", "version": "1.0.0", "status": "running"}
@@ -64,7 +176,7 @@ async def health_check():
     """Controllo stato dell'API"""
     try:
         # Test connessione Redis
-        redis_client.ping()
+        await session_store.ping()
         redis_status = "connected"
     except:
         redis_status = "disconnected"
@@ -72,203 +184,620 @@ async def health_check():
     return {
         "status": "healthy",
         "redis": redis_status,
-        "gpu_available": demucs_model.gpu_available,
-        "model_loaded": demucs_model.is_loaded
+        "mode": "api",
+        "heavy_modules_loaded": [name for name in HEAVY_MODULES if name in sys.modules]
     }
 
-@app.post("/upload")
-async def upload_audio(file: UploadFile = File(...)):
-    """Upload di file audio per elaborazione"""
+@app.get("/metrics")
+async def metrics():
+    """Metriche Prometheus"""
+    
+    # Profondità code aggiornata a ogni scrape
+    try:
+        for queue, length in (await job_queue.depth()).items():
+            QUEUE_LENGTH.labels(queue=queue).set(length)
+    except Exception as e:
+        logger.warning(f"Errore lettura profondità code: {str(e)}")
     
-    # Validazione formato file
-    allowed_formats = [".mp3", ".wav", ".flac"]
-    file_ext = Path(file.filename).suffix.lower()
+    # Stato del cluster e segnale di autoscaling (per HPA/KEDA o supervisori)
+    try:
+        update_cluster_metrics(await worker_registry.snapshot())
+    except Exception as e:
+        logger.warning(f"Errore lettura registro worker: {str(e)}")
     
-    if file_ext not in allowed_formats:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+def update_cluster_metrics(snapshot: Dict):
+    """Aggiorna i gauge del cluster da uno snapshot del registro worker"""
+    WORKERS_LIVE.set(snapshot["autoscaling"]["live_workers"])
+    WORKERS_DESIRED.set(snapshot["autoscaling"]["desired_workers"])
+    CLUSTER_THROUGHPUT.set(snapshot["throughput"]["audio_seconds_per_second"])
+    QUEUE_OLDEST_WAIT.set(snapshot["queue"]["oldest_wait"])
+
+@app.get("/workers")
+async def list_workers():
+    """Worker attivi, throughput recente, stato della coda e segnale di autoscaling"""
+    snapshot = await worker_registry.snapshot()
+    update_cluster_metrics(snapshot)
+    return snapshot
+
+@app.get("/workers/autoscale")
+async def autoscale_signal():
+    """Numero di worker desiderato per l'attesa in coda obiettivo"""
+    snapshot = await worker_registry.snapshot()
+    update_cluster_metrics(snapshot)
+    return {**snapshot["autoscaling"], "queue": snapshot["queue"]}
+
+# Formati audio accettati in upload
+ALLOWED_FORMATS = [".mp3", ".wav", ".flac"]
+
+# Numero massimo di file per upload batch (album)
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", "50"))
+
+def validate_audio_format(filename: str):
+    """Validazione formato file"""
+    file_ext = Path(filename or "").suffix.lower()
+    
+    if file_ext not in ALLOWED_FORMATS:
         raise HTTPException(
             status_code=400, 
-            detail=f"Formato non supportato. Formati accettati: {', '.join(allowed_formats)}"
+            detail=f"Formato non supportato: {filename}. Formati accettati: {', '.join(ALLOWED_FORMATS)}"
         )
+
+def parse_content_length(request: Request) -> int:
+    """Content-Length dichiarato dal client (0 se assente, 400 se malformato)"""
+    value = request.headers.get("content-length")
+    if value is None:
+        return 0
     
-    # Generazione ID univoco per la sessione
-    session_id = str(uuid.uuid4())
+    try:
+        content_length = int(value)
+    except ValueError:
+        content_length = -1
+    
+    if content_length < 0:
+        raise HTTPException(status_code=400, detail=f"Content-Length non valido: {value}")
+    return content_length
+
+async def receive_uploads(request: Request, max_files: int) -> List[Dict]:
+    """Riceve in streaming i file della richiesta multipart, uno per sessione
+    
+    Ogni parte è validata all'header e scritta su disco mentre arriva: formato
+    non valido (400), troppi file (400) o file oltre MAX_UPLOAD_SIZE (413)
+    interrompono la ricezione senza leggere il resto del corpo.
+    """
+    session_ids = []
+    
+    async def open_file(filename: str):
+        validate_audio_format(filename)
+        session_id = str(uuid.uuid4())
+        session_ids.append(session_id)
+        return await file_manager.open_upload(session_id, filename)
     
     try:
-        # Salvataggio file temporaneo
-        file_path = await file_manager.save_uploaded_file(file, session_id)
-        
-        # Analisi preliminare del file
+        receiver = MultipartFileReceiver(request.headers.get("content-type"), open_file, max_files)
+        uploads = await receiver.receive(request.stream())
+    except Exception as e:
+        await asyncio.gather(*(file_manager.cleanup_session(sid) for sid in session_ids))
+        if isinstance(e, MultipartUploadError):
+            raise HTTPException(status_code=400, detail=str(e))
+        if isinstance(e, UploadTooLargeError):
+            raise HTTPException(status_code=413, detail=str(e))
+        raise
+    
+    if not uploads:
+        raise HTTPException(status_code=400, detail="Nessun file nella richiesta")
+    
+    return uploads
+
+async def describe_upload(upload: Dict) -> Dict:
+    """Metadati della nuova sessione per un file ricevuto"""
+    
+    file_path = upload["file_path"]
+    
+    # Analisi preliminare del file: solo header, l'analisi musicale la fa il worker
+    if API_FULL_ANALYSIS:
         audio_info = await AudioUtils.analyze_audio(file_path)
+    else:
+        audio_info = await AudioUtils.probe_audio(file_path)
+    
+    return {
+        "session_id": upload["session_id"],
+        "original_filename": upload["filename"],
+        "file_path": file_path,
+        "content_hash": upload["content_hash"],
+        "file_size": upload["size"],
+        "audio_info": audio_info,
+        "status": "uploaded",
+        "created_at": datetime.now().isoformat(),
+        "expires_at": (datetime.now() + timedelta(hours=24)).isoformat()
+    }
+
+@app.post("/upload")
+async def upload_audio(request: Request):
+    """Upload di file audio per elaborazione (multipart, campo file)"""
+    
+    # Rifiuta subito richieste dichiaratamente oltre il limite (margine per multipart)
+    if parse_content_length(request) > MAX_UPLOAD_SIZE + 1024 * 1024:
+        raise HTTPException(status_code=413, detail=str(UploadTooLargeError(MAX_UPLOAD_SIZE)))
+    
+    # Corpo letto in streaming: il limite vale anche senza Content-Length (chunked)
+    upload = (await receive_uploads(request, max_files=1))[0]
+    session_id = upload["session_id"]
+    
+    try:
+        session_data = await describe_upload(upload)
         
         # Salvataggio metadati in Redis
-        session_data = {
+        await session_store.set(session_id, session_data)
+        
+        logger.info(f"File caricato: {upload['filename']} (Session: {session_id})")
+        
+        return {
             "session_id": session_id,
-            "original_filename": file.filename,
-            "file_path": file_path,
-            "audio_info": audio_info,
+            "filename": upload["filename"],
+            "audio_info": session_data["audio_info"],
+            "status": "uploaded"
+        }
+        
+    except Exception as e:
+        await file_manager.cleanup_session(session_id)
+        logger.error(f"Errore upload: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Errore durante l'upload: {str(e)}")
+
+@app.post("/upload/batch")
+async def upload_batch(request: Request):
+    """Upload di più file audio (es. un album) in una sola richiesta multipart"""
+    
+    if parse_content_length(request) > (MAX_UPLOAD_SIZE + 1024 * 1024) * MAX_BATCH_FILES:
+        raise HTTPException(status_code=413, detail=str(UploadTooLargeError(MAX_UPLOAD_SIZE)))
+    
+    # Ogni file scritto su disco mentre arriva, limite e formato verificati per parte
+    uploads = await receive_uploads(request, max_files=MAX_BATCH_FILES)
+    session_ids = [upload["session_id"] for upload in uploads]
+    batch_id = str(uuid.uuid4())
+    
+    try:
+        # Probe dei file in parallelo
+        uploaded = await asyncio.gather(*(describe_upload(upload) for upload in uploads))
+        
+        sessions = {}
+        for session_data in uploaded:
+            session_data["batch_id"] = batch_id
+            sessions[session_data["session_id"]] = session_data
+        
+        batch = {
+            "batch_id": batch_id,
+            "session_ids": session_ids,
             "status": "uploaded",
-            "created_at": datetime.now().isoformat(),
-            "expires_at": (datetime.now() + timedelta(hours=24)).isoformat()
+            "created_at": datetime.now().isoformat()
         }
         
-        redis_client.setex(
-            f"session:{session_id}", 
-            86400,  # 24 ore
-            json.dumps(session_data)
-        )
+        # Tutte le sessioni e il batch in un solo round-trip
+        await session_store.set_many(sessions, batch=batch)
         
-        logger.info(f"File caricato: {file.filename} (Session: {session_id})")
+        logger.info(f"Batch caricato: {len(uploads)} file (Batch: {batch_id})")
         
         return {
-            "session_id": session_id,
-            "filename": file.filename,
-            "audio_info": audio_info,
-            "status": "uploaded"
+            "batch_id": batch_id,
+            "status": "uploaded",
+            "sessions": [
+                {
+                    "session_id": data["session_id"],
+                    "filename": data["original_filename"],
+                    "audio_info": data["audio_info"],
+                    "status": "uploaded"
+                }
+                for data in uploaded
+            ]
         }
         
     except Exception as e:
-        logger.error(f"Errore upload: {str(e)}")
+        await asyncio.gather(*(file_manager.cleanup_session(sid) for sid in session_ids))
+        logger.error(f"Errore upload batch: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Errore durante l'upload: {str(e)}")
 
-@app.post("/separate/{session_id}")
-async def separate_audio(session_id: str, background_tasks: BackgroundTasks):
-    """Avvia separazione audio in 16 tracce"""
+@app.post("/separate/batch/{batch_id}")
+async def separate_batch(batch_id: str, http_request: Request,
+                         request: Optional[SeparationRequest] = None):
+    """Avvia la separazione di tutte le tracce di un batch come unico job"""
     
-    # Recupera dati sessione
-    session_data = redis_client.get(f"session:{session_id}")
-    if not session_data:
-        raise HTTPException(status_code=404, detail="Sessione non trovata")
+    request = request or SeparationRequest()
     
-    session_data = json.loads(session_data)
+    batch = await session_store.get_batch(batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch non trovato")
     
-    if session_data["status"] != "uploaded":
-        raise HTTPException(status_code=400, detail="File già in elaborazione o completato")
+    if batch["status"] != "uploaded":
+        raise HTTPException(status_code=400, detail="Batch già in elaborazione o completato")
     
-    # Aggiorna stato a "processing"
-    session_data["status"] = "processing"
-    session_data["processing_started_at"] = datetime.now().isoformat()
+    try:
+        priority = job_queue.resolve_priority(request.priority)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    redis_client.setex(
-        f"session:{session_id}", 
-        86400,
-        json.dumps(session_data)
-    )
+    sessions = await session_store.get_many(batch["session_ids"])
+    
+    missing = [sid for sid, data in sessions.items() if data is None]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Sessioni scadute nel batch: {len(missing)}")
     
-    # Avvia elaborazione in background
-    background_tasks.add_task(process_audio_separation, session_id)
+    if any(data["status"] != "uploaded" for data in sessions.values()):
+        raise HTTPException(status_code=400, detail="Alcune tracce sono già in elaborazione")
     
-    logger.info(f"Avviata separazione per sessione: {session_id}")
+    # Ogni traccia del batch conta come un job ai fini dell'ammissione
+    admitted = await admit_jobs(http_request, len(sessions))
+    
+    items = [
+        {
+            "session_id": sid,
+            "audio_path": data["file_path"],
+            "content_hash": data.get("content_hash"),
+            "duration": (data.get("audio_info") or {}).get("duration")
+        }
+        for sid, data in sessions.items()
+    ]
+    
+    queued_at = datetime.now().isoformat()
+    job_id = str(uuid.uuid4())
+    
+    for session_data in sessions.values():
+        session_data.update({"status": "queued", "queued_at": queued_at, "job_id": job_id})
+    
+    batch.update({
+        "status": "queued",
+        "queued_at": queued_at,
+        "job_id": job_id,
+        "estimated_time": admitted["estimated_time"]
+    })
+    
+    try:
+        await session_store.set_many(sessions, batch=batch)
+        
+        # Un solo job: il worker pianifica le tracce (più lunghe prima, duplicati una volta)
+        await job_queue.enqueue({
+            "job_id": job_id,
+            "type": "batch_separation",
+            "batch_id": batch_id,
+            "options": request.options,
+            "client_id": admitted["client_id"],
+            "expected_duration": sum(item["duration"] or 0.0 for item in items) or None,
+            "items": items
+        }, priority)
+    except Exception:
+        await admission.release(admitted["client_id"], len(sessions))
+        raise
+    
+    await asyncio.gather(*(
+        event_hub.publish(sid, status_payload(data)) for sid, data in sessions.items()
+    ))
+    
+    logger.info(f"Separazione batch accodata: {batch_id} ({len(sessions)} tracce, {priority})")
     
     return {
-        "session_id": session_id,
-        "status": "processing",
-        "message": "Separazione audio avviata"
+        "batch_id": batch_id,
+        "job_id": job_id,
+        "status": "queued",
+        "total": len(sessions),
+        "message": "Separazione batch accodata",
+        "estimated_time": admitted["estimated_time"]
     }
 
-async def process_audio_separation(session_id: str):
-    """Elaborazione separazione audio (background task)"""
+@app.get("/status/batch/{batch_id}")
+async def get_batch_status(batch_id: str):
+    """Stato aggregato di un batch (avanzamento complessivo e per traccia)"""
+    
+    batch = await session_store.get_batch(batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch non trovato")
+    
+    sessions = await session_store.get_many(batch["session_ids"])
+    
+    return batch_status_payload(batch, sessions)
+
+@app.post("/separate/{session_id}")
+async def separate_audio(session_id: str, http_request: Request,
+                         request: Optional[SeparationRequest] = None):
+    """Avvia separazione audio in 16 tracce (accodata ai worker)"""
+    
+    request = request or SeparationRequest()
+    
+    # Recupera dati sessione
+    session_data = await get_session_or_404(session_id)
+    
+    if session_data["status"] != "uploaded":
+        raise HTTPException(status_code=400, detail="File già in elaborazione o completato")
+    
     try:
-        # Recupera dati sessione
-        session_data = json.loads(redis_client.get(f"session:{session_id}"))
-        file_path = session_data["file_path"]
-        
-        logger.info(f"Inizio elaborazione separazione: {session_id}")
-        
-        # Separazione con Demucs (16 stems)
-        stems_paths = await demucs_model.separate_audio(file_path, session_id)
-        
-        # Aggiorna stato completato
-        session_data["status"] = "completed"
-        session_data["stems_paths"] = stems_paths
-        session_data["processing_completed_at"] = datetime.now().isoformat()
-        
-        redis_client.setex(
-            f"session:{session_id}", 
-            86400,
-            json.dumps(session_data)
-        )
+        priority = job_queue.resolve_priority(request.priority)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Ammissione in base a coda e throughput dei worker
+    admitted = await admit_jobs(http_request)
+    
+    # Stesso audio, modello e opzioni di un job già in coda o in corso:
+    # la sessione ne attende il risultato invece di accodare un'altra separazione
+    job_id = str(uuid.uuid4())
+    coalesce = None
+    if COALESCING_ENABLED and session_data.get("content_hash"):
+        coalesce = coalesce_key(session_data["content_hash"], request.options)
+    
+    try:
+        # Aggiorna stato a "queued": il worker passa a "processing" all'avvio
+        session_data = await session_store.update(session_id, {
+            "status": "queued",
+            "queued_at": datetime.now().isoformat(),
+            "estimated_time": admitted["estimated_time"]
+        })
+        if session_data is None:
+            raise HTTPException(status_code=404, detail="Sessione non trovata")
         
-        logger.info(f"Separazione completata: {session_id}")
+        leader_job_id = None
+        if coalesce:
+            leader_job_id = await coalescer.join(coalesce, job_id, {
+                "session_id": session_id,
+                "client_id": admitted["client_id"]
+            })
         
-    except Exception as e:
-        logger.error(f"Errore durante separazione {session_id}: {str(e)}")
+        if leader_job_id is None:
+            # Accoda job per i worker
+            try:
+                job = await job_queue.enqueue({
+                    "type": "separation",
+                    "job_id": job_id,
+                    "session_id": session_id,
+                    "audio_path": session_data["file_path"],
+                    "options": request.options,
+                    "client_id": admitted["client_id"],
+                    "coalesce_key": coalesce,
+                    "expected_duration": (session_data.get("audio_info") or {}).get("duration")
+                }, priority)
+            except Exception:
+                if coalesce:
+                    await fail_coalesced(coalesce, job_id, "Accodamento del job condiviso fallito")
+                raise
+    except Exception:
+        await admission.release(admitted["client_id"])
+        raise
+    
+    if leader_job_id is not None:
+        # Il worker può aver già scritto l'esito: aggiornamento atomico dei soli campi del job
+        await session_store.update(session_id, {
+            "job_id": leader_job_id,
+            "coalesced": True
+        }, publish=True)
         
-        # Aggiorna stato errore
-        session_data = json.loads(redis_client.get(f"session:{session_id}"))
-        session_data["status"] = "error"
-        session_data["error"] = str(e)
+        logger.info(f"Separazione unita al job in corso {leader_job_id}: {session_id}")
         
-        redis_client.setex(
-            f"session:{session_id}", 
-            86400,
-            json.dumps(session_data)
-        )
-
-@app.get("/status/{session_id}")
-async def get_status(session_id: str):
-    """Controllo stato elaborazione"""
+        return {
+            "session_id": session_id,
+            "job_id": leader_job_id,
+            "status": "queued",
+            "message": "Separazione identica già in corso: la sessione ne riceverà il risultato",
+            "coalesced": True,
+            "estimated_time": admitted["estimated_time"]
+        }
     
-    session_data = redis_client.get(f"session:{session_id}")
-    if not session_data:
-        raise HTTPException(status_code=404, detail="Sessione non trovata")
+    await session_store.update(session_id, {"job_id": job["job_id"]}, publish=True)
     
-    session_data = json.loads(session_data)
+    logger.info(f"Separazione accodata per sessione: {session_id} ({priority})")
     
     return {
         "session_id": session_id,
-        "status": session_data["status"],
-        "created_at": session_data.get("created_at"),
-        "processing_started_at": session_data.get("processing_started_at"),
-        "processing_completed_at": session_data.get("processing_completed_at"),
-        "error": session_data.get("error")
+        "job_id": job["job_id"],
+        "status": "queued",
+        "message": "Separazione audio accodata",
+        "coalesced": False,
+        "estimated_time": admitted["estimated_time"]
     }
 
+async def fail_coalesced(key: str, job_id: str, error: str):
+    """Chiude un gruppo il cui job non è partito: i waiter passano in errore"""
+    for waiter in await coalescer.complete(key, job_id):
+        await session_store.update(waiter["session_id"], {
+            "status": "error",
+            "error": error
+        }, publish=True)
+        if waiter.get("client_id"):
+            await admission.release(waiter["client_id"])
+
+@app.get("/status/{session_id}")
+async def get_status(session_id: str):
+    """Controllo stato elaborazione"""
+    
+    session_data = await get_session_or_404(session_id)
+    
+    return status_payload({**session_data, "session_id": session_id})
+
+@app.get("/status/{session_id}/stream")
+async def stream_status(session_id: str, request: Request):
+    """Stato elaborazione in push (Server-Sent Events)"""
+    
+    await get_session_or_404(session_id)
+    
+    # Sottoscrizione prima della lettura iniziale: nessun evento perso
+    queue = event_hub.subscribe(session_id)
+    
+    async def event_stream():
+        try:
+            session_data = await session_store.get(session_id) or {"status": "expired"}
+            state = status_payload({**session_data, "session_id": session_id})
+            yield f"event: status\ndata: {json.dumps(state)}\n\n"
+            
+            while state["status"] not in TERMINAL_STATUSES:
+                if await request.is_disconnected():
+                    break
+                
+                try:
+                    state = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # Keep-alive per proxy e load balancer
+                    yield ": keep-alive\n\n"
+                    continue
+                
+                yield f"event: status\ndata: {json.dumps(state)}\n\n"
+        finally:
+            event_hub.unsubscribe(session_id, queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+async def localize_stem(stem_path: str) -> str:
+    """Stem su disco locale: scaricato dalla blob store alla prima richiesta"""
+    try:
+        return await file_manager.localize(stem_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File non trovato")
+
+async def localize_stems(stems_paths: Dict[str, str]) -> Dict[str, str]:
+    try:
+        return await file_manager.localize_all(stems_paths)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File non trovato")
+
 @app.get("/download/{session_id}/stems")
-async def download_stems(session_id: str):
+async def download_stems(session_id: str, request: Request, format: str = "wav",
+                         bitrate: Optional[int] = None):
     """Download di tutte le tracce separate"""
     
-    session_data = redis_client.get(f"session:{session_id}")
-    if not session_data:
-        raise HTTPException(status_code=404, detail="Sessione non trovata")
+    session_data = await get_completed_session(session_id)
     
-    session_data = json.loads(session_data)
+    try:
+        export_format, bitrate = exporter.resolve_format(format, bitrate)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    archive_name = "stems_archive.zip" if export_format == "wav" else \
+        f"stems_archive_{export_format}_{bitrate or 'lossless'}.zip"
+    
+    # Archivio già generato: servito da cache con Range/ETag
+    zip_path = file_manager.get_cached_archive(session_id, archive_name)
+    if zip_path:
+        record_cache("archive", True)
+        return file_response(
+            request,
+            zip_path,
+            media_type="application/zip",
+            filename=f"stems_{session_id}.zip",
+            immutable=False
+        )
     
-    if session_data["status"] != "completed":
-        raise HTTPException(status_code=400, detail="Elaborazione non completata")
+    stems_paths = await localize_stems(session_data["stems_paths"])
     
-    # Crea archivio ZIP con tutte le tracce
-    zip_path = await file_manager.create_stems_archive(session_id, session_data["stems_paths"])
+    async def prepare(stem_path: str) -> str:
+        return await exporter.get_rendition(stem_path, export_format, bitrate)
     
-    return FileResponse(
-        zip_path,
+    # Prima richiesta: ZIP in streaming, salvato in cache durante l'invio;
+    # ogni stem è codificato in parallelo e aggiunto appena pronto
+    return StreamingResponse(
+        file_manager.stream_stems_archive(
+            session_id, stems_paths, archive_name,
+            prepare=prepare if export_format != "wav" else None
+        ),
         media_type="application/zip",
-        filename=f"stems_{session_id}.zip"
+        headers={"Content-Disposition": f'attachment; filename="stems_{session_id}.zip"'}
     )
 
 @app.get("/download/{session_id}/stem/{stem_name}")
-async def download_single_stem(session_id: str, stem_name: str):
+async def download_single_stem(session_id: str, stem_name: str, request: Request,
+                               format: str = "wav", bitrate: Optional[int] = None):
     """Download di una singola traccia"""
     
-    session_data = redis_client.get(f"session:{session_id}")
-    if not session_data:
-        raise HTTPException(status_code=404, detail="Sessione non trovata")
+    session_data = await get_completed_session(session_id)
     
-    session_data = json.loads(session_data)
+    stems_paths = session_data["stems_paths"]
     
-    if session_data["status"] != "completed":
-        raise HTTPException(status_code=400, detail="Elaborazione non completata")
+    if stem_name not in stems_paths:
+        raise HTTPException(status_code=404, detail="Traccia non trovata")
+    
+    try:
+        stem_path = await localize_stem(stems_paths[stem_name])
+        stem_path = await exporter.get_rendition(stem_path, format, bitrate)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    export_info = EXPORT_FORMATS[format.lower()]
+    
+    # Stems completati immutabili: Range, ETag e cache a lungo termine
+    return file_response(
+        request,
+        stem_path,
+        media_type=export_info["media_type"],
+        filename=f"{stem_name}_{session_id}.{export_info['extension']}"
+    )
+
+@app.get("/peaks/{session_id}/{stem_name}")
+async def get_stem_peaks(session_id: str, stem_name: str, start: float = 0.0,
+                         end: Optional[float] = None, width: int = 1000):
+    """Picchi min/max di una traccia per l'intervallo e la risoluzione richiesti
+    
+    Risposta binaria: header fisso (vedi utils.peaks) + coppie int16 (min, max).
+    """
+    
+    session_data = await get_completed_session(session_id)
     
     stems_paths = session_data["stems_paths"]
     
     if stem_name not in stems_paths:
         raise HTTPException(status_code=404, detail="Traccia non trovata")
     
-    stem_path = stems_paths[stem_name]
+    if start < 0 or (end is not None and end <= start) or width <= 0:
+        raise HTTPException(status_code=400, detail="Parametri intervallo non validi")
     
-    return FileResponse(
-        stem_path,
+    stem_path = await localize_stem(stems_paths[stem_name])
+    
+    try:
+        # Generata durante il post-processing; al volo per sessioni precedenti
+        await waveform_peaks.ensure(stem_path)
+        
+        loop = asyncio.get_event_loop()
+        payload = await loop.run_in_executor(
+            None, waveform_peaks.read_range, stem_path, start, end, width
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File non trovato")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return Response(
+        content=payload,
+        media_type="application/octet-stream",
+        headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    )
+
+@app.post("/mixdown/{session_id}")
+async def mixdown_stems(session_id: str, request: MixdownRequest):
+    """Mixdown in streaming degli stems selezionati"""
+    
+    session_data = await get_completed_session(session_id)
+    
+    stems_paths = session_data["stems_paths"]
+    
+    missing = [name for name in request.stems if name not in stems_paths]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Tracce non trovate: {', '.join(missing)}")
+    
+    tracks = build_mix_tracks(
+        await localize_stems({name: stems_paths[name] for name in request.stems}),
+        {
+            "stem_gains": {name: s.get("gain_db", 0.0) for name, s in request.stems.items()},
+            "stem_pans": {name: s.get("pan", 0.0) for name, s in request.stems.items()},
+            "stem_offsets": {name: s.get("offset", 0.0) for name, s in request.stems.items()}
+        }
+    )
+    
+    # Il mix viene generato a blocchi mentre viene inviato
+    return StreamingResponse(
+        mixer.iter_wav(tracks),
         media_type="audio/wav",
-        filename=f"{stem_name}_{session_id}.wav"
+        headers={"Content-Disposition": f'attachment; filename="mix_{session_id}.wav"'}
     )
 
 @app.delete("/session/{session_id}")
@@ -280,7 +809,7 @@ async def delete_session(session_id: str):
         await file_manager.cleanup_session(session_id)
         
         # Elimina dati da Redis
-        redis_client.delete(f"session:{session_id}")
+        await session_store.delete(session_id)
         
         logger.info(f"Sessione eliminata: {session_id}")
         
@@ -3,11 +3,15 @@ import torchaudio
 import numpy as np
 from pathlib import Path
 import logging
-from typing import Dict, List, Optional
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
 import os
 
+from utils.metrics import stage_timer, record_file_bytes
+from utils.cancellation import CancelToken
+from utils.stems import BASE_STEMS, DERIVED_STEMS
+
 # Import Demucs
 try:
     from demucs.pretrained import get_model
@@ -19,11 +23,20 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Frequenza di lavoro del modello (l'audio viene ricampionato in decodifica)
+MODEL_SAMPLE_RATE = 44100
+
+# Separazione a segmenti salvati su disco: un job interrotto (drain, kill)
+# riprende dal primo segmento mancante; sovrapposizione in dissolvenza
+SEGMENT_SECONDS = float(os.getenv("SEPARATION_SEGMENT_SECONDS", "60"))
+SEGMENT_OVERLAP_SECONDS = 1.0
+
 class DemucsModel:
     """Modello Demucs per separazione audio professionale in 16 tracce"""
     
     def __init__(self):
         self.model = None
+        self.model_name = None
         self.device = None
         self.is_loaded = False
         self.gpu_available = torch.cuda.is_available()
@@ -55,7 +68,34 @@ class DemucsModel:
             "effects": "effects"
         }
         
-        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.max_workers = 2
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        
+        # Inferenze ancora in esecuzione dopo che il job è stato abbandonato
+        self._orphaned: Set[Future] = set()
+    
+    @property
+    def orphaned_threads(self) -> int:
+        """Thread dell'executor occupati da inferenze di job abbandonati
+        
+        Un thread non si può interrompere: cancellare il task asyncio lascia il
+        calcolo in corso fino alla fine, con il posto nel pool occupato.
+        """
+        return sum(1 for future in list(self._orphaned) if not future.done())
+    
+    def _run(self, fn, *args) -> asyncio.Future:
+        """Esegue fn sull'executor del modello tenendo traccia dei thread orfani"""
+        future = self.executor.submit(fn, *args)
+        wrapped = asyncio.wrap_future(future)
+        
+        def on_done(result: asyncio.Future):
+            # Attesa cancellata con il calcolo già avviato: il thread resta occupato
+            if result.cancelled() and not future.done():
+                self._orphaned.add(future)
+                future.add_done_callback(self._orphaned.discard)
+        
+        wrapped.add_done_callback(on_done)
+        return wrapped
     
     async def load_model(self, model_name: str = "htdemucs"):
         """Carica il modello Demucs"""
@@ -78,6 +118,7 @@ class DemucsModel:
                 model_name
             )
             
+            self.model_name = model_name
             self.is_loaded = True
             logger.info("Modello Demucs caricato con successo")
             
@@ -92,30 +133,18 @@ class DemucsModel:
         model.eval()
         return model
     
-    async def separate_audio(self, audio_path: str, session_id: str) -> Dict[str, str]:
-        """Separazione audio in 16 tracce"""
+    async def separate_audio(self, audio_path: str, session_id: str,
+                           stems: Optional[List[str]] = None) -> Dict[str, str]:
+        """Separazione audio in 16 tracce (o solo negli stems richiesti)"""
         if not self.is_loaded:
             raise RuntimeError("Modello non caricato")
         
         try:
             logger.info(f"Inizio separazione audio: {audio_path}")
             
-            # Carica audio
-            waveform, sample_rate = torchaudio.load(audio_path)
-            
-            # Preprocessing
-            waveform = self._preprocess_audio(waveform, sample_rate)
-            
-            # Separazione con Demucs
-            loop = asyncio.get_event_loop()
-            separated_sources = await loop.run_in_executor(
-                self.executor,
-                self._separate_sync,
-                waveform
-            )
-            
-            # Post-processing e salvataggio stems
-            stems_paths = await self._save_stems(separated_sources, session_id, sample_rate)
+            waveform, sample_rate = await self.decode(audio_path)
+            separated_sources = await self.infer(waveform)
+            stems_paths = await self.save_stems(separated_sources, session_id, sample_rate, stems)
             
             logger.info(f"Separazione completata: {len(stems_paths)} tracce")
             return stems_paths
@@ -124,6 +153,112 @@ class DemucsModel:
             logger.error(f"Errore durante separazione: {str(e)}")
             raise
     
+    # Fasi della separazione, eseguibili separatamente dalla pipeline del worker:
+    # decodifica e salvataggio su pool CPU, inferenza sull'executor del modello
+    
+    async def decode(self, audio_path: str,
+                     executor: Optional[ThreadPoolExecutor] = None) -> Tuple[torch.Tensor, int]:
+        """Carica e prepara l'audio per il modello (su CPU)"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor or self.executor, self._decode_sync, audio_path)
+    
+    async def infer(self, waveform: torch.Tensor, cancel: Optional[CancelToken] = None,
+                    segments_dir: Optional[Path] = None,
+                    on_segment: Optional[Callable[[Path], Awaitable]] = None) -> torch.Tensor:
+        """Inferenza Demucs; le sorgenti tornano su CPU liberando subito il device
+        
+        Con segments_dir l'audio è separato a segmenti salvati man mano: tra un
+        segmento e l'altro si verifica cancel, e una ripresa salta quelli già fatti.
+        on_segment riceve ogni segmento salvato (es. per archiviarlo altrove).
+        """
+        if not self.is_loaded:
+            raise RuntimeError("Modello non caricato")
+        
+        length = waveform.shape[-1]
+        segment = int(SEGMENT_SECONDS * MODEL_SAMPLE_RATE)
+        
+        with stage_timer("separation"):
+            if segments_dir is None or segment <= 0 or length <= segment:
+                if cancel is not None:
+                    cancel.raise_if_cancelled()
+                return await self._run(self._separate_sync, waveform)
+            
+            segments_dir.mkdir(parents=True, exist_ok=True)
+            overlap = int(SEGMENT_OVERLAP_SECONDS * MODEL_SAMPLE_RATE)
+            
+            parts = []
+            for index, start in enumerate(range(0, length, segment)):
+                path = segments_dir / f"segment_{index:04d}.pt"
+                bounds = (max(0, start - overlap), min(length, start + segment + overlap))
+                
+                if path.exists():
+                    parts.append((bounds, await self._run(torch.load, path)))
+                    continue
+                
+                if cancel is not None:
+                    cancel.raise_if_cancelled()
+                
+                sources = await self._run(self._separate_sync, waveform[..., bounds[0]:bounds[1]])
+                await self._run(self._save_segment, sources, path)
+                if on_segment is not None:
+                    await on_segment(path)
+                parts.append((bounds, sources))
+                if cancel is not None:
+                    cancel.mark_progress()
+            
+            logger.info(f"Separazione a segmenti completata: {len(parts)} segmenti")
+            # Overlap-add sull'intera durata: fuori dall'event loop come l'inferenza
+            return await self._run(self._stitch_segments, parts, length, overlap)
+    
+    @staticmethod
+    def _save_segment(sources: torch.Tensor, path: Path):
+        tmp_path = path.with_suffix(".tmp")
+        torch.save(sources, tmp_path)
+        tmp_path.replace(path)
+    
+    @staticmethod
+    def _stitch_segments(parts: List[Tuple[Tuple[int, int], torch.Tensor]], length: int,
+                         overlap: int) -> torch.Tensor:
+        """Ricompone i segmenti con dissolvenza lineare nelle sovrapposizioni"""
+        
+        first = parts[0][1]
+        output = torch.zeros(*first.shape[:-1], length, dtype=first.dtype)
+        weight = torch.zeros(length, dtype=first.dtype)
+        
+        for (start, end), sources in parts:
+            window = torch.ones(end - start, dtype=first.dtype)
+            ramp = min(2 * overlap, (end - start) // 2)
+            if ramp > 0 and start > 0:
+                window[:ramp] = torch.linspace(0, 1, ramp + 2, dtype=first.dtype)[1:-1]
+            if ramp > 0 and end < length:
+                window[-ramp:] = torch.linspace(1, 0, ramp + 2, dtype=first.dtype)[1:-1]
+            
+            output[..., start:end] += sources[..., :end - start] * window
+            weight[start:end] += window
+        
+        return output / weight.clamp_min(1e-8)
+    
+    async def save_stems(self, sources: torch.Tensor, session_id: str, sample_rate: int,
+                         stems: Optional[List[str]] = None,
+                         executor: Optional[ThreadPoolExecutor] = None,
+                         output_dir: Optional[Path] = None) -> Dict[str, str]:
+        """Salva stems base e derivati (in output_dir, di default nella directory della sessione)"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            executor or self.executor, self._save_stems, sources, session_id, sample_rate, stems, output_dir
+        )
+    
+    def _decode_sync(self, audio_path: str) -> Tuple[torch.Tensor, int]:
+        with stage_timer("decode"):
+            # Carica audio
+            waveform, sample_rate = torchaudio.load(audio_path)
+            record_file_bytes("read", "decode", audio_path)
+            
+            # Preprocessing
+            waveform = self._preprocess_audio(waveform, sample_rate)
+        
+        return waveform, sample_rate
+    
     def _preprocess_audio(self, waveform: torch.Tensor, sample_rate: int) -> torch.Tensor:
         """Preprocessing dell'audio per Demucs"""
         
@@ -132,7 +267,7 @@ class DemucsModel:
             waveform = torch.mean(waveform, dim=0, keepdim=True)
         
         # Resample se necessario (Demucs lavora a 44.1kHz)
-        target_sr = 44100
+        target_sr = MODEL_SAMPLE_RATE
         if sample_rate != target_sr:
             resampler = torchaudio.transforms.Resample(sample_rate, target_sr)
             waveform = resampler(waveform)
@@ -140,7 +275,8 @@ class DemucsModel:
         # Normalizzazione
         waveform = waveform / torch.max(torch.abs(waveform))
         
-        return waveform.to(self.device)
+        # Resta su CPU: il trasferimento al device avviene all'inferenza
+        return waveform
     
     def _separate_sync(self, waveform: torch.Tensor) -> torch.Tensor:
         """Separazione sincrona con Demucs"""
@@ -148,68 +284,78 @@ class DemucsModel:
             # Applica modello Demucs
             sources = apply_model(
                 self.model, 
-                waveform.unsqueeze(0),  # Batch dimension
+                waveform.to(self.device).unsqueeze(0),  # Batch dimension
                 device=self.device,
                 progress=True
             )
             
-            return sources.squeeze(0)  # Rimuovi batch dimension
+            return sources.squeeze(0).cpu()  # Rimuovi batch dimension
     
-    async def _save_stems(self, sources: torch.Tensor, session_id: str, sample_rate: int) -> Dict[str, str]:
+    def _save_stems(self, sources: torch.Tensor, session_id: str, sample_rate: int,
+                        stems: Optional[List[str]] = None,
+                        output_dir: Optional[Path] = None) -> Dict[str, str]:
         """Salva le tracce separate e genera stems aggiuntivi"""
         
-        stems_dir = Path(f"/app/temp_files/{session_id}/stems")
+        stems_dir = Path(output_dir or f"/app/temp_files/{session_id}/stems")
         stems_dir.mkdir(parents=True, exist_ok=True)
         
         stems_paths = {}
         
         # Stems base da Demucs (4 tracce standard)
-        base_stems = ["drums", "bass", "other", "vocals"]
-        
-        for i, stem_name in enumerate(base_stems):
-            if i < sources.shape[0]:
-                stem_path = stems_dir / f"{stem_name}.wav"
-                
-                # Converti a CPU e salva
-                audio_data = sources[i].cpu()
-                torchaudio.save(
-                    str(stem_path),
-                    audio_data,
-                    sample_rate,
-                    format="wav"
-                )
-                
-                stems_paths[stem_name] = str(stem_path)
+        with stage_timer("save"):
+            for i, stem_name in enumerate(BASE_STEMS):
+                if i < sources.shape[0]:
+                    stem_path = stems_dir / f"{stem_name}.wav"
+                    
+                    # Converti a CPU e salva
+                    audio_data = sources[i].cpu()
+                    torchaudio.save(
+                        str(stem_path),
+                        audio_data,
+                        sample_rate,
+                        format="wav"
+                    )
+                    
+                    stems_paths[stem_name] = str(stem_path)
+            
+            record_file_bytes("write", "save", *stems_paths.values())
         
         # Genera stems aggiuntivi tramite post-processing
-        additional_stems = await self._generate_additional_stems(
-            stems_paths, stems_dir, sample_rate
-        )
+        with stage_timer("derived_stems"):
+            additional_stems = self._generate_additional_stems(
+                stems_paths, stems_dir, sample_rate, stems
+            )
+            record_file_bytes("write", "derived_stems", *additional_stems.values())
         
         stems_paths.update(additional_stems)
         
         return stems_paths
     
-    async def _generate_additional_stems(self, base_stems: Dict[str, str], 
-                                       stems_dir: Path, sample_rate: int) -> Dict[str, str]:
+    def _generate_additional_stems(self, base_stems: Dict[str, str], 
+                                       stems_dir: Path, sample_rate: int,
+                                       required: Optional[List[str]] = None) -> Dict[str, str]:
         """Genera stems aggiuntivi tramite analisi spettrale e separazione avanzata"""
         
         additional_stems = {}
         
+        def is_needed(group: str) -> bool:
+            # Senza richiesta esplicita si generano tutte le 16 tracce
+            return required is None or any(name in required for name in DERIVED_STEMS[group])
+        
         try:
             # Analizza drums per separare kick, snare, hihat
-            if "drums" in base_stems:
-                drum_stems = await self._separate_drums(base_stems["drums"], stems_dir, sample_rate)
+            if "drums" in base_stems and is_needed("drums"):
+                drum_stems = self._separate_drums(base_stems["drums"], stems_dir, sample_rate)
                 additional_stems.update(drum_stems)
             
             # Analizza vocals per separare lead, backing, choir
-            if "vocals" in base_stems:
-                vocal_stems = await self._separate_vocals(base_stems["vocals"], stems_dir, sample_rate)
+            if "vocals" in base_stems and is_needed("vocals"):
+                vocal_stems = self._separate_vocals(base_stems["vocals"], stems_dir, sample_rate)
                 additional_stems.update(vocal_stems)
             
             # Analizza "other" per strumenti specifici
-            if "other" in base_stems:
-                instrument_stems = await self._separate_instruments(base_stems["other"], stems_dir, sample_rate)
+            if "other" in base_stems and is_needed("other"):
+                instrument_stems = self._separate_instruments(base_stems["other"], stems_dir, sample_rate)
                 additional_stems.update(instrument_stems)
             
         except Exception as e:
@@ -217,7 +363,7 @@ class DemucsModel:
         
         return additional_stems
     
-    async def _separate_drums(self, drums_path: str, output_dir: Path, sample_rate: int) -> Dict[str, str]:
+    def _separate_drums(self, drums_path: str, output_dir: Path, sample_rate: int) -> Dict[str, str]:
         """Separazione batteria in kick, snare, hihat, percussion"""
         
         drum_stems = {}
@@ -271,7 +417,7 @@ class DemucsModel:
         
         return drum_stems
     
-    async def _separate_vocals(self, vocals_path: str, output_dir: Path, sample_rate: int) -> Dict[str, str]:
+    def _separate_vocals(self, vocals_path: str, output_dir: Path, sample_rate: int) -> Dict[str, str]:
         """Separazione voci in lead, backing, choir"""
         
         vocal_stems = {}
@@ -309,7 +455,7 @@ class DemucsModel:
         
         return vocal_stems
     
-    async def _separate_instruments(self, other_path: str, output_dir: Path, sample_rate: int) -> Dict[str, str]:
+    def _separate_instruments(self, other_path: str, output_dir: Path, sample_rate: int) -> Dict[str, str]:
         """Separazione strumenti da traccia 'other'"""
         
         instrument_stems = {}
@@ -0,0 +1,115 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+import utils.admission as admission_module
+from utils.admission import (
+    JOB_DURATIONS_KEY, AdmissionController, AdmissionRejected, inflight_key
+)
+
+fakeredis = pytest.importorskip("fakeredis")
+
+class _Queue:
+    """Profondità della coda fissata dal test"""
+
+    def __init__(self, depth: int):
+        self.depth_value = depth
+
+    async def depth(self):
+        return {"normal": self.depth_value}
+
+async def _controller(depth: int, workers: int = 2, job_seconds: float = 60.0):
+    """Controller con worker da un posto ciascuno e durata media dei job nota"""
+
+    client = fakeredis.aioredis.FakeRedis()
+    for index in range(workers):
+        await client.set(f"worker:w{index}", json.dumps({"pipeline_depth": 1}))
+    await client.rpush(JOB_DURATIONS_KEY, job_seconds)
+
+    return AdmissionController(client, _Queue(depth)), client
+
+def test_queue_wait_over_limit_sets_retry_after(monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(admission_module, "MAX_QUEUE_WAIT", 900.0)
+        monkeypatch.setattr(admission_module, "MAX_QUEUE_DEPTH", 200)
+
+        # 2 posti, 60 s per job: 1/30 job/s, attesa massima = 30 job in coda
+        controller, _ = await _controller(depth=40)
+        with pytest.raises(AdmissionRejected) as exc_info:
+            await controller.admit("ip:1", limit=10)
+
+        # 10 job oltre il limite a 30 s ciascuno
+        assert exc_info.value.retry_after == 300
+
+        controller, _ = await _controller(depth=3)
+        estimate = await controller.admit("ip:1", limit=10)
+        assert estimate == {"queue_depth": 3, "workers": 2, "estimated_time": 150.0}
+
+    asyncio.run(scenario())
+
+def test_queue_depth_over_limit(monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(admission_module, "MAX_QUEUE_WAIT", 900.0)
+        monkeypatch.setattr(admission_module, "MAX_QUEUE_DEPTH", 10)
+
+        controller, _ = await _controller(depth=10)
+        with pytest.raises(AdmissionRejected) as exc_info:
+            await controller.admit("ip:1", limit=10)
+        assert exc_info.value.retry_after == 30
+
+        # Batch: il numero di job richiesti conta sulla profondità
+        controller, _ = await _controller(depth=5)
+        with pytest.raises(AdmissionRejected):
+            await controller.admit("ip:1", limit=10, jobs=6)
+
+    asyncio.run(scenario())
+
+def test_client_limit(monkeypatch):
+    async def scenario():
+        controller, client = await _controller(depth=0)
+
+        await controller.admit("ip:1", limit=2)
+        await controller.admit("ip:1", limit=2)
+        with pytest.raises(AdmissionRejected) as exc_info:
+            await controller.admit("ip:1", limit=2)
+
+        # Riprovare dopo circa un job; il tentativo rifiutato non occupa posti
+        assert exc_info.value.retry_after == 60
+        assert int(await client.get(inflight_key("ip:1"))) == 2
+
+        await controller.release("ip:1")
+        await controller.admit("ip:1", limit=2)
+
+        # Altri client non sono toccati dal limite
+        await controller.admit("ip:2", limit=2)
+
+    asyncio.run(scenario())
+
+def test_rejection_is_a_429_with_retry_after(monkeypatch):
+    main = pytest.importorskip("main")
+
+    # Dati scritti con un client sincrono: quello asincrono si connette nel loop dell'app
+    server = fakeredis.FakeServer()
+    fakeredis.FakeRedis(server=server).set("worker:w0", json.dumps({"pipeline_depth": 1}))
+    fakeredis.FakeRedis(server=server).rpush(JOB_DURATIONS_KEY, 60.0)
+    controller = AdmissionController(fakeredis.aioredis.FakeRedis(server=server), _Queue(0))
+
+    monkeypatch.setattr(main, "admission", controller)
+    monkeypatch.setattr(main, "resolve_client", lambda api_key, host: ("ip:test", 1))
+
+    app = FastAPI()
+
+    @app.post("/admit")
+    async def admit(request: Request):
+        return await main.admit_jobs(request)
+
+    # Un solo event loop per tutte le richieste (client Redis asincrono)
+    with TestClient(app) as client:
+        assert client.post("/admit").status_code == 200
+
+        response = client.post("/admit")
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "60"
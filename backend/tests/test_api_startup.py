@@ -0,0 +1,59 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+# Limiti generosi: l'import con torch/demucs richiede diversi secondi
+MAX_IMPORT_SECONDS = 5.0
+MAX_STARTUP_SECONDS = 2.0
+
+# Interprete pulito: qualsiasi tentativo di import delle librerie di
+# inferenza viene registrato (e fallisce), anche se non installate
+PROBE = """
+import asyncio, importlib.abc, json, sys, time
+
+HEAVY = ("torch", "torchaudio", "librosa", "demucs")
+attempted = []
+
+class BlockHeavy(importlib.abc.MetaPathFinder):
+    def find_spec(self, name, path=None, target=None):
+        if name.split(".")[0] in HEAVY:
+            attempted.append(name)
+            raise ImportError(f"{name} importato dal processo API")
+        return None
+
+sys.meta_path.insert(0, BlockHeavy())
+
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def startup():
+    await main.startup_event()
+    elapsed = time.perf_counter() - imported
+    await main.shutdown_event()
+    return elapsed
+
+startup_seconds = asyncio.run(startup())
+print(json.dumps({
+    "import_seconds": imported - started,
+    "startup_seconds": startup_seconds,
+    "attempted": attempted,
+    "loaded": [name for name in HEAVY if name in sys.modules]
+}))
+"""
+
+def test_api_imports_without_inference_libraries():
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=BACKEND_DIR, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode == 0, result.stderr
+
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    assert report["attempted"] == []
+    assert report["loaded"] == []
+    assert report["import_seconds"] < MAX_IMPORT_SECONDS
+    assert report["startup_seconds"] < MAX_STARTUP_SECONDS
@@ -0,0 +1,68 @@
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+fakeredis = pytest.importorskip("fakeredis")
+
+from utils.blob_store import BlobStore, S3BlobBackend
+
+BUCKET = "musicai-blobs-test"
+
+@pytest.fixture(autouse=True)
+def aws_credentials(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+def _write(path, data: bytes) -> str:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+def test_backend_creates_missing_bucket():
+    with moto.mock_aws():
+        backend = S3BlobBackend(BUCKET, "blobs/")
+        backend.client.head_bucket(Bucket=BUCKET)
+
+        # Un secondo processo trova il bucket già creato
+        S3BlobBackend(BUCKET, "blobs/")
+
+def test_put_get_and_collect(tmp_path):
+    async def scenario():
+        redis_client = fakeredis.aioredis.FakeRedis()
+        backend = S3BlobBackend(BUCKET, "blobs/")
+        store = BlobStore(backend, str(tmp_path / "cache"), redis_client)
+
+        # Stesso contenuto da due sessioni: un solo oggetto nel bucket
+        first = await store.put("s1", "stems/vocals", _write(tmp_path / "s1" / "vocals.wav", b"voce"))
+        second = await store.put("s2", "stems/vocals", _write(tmp_path / "s2" / "vocals.wav", b"voce"))
+        assert first == second
+
+        key = store.key_for(first)
+        assert backend.exists(key)
+        objects = backend.client.list_objects_v2(Bucket=BUCKET)["Contents"]
+        assert [item["Key"] for item in objects] == [f"blobs/{key[:2]}/{key}"]
+
+        # Altro nodo: cache vuota, il blob viene scaricato dal bucket
+        os.remove(first)
+        assert await store.exists(first)
+        assert open(await store.localize(first), "rb").read() == b"voce"
+
+        # Raccolto solo quando nessuna sessione lo referenzia più
+        assert await store.release_session("s1") == 0
+        assert await store.collect_garbage(grace=0) == 0
+        assert backend.exists(key)
+
+        assert await store.release_session("s2") == 1
+        assert await store.collect_garbage(grace=0) == 1
+        assert not backend.exists(key)
+        assert not os.path.exists(first)
+
+        with pytest.raises(FileNotFoundError):
+            backend.get(key, tmp_path / "missing.wav")
+
+    with moto.mock_aws():
+        asyncio.run(scenario())
@@ -0,0 +1,75 @@
+import asyncio
+import os
+
+import pytest
+
+import utils.blob_store as blob_store
+from utils.checkpoint import CheckpointStore, checkpoint_key
+from utils.file_manager import FileManager
+
+fakeredis = pytest.importorskip("fakeredis")
+
+@pytest.fixture
+def shared_blobs(tmp_path, monkeypatch):
+    """Backend dei blob condiviso, cache locale del nodo separata"""
+
+    monkeypatch.setattr(blob_store, "BLOB_ROOT", str(tmp_path / "shared"))
+    monkeypatch.setattr(blob_store, "BLOB_CACHE_DIR", str(tmp_path / "cache"))
+
+def test_checkpoint_resumes_with_artifacts_from_blob_store(tmp_path, shared_blobs):
+    async def scenario():
+        redis_client = fakeredis.aioredis.FakeRedis()
+        file_manager = FileManager(str(tmp_path / "node"), redis_client)
+        checkpoints = CheckpointStore(redis_client, file_manager.blobs)
+
+        stem = file_manager.session_dir("s1") / "vocals.wav"
+        stem.write_bytes(b"voce")
+        stems = await file_manager.publish_files("s1", {"vocals": str(stem)}, "stems/")
+
+        input_hash = checkpoints.fingerprint({"stage": "separation"})
+        await checkpoints.save("s1", "separation", input_hash, stems, list(stems.values()))
+
+        # Altro nodo: nessun file locale, checkpoint e blob condivisi
+        os.remove(stems["vocals"])
+        entry = await checkpoints.load("s1", "separation", input_hash)
+        assert entry["result"] == stems
+        assert open(stems["vocals"], "rb").read() == b"voce"
+
+        assert await checkpoints.load("s1", "separation", "altro input") is None
+
+        # Artefatto raccolto: la fase va rifatta
+        file_manager.blobs._delete(file_manager.blobs.key_for(stems["vocals"]))
+        assert await checkpoints.load("s1", "separation", input_hash) is None
+
+        # Eliminazione della sessione: checkpoint rimossi
+        await file_manager.cleanup_session("s1")
+        assert not await redis_client.exists(checkpoint_key("s1"))
+
+    asyncio.run(scenario())
+
+def test_segments_restored_and_released(tmp_path, shared_blobs):
+    async def scenario():
+        redis_client = fakeredis.aioredis.FakeRedis()
+        file_manager = FileManager(str(tmp_path / "node"), redis_client)
+        prefix = "segments/abc_htdemucs/"
+
+        segments_dir = file_manager.session_dir("s1") / prefix
+        segments_dir.mkdir(parents=True)
+        for index in range(2):
+            segment = segments_dir / f"segment_{index:04d}.pt"
+            segment.write_bytes(f"segmento {index}".encode())
+            await file_manager.publish_files("s1", {segment.name: str(segment)}, prefix)
+
+        # Ripresa su un nodo senza la directory dei segmenti né la cache
+        restored_dir = tmp_path / "restored"
+        for path in (await file_manager.blobs.manifest("s1")).values():
+            os.remove(path)
+        assert await file_manager.restore_files("s1", prefix, restored_dir) == 2
+        assert (restored_dir / "segment_0001.pt").read_bytes() == b"segmento 1"
+
+        # A separazione completata i segmenti diventano orfani per il GC
+        assert await file_manager.release_files("s1", prefix) == 2
+        assert await file_manager.blobs.manifest("s1") == {}
+        assert await file_manager.blobs.collect_garbage(grace=0) == 2
+
+    asyncio.run(scenario())
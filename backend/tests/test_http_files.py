@@ -0,0 +1,91 @@
+import pytest
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.testclient import TestClient
+
+from utils.http_files import _parse_range, file_response
+
+CONTENT = bytes(range(256)) * 4
+
+@pytest.fixture
+def client(tmp_path):
+    path = tmp_path / "vocals.wav"
+    path.write_bytes(CONTENT)
+
+    app = FastAPI()
+
+    @app.get("/file")
+    async def serve(request: Request):
+        return file_response(request, str(path), "audio/wav", "vocals.wav")
+
+    return TestClient(app)
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=1000-", (1000, 1023)),
+    ("bytes=1000-5000", (1000, 1023)),
+    ("bytes=-24", (1000, 1023)),
+    ("bytes=-5000", (0, 1023)),
+    ("bytes=0-9,20-29", None),
+    ("items=0-9", None),
+    ("bytes=abc-", None),
+    ("bytes=-0", None),
+])
+def test_parse_range(header, expected):
+    assert _parse_range(header, len(CONTENT)) == expected
+
+@pytest.mark.parametrize("header", ["bytes=1024-", "bytes=10-5"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(HTTPException) as exc_info:
+        _parse_range(header, len(CONTENT))
+
+    assert exc_info.value.status_code == 416
+    assert exc_info.value.headers["Content-Range"] == f"bytes */{len(CONTENT)}"
+
+def test_range_requests(client):
+    response = client.get("/file", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 10-19/{len(CONTENT)}"
+    assert response.content == CONTENT[10:20]
+
+    response = client.get("/file", headers={"Range": "bytes=-4"})
+    assert response.status_code == 206
+    assert response.content == CONTENT[-4:]
+
+    # Multi-range non supportato: file intero
+    response = client.get("/file", headers={"Range": "bytes=0-1,5-6"})
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+    response = client.get("/file", headers={"Range": "bytes=5000-"})
+    assert response.status_code == 416
+
+def test_if_range(client):
+    etag = client.get("/file").headers["ETag"]
+
+    response = client.get("/file", headers={"Range": "bytes=0-9", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.content == CONTENT[:10]
+
+    # Risorsa cambiata (altro validatore): il Range viene ignorato
+    response = client.get("/file", headers={"Range": "bytes=0-9", "If-Range": '"altro"'})
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+def test_conditional_requests(client):
+    first = client.get("/file")
+    etag, last_modified = first.headers["ETag"], first.headers["Last-Modified"]
+
+    assert client.get("/file", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/file", headers={"If-None-Match": f'"x", W/{etag}'}).status_code == 304
+    assert client.get("/file", headers={"If-None-Match": "*"}).status_code == 304
+    assert client.get("/file", headers={"If-None-Match": '"x"'}).status_code == 200
+
+    assert client.get("/file", headers={"If-Modified-Since": last_modified}).status_code == 304
+    assert client.get("/file", headers={
+        "If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"
+    }).status_code == 200
+
+    # If-None-Match ha precedenza su If-Modified-Since
+    assert client.get("/file", headers={
+        "If-None-Match": '"x"', "If-Modified-Since": last_modified
+    }).status_code == 200
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+import utils.job_queue as job_queue_module
+from utils.job_queue import CONSUMER_GROUP, DEAD_LETTER_STREAM, QUEUES, JobQueue
+
+fakeredis = pytest.importorskip("fakeredis")
+
+STREAM = QUEUES["normal"]
+
+async def _pending(client) -> int:
+    return (await client.xpending(STREAM, CONSUMER_GROUP))["pending"]
+
+def test_reclaim_respects_visibility_timeout(monkeypatch):
+    async def scenario():
+        client = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(client)
+
+        await queue.enqueue({"job_id": "j1", "type": "separation"})
+        assert (await queue.read_stream("w1", STREAM)).job["job_id"] == "j1"
+
+        # Lease ancora valido: nessuna riassegnazione
+        monkeypatch.setattr(job_queue_module, "VISIBILITY_TIMEOUT", 60)
+        assert await queue.reclaim("w2") == (None, [])
+
+        # Worker morto: il job passa al consumer successivo con la consegna contata
+        monkeypatch.setattr(job_queue_module, "VISIBILITY_TIMEOUT", 0)
+        delivery, dead = await queue.reclaim("w2")
+        assert dead == []
+        assert delivery.job["job_id"] == "j1"
+        assert delivery.deliveries == 2
+
+        await queue.ack(delivery)
+        assert await _pending(client) == 0
+        assert await client.xlen(STREAM) == 0
+
+    asyncio.run(scenario())
+
+def test_exhausted_deliveries_go_to_dead_letter(monkeypatch):
+    async def scenario():
+        client = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(client)
+        monkeypatch.setattr(job_queue_module, "VISIBILITY_TIMEOUT", 0)
+        monkeypatch.setattr(job_queue_module, "MAX_DELIVERIES", 2)
+
+        await queue.enqueue({"job_id": "j1", "type": "separation"})
+        await queue.read_stream("w1", STREAM)
+
+        delivery, _ = await queue.reclaim("w2")
+        assert delivery.deliveries == 2
+
+        # Terza consegna oltre MAX_DELIVERIES: dead-letter invece di un altro tentativo
+        delivery, dead = await queue.reclaim("w3")
+        assert delivery is None
+        assert [entry.job["job_id"] for entry in dead] == ["j1"]
+        assert dead[0].deliveries == 3
+
+        entries = await client.xrange(DEAD_LETTER_STREAM)
+        assert len(entries) == 1
+        fields = entries[0][1]
+        assert fields[b"source"].decode() == STREAM
+        assert fields[b"deliveries"] == b"3"
+        assert b"Consegne esaurite" in fields[b"reason"]
+
+        # Confermato e rimosso dallo stream di origine
+        assert await _pending(client) == 0
+        assert await client.xlen(STREAM) == 0
+
+    asyncio.run(scenario())
+
+def test_reclaim_drops_pending_entries_deleted_from_stream(monkeypatch):
+    async def scenario():
+        client = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(client)
+        monkeypatch.setattr(job_queue_module, "VISIBILITY_TIMEOUT", 0)
+
+        await queue.enqueue({"job_id": "j1", "type": "separation"})
+        delivery = await queue.read_stream("w1", STREAM)
+        await client.xdel(STREAM, delivery.message_id)
+
+        assert await queue.reclaim("w2") == (None, [])
+        assert await _pending(client) == 0
+
+    asyncio.run(scenario())
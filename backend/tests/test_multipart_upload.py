@@ -0,0 +1,87 @@
+import asyncio
+import hashlib
+
+import pytest
+
+from utils.file_manager import FileManager, UploadTooLargeError
+from utils.multipart_upload import MultipartFileReceiver, MultipartUploadError
+
+fakeredis = pytest.importorskip("fakeredis")
+
+BOUNDARY = "test-boundary"
+CONTENT_TYPE = f"multipart/form-data; boundary={BOUNDARY}"
+
+def _body(files) -> bytes:
+    parts = [b"--" + BOUNDARY.encode() + b"\r\nContent-Disposition: form-data; name=\"note\"\r\n\r\nalbum\r\n"]
+    for filename, data in files:
+        parts.append(
+            b"--" + BOUNDARY.encode() + b"\r\n"
+            + f"Content-Disposition: form-data; name=\"files\"; filename=\"{filename}\"\r\n".encode()
+            + b"Content-Type: audio/wav\r\n\r\n" + data + b"\r\n"
+        )
+    parts.append(b"--" + BOUNDARY.encode() + b"--\r\n")
+    return b"".join(parts)
+
+class _Stream:
+    """Corpo della richiesta a blocchi, con conteggio dei blocchi letti"""
+
+    def __init__(self, body: bytes, chunk_size: int = 7):
+        self.chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+        self.read = 0
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+def _receiver(file_manager: FileManager, max_files: int = 2, max_size: int = 1024):
+    async def open_file(filename):
+        session_id = f"s{filename}"
+        return await file_manager.open_upload(session_id, filename, max_size)
+
+    return MultipartFileReceiver(CONTENT_TYPE, open_file, max_files)
+
+def test_files_written_as_they_arrive(tmp_path):
+    async def scenario():
+        file_manager = FileManager(str(tmp_path), fakeredis.aioredis.FakeRedis())
+        files = [("a.wav", b"RIFF" + bytes(range(200))), ("b.mp3", b"ID3" * 50)]
+
+        uploads = await _receiver(file_manager).receive(_Stream(_body(files)))
+
+        assert [upload["filename"] for upload in uploads] == ["a.wav", "b.mp3"]
+        for upload, (_, data) in zip(uploads, files):
+            assert upload["size"] == len(data)
+            assert upload["content_hash"] == hashlib.sha256(data).hexdigest()
+            assert open(upload["file_path"], "rb").read() == data
+
+    asyncio.run(scenario())
+
+def test_oversized_file_stops_reading_the_body(tmp_path):
+    async def scenario():
+        file_manager = FileManager(str(tmp_path), fakeredis.aioredis.FakeRedis())
+        stream = _Stream(_body([("a.wav", b"x" * 10_000)]))
+
+        with pytest.raises(UploadTooLargeError):
+            await _receiver(file_manager, max_size=100).receive(stream)
+
+        # Ricezione interrotta al primo blocco oltre il limite, file parziale rimosso
+        assert stream.read < len(stream.chunks) / 10
+        assert not (file_manager.session_dir("sa.wav") / "original.wav").exists()
+
+    asyncio.run(scenario())
+
+def test_invalid_requests(tmp_path):
+    async def scenario():
+        file_manager = FileManager(str(tmp_path), fakeredis.aioredis.FakeRedis())
+
+        with pytest.raises(MultipartUploadError):
+            MultipartFileReceiver("multipart/form-data", None, 1)
+
+        body = _body([("a.wav", b"x" * 100), ("b.wav", b"y" * 100)])
+        with pytest.raises(MultipartUploadError):
+            await _receiver(file_manager, max_files=1).receive(_Stream(body))
+
+        with pytest.raises(MultipartUploadError):
+            await _receiver(file_manager).receive(_Stream(body[:150]))
+
+    asyncio.run(scenario())
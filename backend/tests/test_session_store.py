@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+import pytest
+
+from utils.session_store import session_key, update_session
+
+fakeredis = pytest.importorskip("fakeredis")
+
+def test_concurrent_updates_are_not_lost():
+    async def scenario():
+        client = fakeredis.aioredis.FakeRedis()
+        await client.set(session_key("s1"), json.dumps({"session_id": "s1", "status": "queued"}))
+
+        # Scritture interlacciate: con GET + SETEX sopravviverebbe solo l'ultima
+        await asyncio.gather(*(
+            update_session(client, "s1", {f"field_{index}": index}) for index in range(20)
+        ))
+
+        session_data = json.loads(await client.get(session_key("s1")))
+        assert all(session_data[f"field_{index}"] == index for index in range(20))
+
+    asyncio.run(scenario())
+
+def test_api_update_keeps_worker_status():
+    async def scenario():
+        client = fakeredis.aioredis.FakeRedis()
+        await client.set(session_key("s1"), json.dumps({"session_id": "s1", "status": "queued"}))
+
+        # Il worker conclude prima che l'API registri il job_id
+        await update_session(client, "s1", {"status": "completed"}, publish=True)
+        session_data = await update_session(client, "s1", {"job_id": "j1"})
+
+        assert session_data["status"] == "completed"
+        assert session_data["job_id"] == "j1"
+
+    asyncio.run(scenario())
+
+def test_missing_and_skipped_sessions_are_not_written():
+    async def scenario():
+        client = fakeredis.aioredis.FakeRedis()
+
+        assert await update_session(client, "missing", {"status": "queued"}) is None
+        assert not await client.exists(session_key("missing"))
+
+        created = await update_session(client, "new", {"status": "processing"}, create=True)
+        assert created == {"session_id": "new", "status": "processing"}
+
+        await update_session(client, "new", {"status": "completed"})
+        assert await update_session(client, "new", {"status": "killed"},
+                                    skip_statuses=("completed",)) is None
+        assert json.loads(await client.get(session_key("new")))["status"] == "completed"
+
+    asyncio.run(scenario())
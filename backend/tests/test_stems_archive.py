@@ -0,0 +1,70 @@
+import asyncio
+import io
+import zipfile
+
+import pytest
+
+from utils.file_manager import FileManager
+
+fakeredis = pytest.importorskip("fakeredis")
+
+def _stems(file_manager: FileManager, session_id: str):
+    stems_dir = file_manager.session_dir(session_id) / "stems"
+    stems_dir.mkdir()
+    paths = {}
+    for name in ("vocals", "drums"):
+        path = stems_dir / f"{name}.wav"
+        path.write_bytes(name.encode() * 100_000)
+        paths[name] = str(path)
+    return paths
+
+def test_first_entry_streams_while_later_stems_encode(tmp_path):
+    async def scenario():
+        file_manager = FileManager(str(tmp_path), fakeredis.aioredis.FakeRedis())
+        stems = _stems(file_manager, "s1")
+        drums_released = asyncio.Event()
+
+        async def prepare(path):
+            # Codifica finta: drums pronta solo dopo il primo blocco inviato
+            if "drums" in path:
+                await drums_released.wait()
+            encoded = path.replace(".wav", ".mp3")
+            with open(path, "rb") as src, open(encoded, "wb") as dst:
+                dst.write(src.read())
+            return encoded
+
+        archive = file_manager.stream_stems_archive("s1", stems, "stems.zip", prepare=prepare)
+        chunks = [await archive.__anext__()]
+        drums_released.set()
+        chunks += [chunk async for chunk in archive]
+
+        with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as zipf:
+            assert zipf.namelist() == ["vocals.mp3", "drums.mp3"]
+        assert file_manager.get_cached_archive("s1", "stems.zip")
+
+    asyncio.run(scenario())
+
+def test_disconnect_cancels_pending_encodes(tmp_path):
+    async def scenario():
+        file_manager = FileManager(str(tmp_path), fakeredis.aioredis.FakeRedis())
+        stems = _stems(file_manager, "s1")
+        cancelled = []
+
+        async def prepare(path):
+            if "drums" in path:
+                try:
+                    await asyncio.Event().wait()
+                except asyncio.CancelledError:
+                    cancelled.append(path)
+                    raise
+            return path
+
+        archive = file_manager.stream_stems_archive("s1", stems, "stems.zip", prepare=prepare)
+        await archive.__anext__()
+        await archive.aclose()
+
+        assert cancelled == [stems["drums"]]
+        assert not file_manager.get_cached_archive("s1", "stems.zip")
+        assert not list(file_manager.session_dir("s1").glob(".stems.zip.*"))
+
+    asyncio.run(scenario())
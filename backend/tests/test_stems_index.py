@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from utils.file_manager import FileManager
+from utils.stems import ALL_STEMS, BASE_STEMS
+
+fakeredis = pytest.importorskip("fakeredis")
+
+CONTENT_HASH = "ab" * 32
+MODEL = "htdemucs"
+
+async def _separate(file_manager: FileManager, session_id: str, names):
+    """Stems scritti e pubblicati come da _get_or_separate"""
+
+    stems_dir = file_manager.session_dir(session_id) / "stems"
+    stems_dir.mkdir(exist_ok=True)
+
+    paths = {}
+    for name in names:
+        path = stems_dir / f"{name}.wav"
+        path.write_bytes(f"{session_id}:{name}".encode())
+        paths[name] = str(path)
+
+    return await file_manager.publish_files(session_id, paths, "stems/")
+
+def test_mashup_stems_not_reused_for_full_separation(tmp_path):
+    async def scenario():
+        file_manager = FileManager(str(tmp_path), fakeredis.aioredis.FakeRedis())
+
+        # Mashup: separazione con required=["vocals"] registra solo gli stems base
+        mashup_stems = await _separate(file_manager, "mashup_track1", BASE_STEMS)
+        await file_manager.register_stems(CONTENT_HASH, MODEL, mashup_stems)
+
+        assert await file_manager.find_cached_stems(CONTENT_HASH, MODEL, ["vocals"]) == {
+            "vocals": mashup_stems["vocals"]
+        }
+        assert await file_manager.find_cached_stems(CONTENT_HASH, MODEL) is None
+
+        # La separazione completa dello stesso audio registra tutte le tracce
+        full_stems = await _separate(file_manager, "full", ALL_STEMS)
+        await file_manager.register_stems(CONTENT_HASH, MODEL, full_stems)
+
+        cached = await file_manager.find_cached_stems(CONTENT_HASH, MODEL)
+        assert cached is not None
+        assert sorted(cached) == sorted(ALL_STEMS)
+
+    asyncio.run(scenario())
+
+def test_partial_entry_after_blob_removal(tmp_path):
+    async def scenario():
+        file_manager = FileManager(str(tmp_path), fakeredis.aioredis.FakeRedis())
+
+        stems = await _separate(file_manager, "full", ALL_STEMS)
+        await file_manager.register_stems(CONTENT_HASH, MODEL, stems)
+
+        # Blob di uno stem derivato raccolto dal GC
+        file_manager.blobs._delete(file_manager.blobs.key_for(stems["piano"]))
+
+        assert await file_manager.find_cached_stems(CONTENT_HASH, MODEL) is None
+        assert await file_manager.find_cached_stems(CONTENT_HASH, MODEL, ["vocals"]) is not None
+
+    asyncio.run(scenario())
+
+def test_index_shared_between_nodes(tmp_path):
+    async def scenario():
+        redis_client = fakeredis.aioredis.FakeRedis()
+        worker_node = FileManager(str(tmp_path / "worker"), redis_client)
+        other_node = FileManager(str(tmp_path / "other"), redis_client)
+
+        stems = await _separate(worker_node, "full", ALL_STEMS)
+        await worker_node.register_stems(CONTENT_HASH, MODEL, stems)
+
+        # Stesso Redis, disco diverso: l'indice è visibile anche all'altro nodo
+        assert await other_node.find_cached_stems(CONTENT_HASH, MODEL) == stems
+
+    asyncio.run(scenario())
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Durate recenti dei job (scritte dai worker, finestra mobile)
+JOB_DURATIONS_KEY = "stats:separation:durations"
+JOB_DURATIONS_WINDOW = 100
+
+# Job in coda o in elaborazione per client
+INFLIGHT_KEY_PREFIX = "admission:inflight:"
+INFLIGHT_TTL = 86400
+
+# Attesa massima accettata in coda (secondi) e profondità massima assoluta
+MAX_QUEUE_WAIT = float(os.getenv("ADMISSION_MAX_QUEUE_WAIT", "900"))
+MAX_QUEUE_DEPTH = int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH", "200"))
+
+# Durata stimata di un job finché i worker non hanno misure
+DEFAULT_JOB_SECONDS = float(os.getenv("ADMISSION_DEFAULT_JOB_SECONDS", "120"))
+
+# Job contemporanei per client: default e override per API key/client (JSON)
+DEFAULT_CLIENT_LIMIT = int(os.getenv("ADMISSION_DEFAULT_CLIENT_LIMIT", "10"))
+CLIENT_LIMITS: Dict[str, int] = json.loads(os.getenv("ADMISSION_CLIENT_LIMITS", "{}"))
+
+# Cache della capacità misurata (evita SCAN dei worker a ogni richiesta)
+_CAPACITY_TTL = 5.0
+
+def inflight_key(client_id: str) -> str:
+    return f"{INFLIGHT_KEY_PREFIX}{client_id}"
+
+def resolve_client(api_key: Optional[str], remote_addr: Optional[str]) -> Tuple[str, int]:
+    """Identificativo del client e relativo limite di job contemporanei
+
+    Con API key il client è la chiave (salvata solo come hash in Redis),
+    altrimenti l'indirizzo di provenienza.
+    """
+
+    if api_key:
+        client_id = f"key:{hashlib.sha256(api_key.encode()).hexdigest()[:16]}"
+        return client_id, int(CLIENT_LIMITS.get(api_key, DEFAULT_CLIENT_LIMIT))
+
+    return f"ip:{remote_addr or 'unknown'}", DEFAULT_CLIENT_LIMIT
+
+class AdmissionRejected(Exception):
+    """Richiesta oltre capacità: da tradurre in 429 con Retry-After"""
+
+    def __init__(self, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Ammissione dei job in base a profondità coda e throughput misurato dei worker"""
+
+    def __init__(self, redis_client, job_queue):
+        self.client = redis_client
+        self.job_queue = job_queue
+        self._capacity: Optional[Dict] = None
+        self._capacity_at = 0.0
+
+    async def capacity(self) -> Dict:
+        """Worker attivi e durata media dei job recenti"""
+
+        now = time.monotonic()
+        if self._capacity is not None and now - self._capacity_at < _CAPACITY_TTL:
+            return self._capacity
+
+        keys = [key async for key in self.client.scan_iter(match="worker:*", count=100)]
+        workers = len(keys)
+
+        # Job contemporanei per worker (pipeline interna, default 1)
+        slots = 0
+        for info in (await self.client.mget(keys) if keys else []):
+            try:
+                slots += max(1, int(json.loads(info).get("pipeline_depth", 1)))
+            except (TypeError, ValueError, AttributeError):
+                slots += 1
+
+        durations = await self.client.lrange(JOB_DURATIONS_KEY, 0, JOB_DURATIONS_WINDOW - 1)
+        samples = [float(value) for value in durations]
+        job_seconds = sum(samples) / len(samples) if samples else DEFAULT_JOB_SECONDS
+
+        self._capacity = {
+            "workers": workers,
+            "slots": slots,
+            "job_seconds": job_seconds,
+            # Le durate misurate includono l'attesa nella pipeline del worker
+            "jobs_per_second": max(slots, 1) / job_seconds
+        }
+        self._capacity_at = now
+
+        return self._capacity
+
+    async def admit(self, client_id: str, limit: int, jobs: int = 1) -> Dict:
+        """Verifica capacità e limiti del client; ritorna la stima di attesa
+
+        Solleva AdmissionRejected se la coda supera l'attesa massima o se il
+        client ha già troppi job in corso. In caso di ammissione il contatore
+        del client è incrementato (decrementato dal worker a fine job).
+        """
+
+        depth = sum((await self.job_queue.depth()).values())
+        capacity = await self.capacity()
+        rate = capacity["jobs_per_second"]
+
+        queue_wait = depth / rate
+        if depth + jobs > MAX_QUEUE_DEPTH or queue_wait > MAX_QUEUE_WAIT:
+            # Tempo perché la coda rientri sotto i limiti
+            allowed = min(MAX_QUEUE_DEPTH - jobs, MAX_QUEUE_WAIT * rate)
+            retry_after = max(1, math.ceil((depth - max(allowed, 0)) / rate))
+            raise AdmissionRejected("Coda di elaborazione piena, riprovare più tardi", retry_after)
+
+        key = inflight_key(client_id)
+
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.incrby(key, jobs)
+            pipe.expire(key, INFLIGHT_TTL)
+            inflight, _ = await pipe.execute()
+
+        if inflight > limit:
+            await self.client.decrby(key, jobs)
+            raise AdmissionRejected(
+                f"Limite di job contemporanei raggiunto ({limit})",
+                max(1, math.ceil(capacity["job_seconds"]))
+            )
+
+        # Attesa in coda più elaborazione dei job richiesti
+        estimated_time = queue_wait + math.ceil(jobs / max(capacity["slots"], 1)) * capacity["job_seconds"]
+
+        return {
+            "queue_depth": depth,
+            "workers": capacity["workers"],
+            "estimated_time": round(estimated_time, 1)
+        }
+
+    async def release(self, client_id: str, jobs: int = 1):
+        """Restituisce i posti del client (job non accodato)"""
+
+        await self.client.decrby(inflight_key(client_id), jobs)
@@ -1,7 +1,4 @@
-import librosa
 import numpy as np
-import torch
-import torchaudio
 from typing import Dict, List, Tuple, Optional
 import logging
 from pathlib import Path
@@ -14,12 +11,18 @@ class AudioUtils:
     """Utility per analisi e processamento audio"""
     
     @staticmethod
-    async def analyze_audio(file_path: str) -> Dict[str, any]:
-        """Analisi completa del file audio"""
+    async def analyze_audio(file_path: str,
+                            executor: Optional[ThreadPoolExecutor] = None) -> Dict[str, any]:
+        """Analisi completa del file audio (sul pool indicato o su un pool dedicato)"""
         
         try:
             # Esegui analisi in thread separato per non bloccare
             loop = asyncio.get_event_loop()
+            if executor is not None:
+                return await loop.run_in_executor(
+                    executor, AudioUtils._analyze_audio_sync, file_path
+                )
+            
             with ThreadPoolExecutor() as executor:
                 analysis = await loop.run_in_executor(
                     executor,
@@ -33,10 +36,43 @@ class AudioUtils:
             logger.error(f"Errore analisi audio {file_path}: {str(e)}")
             raise
     
+    @staticmethod
+    async def probe_audio(file_path: str) -> Dict[str, any]:
+        """Informazioni base dall'header del file (senza decodifica né librerie pesanti)"""
+        
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, AudioUtils._probe_audio_sync, file_path)
+    
+    @staticmethod
+    def _probe_audio_sync(file_path: str) -> Dict[str, any]:
+        """Lettura sincrona dell'header con soundfile"""
+        
+        import soundfile as sf
+        
+        info = {
+            "file_size": Path(file_path).stat().st_size,
+            "format": Path(file_path).suffix.lower()
+        }
+        
+        try:
+            header = sf.info(file_path)
+            info.update({
+                "duration": float(header.duration),
+                "sample_rate": int(header.samplerate),
+                "channels": int(header.channels)
+            })
+        except Exception as e:
+            # Formati non letti da libsndfile (es. m4a): analisi completa nel worker
+            logger.debug(f"Header non leggibile {file_path}: {str(e)}")
+        
+        return info
+    
     @staticmethod
     def _analyze_audio_sync(file_path: str) -> Dict[str, any]:
         """Analisi sincrona del file audio"""
         
+        import librosa
+        
         # Carica audio con librosa per analisi
         y, sr = librosa.load(file_path, sr=None)
         
@@ -46,6 +82,7 @@ class AudioUtils:
         
         # Carica con torchaudio per info canali originali
         try:
+            import torchaudio
             waveform, original_sr = torchaudio.load(file_path)
             original_channels = waveform.shape[0]
         except:
@@ -82,6 +119,8 @@ class AudioUtils:
     def _extract_audio_features(y: np.ndarray, sr: int) -> Dict[str, float]:
         """Estrazione caratteristiche audio"""
         
+        import librosa
+        
         try:
             # MFCC (Mel-frequency cepstral coefficients)
             mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
@@ -167,6 +206,8 @@ class AudioUtils:
     def _analyze_key(y: np.ndarray, sr: int) -> Dict[str, any]:
         """Analisi tonalità e key"""
         
+        import librosa
+        
         try:
             # Chroma features per analisi tonale
             chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
@@ -242,6 +283,8 @@ class AudioUtils:
     def _align_tempo_sync(audio1_path: str, audio2_path: str, target_tempo: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray, float]:
         """Allineamento sincrono del tempo"""
         
+        import librosa
+        
         # Carica audio
         y1, sr1 = librosa.load(audio1_path)
         y2, sr2 = librosa.load(audio2_path)
@@ -287,6 +330,8 @@ class AudioUtils:
     def _detect_beats_sync(audio_path: str) -> Dict[str, any]:
         """Rilevamento sincrono dei beat"""
         
+        import librosa
+        
         # Carica audio
         y, sr = librosa.load(audio_path)
         
@@ -373,6 +418,8 @@ class AudioUtils:
     def calculate_similarity(audio1: np.ndarray, audio2: np.ndarray, sr: int) -> float:
         """Calcola similarità tra due tracce audio"""
         
+        import librosa
+        
         try:
             # Assicura stessa lunghezza
             min_len = min(len(audio1), len(audio2))
@@ -0,0 +1,495 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from utils.metrics import record_bytes, record_cache
+
+# Backend S3 opzionale (BLOB_BACKEND=s3): boto3 serve solo in quel caso
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+    ClientError = None
+
+logger = logging.getLogger(__name__)
+
+# Backend dei blob: "local" (directory, anche su volume condiviso) o "s3"
+# (qualsiasi servizio compatibile: endpoint_url per MinIO o altri sostituti locali)
+BLOB_BACKEND = os.getenv("BLOB_BACKEND", "local")
+BLOB_ROOT = os.getenv("BLOB_ROOT")
+BLOB_S3_BUCKET = os.getenv("BLOB_S3_BUCKET", "musicai-blobs")
+BLOB_S3_PREFIX = os.getenv("BLOB_S3_PREFIX", "blobs/")
+BLOB_S3_ENDPOINT_URL = os.getenv("BLOB_S3_ENDPOINT_URL")
+
+# Cache locale read-through di ogni nodo; limite in MB (0 = nessun limite)
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR")
+BLOB_CACHE_MAX_MB = float(os.getenv("BLOB_CACHE_MAX_MB", "0"))
+
+# Blob senza riferimenti eliminati solo dopo questo periodo (riuso ravvicinato)
+BLOB_GC_GRACE = float(os.getenv("BLOB_GC_GRACE", "3600"))
+
+# Contatori di riferimento e manifest delle sessioni (condivisi tra API e worker)
+REFS_KEY = "blobs:refs"
+ORPHANS_KEY = "blobs:orphans"
+MANIFEST_PREFIX = "blobs:manifest:"
+
+def manifest_key(session_id: str) -> str:
+    return f"{MANIFEST_PREFIX}{session_id}"
+
+def blob_key(digest: str, suffix: str = "") -> str:
+    """Chiave del blob: hash SHA-256 del contenuto + estensione (per i decoder)"""
+    return f"{digest}{suffix.lower()}"
+
+def _hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _tmp_path(path: Path) -> Path:
+    return path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+
+def _decode(value) -> Optional[str]:
+    return value.decode() if isinstance(value, bytes) else value
+
+class LocalBlobBackend:
+    """Blob su filesystem: {root}/{prefisso hash}/{chiave}"""
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def exists(self, key: str) -> bool:
+        return self.path(key).exists()
+
+    def put(self, key: str, source: Path):
+        target = self.path(key)
+        # Cache e backend coincidono (default su un solo host): già archiviato
+        if target == source or target.exists():
+            return
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = _tmp_path(target)
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+
+    def get(self, key: str, target: Path):
+        source = self.path(key)
+        if not source.exists():
+            raise FileNotFoundError(f"Blob non trovato: {key}")
+
+        tmp_path = _tmp_path(target)
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+
+    def delete(self, key: str):
+        self.path(key).unlink(missing_ok=True)
+
+class S3BlobBackend:
+    """Blob su storage compatibile S3 (credenziali dalle variabili AWS_* standard)"""
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None):
+        if boto3 is None:
+            raise RuntimeError("boto3 non installato: necessario per BLOB_BACKEND=s3")
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url or None)
+        self._ensure_bucket()
+
+    def _ensure_bucket(self):
+        """Crea il bucket se manca (es. MinIO appena avviato)"""
+
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+            return
+        except ClientError as e:
+            if not self._not_found(e):
+                raise
+
+        region = self.client.meta.region_name
+        options = {}
+        if region and region != "us-east-1":
+            options["CreateBucketConfiguration"] = {"LocationConstraint": region}
+
+        try:
+            self.client.create_bucket(Bucket=self.bucket, **options)
+            logger.info(f"Bucket blob creato: {self.bucket}")
+        except ClientError as e:
+            # Creato nel frattempo da un altro processo (API o worker)
+            if e.response.get("Error", {}).get("Code") not in ("BucketAlreadyOwnedByYou", "BucketAlreadyExists"):
+                raise
+
+    def _object(self, key: str) -> str:
+        return f"{self.prefix}{key[:2]}/{key}"
+
+    @staticmethod
+    def _not_found(error) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object(key))
+            return True
+        except ClientError as e:
+            if self._not_found(e):
+                return False
+            raise
+
+    def put(self, key: str, source: Path):
+        self.client.upload_file(str(source), self.bucket, self._object(key))
+
+    def get(self, key: str, target: Path):
+        tmp_path = _tmp_path(target)
+        try:
+            self.client.download_file(self.bucket, self._object(key), str(tmp_path))
+        except ClientError as e:
+            tmp_path.unlink(missing_ok=True)
+            if self._not_found(e):
+                raise FileNotFoundError(f"Blob non trovato: {key}")
+            raise
+        os.replace(tmp_path, target)
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object(key))
+
+class BlobStore:
+    """Archivio content-addressed dei file delle sessioni (upload, stems, mix)
+
+    Ogni file è salvato una sola volta per contenuto; le sessioni lo
+    referenziano tramite un manifest (nome -> chiave) con contatore di
+    riferimenti in Redis. I blob senza riferimenti sono eliminati dopo
+    BLOB_GC_GRACE. I percorsi restituiti sono nella cache locale del nodo
+    ({cache}/{prefisso}/{chiave}) e validi su ogni nodo: localize() li
+    scarica dal backend alla prima lettura.
+    """
+
+    def __init__(self, backend, cache_dir: str, redis_client=None, cache_max_bytes: float = 0,
+                 evictable: bool = True):
+        self.backend = backend
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_max_bytes = cache_max_bytes
+
+        # False se la cache è il backend locale stesso (contiene gli originali)
+        self.evictable = evictable
+
+        # Client redis.asyncio per riferimenti e manifest (senza: nessuna raccolta)
+        self.client = redis_client
+
+        # Download in corso per chiave (evita doppi trasferimenti dello stesso blob)
+        self._fetches: Dict[str, asyncio.Lock] = {}
+
+    def cache_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def key_for(self, path: str) -> Optional[str]:
+        """Chiave del blob di un percorso della cache, None per altri file"""
+
+        path = Path(path)
+        if path.parent.parent != self.cache_dir or path.parent.name != path.name[:2]:
+            return None
+        return path.name
+
+    def _lock(self, key: str):
+        # Serializza archiviazione e raccolta dello stesso blob tra i processi
+        if self.client is None:
+            return contextlib.nullcontext()
+        return self.client.lock(f"blobs:lock:{key}", timeout=300, blocking_timeout=60)
+
+    async def put(self, session_id: str, name: str, source: str,
+                  digest: Optional[str] = None, companions: Tuple[str, ...] = ()) -> str:
+        """Archivia un file della sessione (spostato in cache) e ritorna il percorso del blob
+
+        Le estensioni in companions sono file derivati accanto al sorgente
+        (es. ".peaks"), spostati in cache con il blob ma non archiviati.
+        """
+
+        source = Path(source)
+        loop = asyncio.get_event_loop()
+
+        if digest is None:
+            digest = await loop.run_in_executor(None, _hash_file, source)
+
+        key = blob_key(digest, source.suffix)
+
+        async with self._lock(key):
+            await self._add_ref(session_id, name, key)
+            await loop.run_in_executor(None, self._store, key, source, companions)
+
+        return str(self.cache_path(key))
+
+    def _store(self, key: str, source: Path, companions: Tuple[str, ...]):
+        cached = self.cache_path(key)
+        duplicate = cached.exists()
+        record_cache("blob_dedup", duplicate)
+
+        if source == cached:
+            pass
+        elif duplicate:
+            source.unlink(missing_ok=True)
+        else:
+            cached.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(source), str(cached))
+
+        for suffix in companions:
+            companion = source.with_suffix(suffix)
+            if companion.exists():
+                os.replace(companion, cached.with_suffix(suffix))
+
+        if not self.backend.exists(key):
+            self.backend.put(key, cached)
+            record_bytes("write", "blob_upload", cached.stat().st_size)
+
+    async def retain(self, session_id: str, name: str, path: str):
+        """Aggiunge al manifest della sessione un blob già archiviato"""
+
+        key = self.key_for(path)
+        if key is None:
+            return
+
+        async with self._lock(key):
+            await self._add_ref(session_id, name, key)
+
+    async def _add_ref(self, session_id: str, name: str, key: str):
+        if self.client is None:
+            return
+
+        manifest = manifest_key(session_id)
+        previous = _decode(await self.client.hget(manifest, name))
+        if previous == key:
+            return
+
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hset(manifest, name, key)
+            pipe.hincrby(REFS_KEY, key, 1)
+            pipe.zrem(ORPHANS_KEY, key)
+            if previous:
+                pipe.hincrby(REFS_KEY, previous, -1)
+            results = await pipe.execute()
+
+        if previous and results[-1] <= 0:
+            await self.client.zadd(ORPHANS_KEY, {previous: time.time()})
+
+    async def release_session(self, session_id: str) -> int:
+        """Rilascia i riferimenti della sessione; ritorna i blob rimasti senza riferimenti"""
+
+        if self.client is None:
+            return 0
+
+        manifest = manifest_key(session_id)
+        entries = await self.client.hgetall(manifest)
+        if not entries:
+            return 0
+
+        keys = [_decode(key) for key in entries.values()]
+
+        async with self.client.pipeline(transaction=True) as pipe:
+            for key in keys:
+                pipe.hincrby(REFS_KEY, key, -1)
+            pipe.delete(manifest)
+            counts = (await pipe.execute())[:-1]
+
+        orphans = {key: time.time() for key, count in zip(keys, counts) if count <= 0}
+        if orphans:
+            await self.client.zadd(ORPHANS_KEY, orphans)
+
+        return len(orphans)
+
+    async def release(self, session_id: str, names: List[str]) -> int:
+        """Rilascia alcuni file della sessione (es. intermedi non più necessari)"""
+
+        if self.client is None or not names:
+            return 0
+
+        manifest = manifest_key(session_id)
+        keys = [_decode(key) for key in await self.client.hmget(manifest, names)]
+        entries = [(name, key) for name, key in zip(names, keys) if key]
+        if not entries:
+            return 0
+
+        async with self.client.pipeline(transaction=True) as pipe:
+            for name, key in entries:
+                pipe.hdel(manifest, name)
+                pipe.hincrby(REFS_KEY, key, -1)
+            counts = (await pipe.execute())[1::2]
+
+        orphans = {key: time.time() for (_, key), count in zip(entries, counts) if count <= 0}
+        if orphans:
+            await self.client.zadd(ORPHANS_KEY, orphans)
+
+        return len(orphans)
+
+    async def manifest(self, session_id: str) -> Dict[str, str]:
+        """Manifest della sessione: nome -> percorso del blob"""
+
+        if self.client is None:
+            return {}
+
+        entries = await self.client.hgetall(manifest_key(session_id))
+        return {
+            _decode(name): str(self.cache_path(_decode(key))) for name, key in entries.items()
+        }
+
+    async def collect_garbage(self, grace: float = BLOB_GC_GRACE) -> int:
+        """Elimina i blob rimasti senza riferimenti per più di grace secondi"""
+
+        if self.client is None:
+            return 0
+
+        candidates = await self.client.zrangebyscore(ORPHANS_KEY, "-inf", time.time() - grace)
+        loop = asyncio.get_event_loop()
+        deleted = 0
+
+        for key in map(_decode, candidates):
+            async with self._lock(key):
+                refs = await self.client.hget(REFS_KEY, key)
+                if refs is not None and int(refs) > 0:
+                    # Riutilizzato nel frattempo
+                    await self.client.zrem(ORPHANS_KEY, key)
+                    continue
+
+                await loop.run_in_executor(None, self._delete, key)
+
+                async with self.client.pipeline(transaction=True) as pipe:
+                    pipe.hdel(REFS_KEY, key)
+                    pipe.zrem(ORPHANS_KEY, key)
+                    await pipe.execute()
+
+                deleted += 1
+
+        if deleted:
+            logger.info(f"Blob senza riferimenti eliminati: {deleted}")
+
+        return deleted
+
+    def _delete(self, key: str):
+        self.backend.delete(key)
+
+        cached = self.cache_path(key)
+        cached.unlink(missing_ok=True)
+
+        # File derivati accanto al blob: piramide dei picchi (utils.peaks) e
+        # versioni esportate (utils.exporter.rendition_path)
+        cached.with_suffix(".peaks").unlink(missing_ok=True)
+        for rendition in (cached.parent / "renditions").glob(f"{cached.stem}_*"):
+            rendition.unlink(missing_ok=True)
+
+    async def exists(self, path: str) -> bool:
+        """File disponibile localmente o nel backend"""
+
+        if os.path.exists(path):
+            return True
+
+        key = self.key_for(path)
+        if key is None:
+            return False
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.backend.exists, key)
+
+    async def localize(self, path: str) -> str:
+        """Percorso locale del file: i blob mancanti sono scaricati nella cache"""
+
+        key = self.key_for(path)
+        if key is None:
+            return path
+
+        cached = self.cache_path(key)
+        loop = asyncio.get_event_loop()
+
+        if cached.exists():
+            record_cache("blob", True)
+            if self.cache_max_bytes > 0:
+                # Ordine di utilizzo per l'eviction della cache
+                await loop.run_in_executor(None, os.utime, cached)
+            return str(cached)
+
+        lock = self._fetches.setdefault(key, asyncio.Lock())
+        async with lock:
+            if not cached.exists():
+                record_cache("blob", False)
+                cached.parent.mkdir(parents=True, exist_ok=True)
+                await loop.run_in_executor(None, self.backend.get, key, cached)
+                record_bytes("read", "blob_fetch", cached.stat().st_size)
+        self._fetches.pop(key, None)
+
+        return str(cached)
+
+    async def trim_cache(self) -> int:
+        """Riporta la cache locale entro il limite, dai file usati meno di recente"""
+
+        if self.cache_max_bytes <= 0 or not self.evictable:
+            return 0
+
+        loop = asyncio.get_event_loop()
+        removed, _ = await loop.run_in_executor(None, self._trim_cache_sync, self.cache_max_bytes, None)
+        return removed
+
+    async def evict(self, bytes_to_free: int) -> int:
+        """Libera spazio dalla cache locale (pressione sul disco); ritorna i byte liberati"""
+
+        if not self.evictable or bytes_to_free <= 0:
+            return 0
+
+        loop = asyncio.get_event_loop()
+        _, freed = await loop.run_in_executor(None, self._trim_cache_sync, None, bytes_to_free)
+        return freed
+
+    def _trim_cache_sync(self, limit: Optional[float], bytes_to_free: Optional[int]) -> Tuple[int, int]:
+        files = []
+        total = 0
+
+        for path in self.cache_dir.rglob('*'):
+            if path.is_file():
+                stat = path.stat()
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        if limit is None:
+            limit = total - bytes_to_free
+
+        removed = 0
+        freed = 0
+        # Blob e derivati (picchi, versioni esportate) si rigenerano dal backend
+        for _, size, path in sorted(files):
+            if total - freed <= limit:
+                break
+            path.unlink(missing_ok=True)
+            freed += size
+            removed += 1
+
+        if removed:
+            logger.info(f"Cache blob ridotta: {removed} file rimossi ({freed // (1024 * 1024)} MB)")
+
+        return removed, freed
+
+def create_blob_store(temp_dir: Path, redis_client=None) -> BlobStore:
+    """Blob store configurato da ambiente (default: directory locale in temp_dir)"""
+
+    if BLOB_BACKEND == "s3":
+        backend = S3BlobBackend(BLOB_S3_BUCKET, BLOB_S3_PREFIX, BLOB_S3_ENDPOINT_URL)
+        cache_dir = Path(BLOB_CACHE_DIR or temp_dir / ".blob_cache")
+    elif BLOB_BACKEND == "local":
+        backend = LocalBlobBackend(BLOB_ROOT or str(temp_dir / ".blobs"))
+        cache_dir = Path(BLOB_CACHE_DIR) if BLOB_CACHE_DIR else backend.root
+    else:
+        raise ValueError(f"BLOB_BACKEND non supportato: {BLOB_BACKEND}")
+
+    # Cache coincidente con il backend locale: sono gli originali, mai rimossi
+    shared = isinstance(backend, LocalBlobBackend) and cache_dir.resolve() == backend.root.resolve()
+    cache_max_bytes = 0 if shared else BLOB_CACHE_MAX_MB * 1024 * 1024
+
+    return BlobStore(backend, str(cache_dir), redis_client, cache_max_bytes, evictable=not shared)
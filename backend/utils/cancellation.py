@@ -0,0 +1,43 @@
+import threading
+import time
+from typing import Optional
+
+class JobInterrupted(Exception):
+    """Job fermato a un confine di fase o di segmento (lavoro fatto già salvato)"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Job interrotto: {reason}")
+        self.reason = reason
+
+class CancelToken:
+    """Richiesta di interruzione di un job, controllata ai confini sicuri
+
+    Thread-safe: può essere impostata da signal handler o watchdog e letta
+    dai thread degli executor. La pipeline vi segnala anche l'avanzamento,
+    usato dal watchdog per riconoscere i job bloccati.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason: Optional[str] = None
+        self.last_progress = time.monotonic()
+
+    def cancel(self, reason: str):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise JobInterrupted(self.reason or "cancelled")
+
+    def mark_progress(self):
+        self.last_progress = time.monotonic()
+
+    @property
+    def idle_seconds(self) -> float:
+        return time.monotonic() - self.last_progress
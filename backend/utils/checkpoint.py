@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Checkpoint delle sessioni in Redis (condivisi tra i worker di tutti i nodi)
+CHECKPOINT_PREFIX = "checkpoints:"
+
+# Durata dei checkpoint, rinnovata a ogni fase completata (come i file di sessione)
+CHECKPOINT_TTL = int(float(os.getenv("SESSION_FILES_TTL", "86400")))
+
+def checkpoint_key(session_id: str) -> str:
+    return f"{CHECKPOINT_PREFIX}{session_id}"
+
+class CheckpointStore:
+    """Checkpoint persistenti delle fasi di elaborazione per sessione
+
+    Un hash Redis per sessione (fase -> record JSON): un job ripreso da un
+    worker su un altro nodo salta le fasi già completate. Gli artefatti sono
+    blob della sessione, verificati e scaricati dalla blob store al
+    caricamento. Senza client Redis i checkpoint sono disattivati.
+    """
+
+    def __init__(self, redis_client=None, blobs=None):
+        self.client = redis_client
+        self.blobs = blobs
+
+    @staticmethod
+    def fingerprint(inputs: Dict) -> str:
+        """Hash deterministico degli input di una fase"""
+
+        payload = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def load_all(self, session_id: str) -> Dict[str, Dict]:
+        """Tutti i checkpoint registrati per una sessione"""
+
+        if self.client is None:
+            return {}
+
+        checkpoints = {}
+        for stage, value in (await self.client.hgetall(checkpoint_key(session_id))).items():
+            stage = stage.decode() if isinstance(stage, bytes) else stage
+            try:
+                checkpoints[stage] = json.loads(value)
+            except ValueError as e:
+                logger.warning(f"Checkpoint illeggibile {stage} - {session_id}: {str(e)}")
+
+        return checkpoints
+
+    async def load(self, session_id: str, stage: str, input_hash: str) -> Optional[Dict]:
+        """Checkpoint valido di una fase: stessi input e artefatti ancora disponibili"""
+
+        if self.client is None:
+            return None
+
+        value = await self.client.hget(checkpoint_key(session_id), stage)
+        if value is None:
+            return None
+
+        try:
+            entry = json.loads(value)
+        except ValueError as e:
+            logger.warning(f"Checkpoint illeggibile {stage} - {session_id}: {str(e)}")
+            return None
+
+        if entry.get("input_hash") != input_hash:
+            return None
+
+        artifacts = entry.get("artifacts", [])
+        if self.blobs is not None:
+            present = await asyncio.gather(*(self.blobs.exists(path) for path in artifacts))
+        else:
+            present = [os.path.exists(path) for path in artifacts]
+
+        if not all(present):
+            logger.info(f"Artefatti mancanti per checkpoint {stage} - {session_id}")
+            return None
+
+        # Ripresa su un altro nodo: artefatti scaricati nella cache locale
+        if self.blobs is not None:
+            await asyncio.gather(*(self.blobs.localize(path) for path in artifacts))
+
+        return entry
+
+    async def save(self, session_id: str, stage: str, input_hash: str, result,
+                   artifacts: Optional[List[str]] = None):
+        """Registra il completamento di una fase"""
+
+        if self.client is None:
+            return
+
+        entry = {
+            "stage": stage,
+            "input_hash": input_hash,
+            "artifacts": artifacts or [],
+            "result": result,
+            "completed_at": datetime.now().isoformat()
+        }
+
+        key = checkpoint_key(session_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hset(key, stage, json.dumps(entry, default=str))
+            pipe.expire(key, CHECKPOINT_TTL)
+            await pipe.execute()
+
+        logger.debug(f"Checkpoint salvato: {stage} - {session_id}")
+
+    async def clear(self, session_id: str):
+        """Elimina i checkpoint di una sessione"""
+
+        if self.client is not None:
+            await self.client.delete(checkpoint_key(session_id))
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+from redis.exceptions import WatchError
+
+logger = logging.getLogger(__name__)
+
+# Job identici (stesso audio, modello e opzioni) eseguiti una sola volta
+COALESCING_ENABLED = os.getenv("JOB_COALESCING", "true").lower() == "true"
+
+# Modello dei worker (stesso valore letto da DemucsModel)
+SEPARATION_MODEL = os.getenv("SEPARATION_MODEL", "htdemucs")
+
+# Durata massima di un gruppo senza rinnovi (il worker la rinnova col lease)
+COALESCE_TTL = int(os.getenv("COALESCE_TTL", "3600"))
+
+COALESCE_PREFIX = "coalesce:separation:"
+
+def coalesce_key(content_hash: str, options: Optional[Dict], model: str = SEPARATION_MODEL) -> str:
+    """Chiave del lavoro: hash audio + modello + opzioni normalizzate"""
+
+    fingerprint = json.dumps(
+        {"audio": content_hash, "model": model, "options": options or {}},
+        sort_keys=True, default=str
+    )
+    return f"{COALESCE_PREFIX}{hashlib.sha256(fingerprint.encode()).hexdigest()}"
+
+def _waiters_key(key: str, job_id: str) -> str:
+    return f"{key}:{job_id}:waiters"
+
+def _decode(value) -> Optional[str]:
+    return value.decode() if isinstance(value, bytes) else value
+
+class JobCoalescer:
+    """Unisce le richieste identiche in attesa o in corso in un'unica esecuzione
+
+    Il primo richiedente diventa leader e accoda il job; i successivi si
+    iscrivono come waiter del job del leader e ricevono il suo risultato
+    alla chiusura del gruppo. Iscrizione e chiusura sono transazioni
+    (WATCH sulla chiave del leader): nessun waiter resta orfano.
+    """
+
+    def __init__(self, redis_client):
+        # Client redis.asyncio (API e worker)
+        self.client = redis_client
+
+    async def join(self, key: str, job_id: str, waiter: Dict) -> Optional[str]:
+        """Iscrive il waiter al job identico in corso e ne ritorna l'id,
+        oppure registra job_id come leader e ritorna None"""
+
+        async with self.client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    leader = _decode(await pipe.get(key))
+
+                    pipe.multi()
+                    if leader:
+                        waiters = _waiters_key(key, leader)
+                        pipe.sadd(waiters, json.dumps(waiter, sort_keys=True))
+                        pipe.expire(waiters, COALESCE_TTL)
+                    else:
+                        pipe.set(key, job_id, ex=COALESCE_TTL)
+                    await pipe.execute()
+
+                    return leader
+
+                except WatchError:
+                    # Il gruppo è stato chiuso o creato nel frattempo: si riprova
+                    continue
+
+    async def waiters(self, key: str, job_id: str) -> List[Dict]:
+        """Waiter attualmente iscritti (senza chiudere il gruppo)"""
+
+        members = await self.client.smembers(_waiters_key(key, job_id))
+        return [json.loads(member) for member in members]
+
+    async def touch(self, key: str, job_id: str):
+        """Rinnova il gruppo finché il job del leader è in elaborazione"""
+
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.expire(_waiters_key(key, job_id), COALESCE_TTL)
+            leader, _ = await pipe.execute()
+
+        if _decode(leader) == job_id:
+            await self.client.expire(key, COALESCE_TTL)
+
+    async def complete(self, key: str, job_id: str) -> List[Dict]:
+        """Chiude il gruppo del job e ritorna i waiter da notificare
+
+        Le richieste successive non trovano più il leader e avviano un nuovo job.
+        """
+
+        waiters = _waiters_key(key, job_id)
+
+        async with self.client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    leader = _decode(await pipe.get(key))
+
+                    pipe.multi()
+                    pipe.smembers(waiters)
+                    pipe.delete(waiters)
+                    # Il gruppo può essere scaduto ed essere stato ripreso da un altro job
+                    if leader == job_id:
+                        pipe.delete(key)
+                    results = await pipe.execute()
+
+                    return [json.loads(member) for member in results[0]]
+
+                except WatchError:
+                    continue
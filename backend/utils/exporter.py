@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+import soundfile as sf
+
+from utils.metrics import record_cache, record_file_bytes
+
+logger = logging.getLogger(__name__)
+
+# Formati di esportazione supportati
+EXPORT_FORMATS = {
+    "wav": {"extension": "wav", "media_type": "audio/wav", "default_bitrate": None},
+    "flac": {"extension": "flac", "media_type": "audio/flac", "default_bitrate": None},
+    "opus": {"extension": "opus", "media_type": "audio/ogg", "default_bitrate": 128},
+    "mp3": {"extension": "mp3", "media_type": "audio/mpeg", "default_bitrate": 192}
+}
+
+# Codec ffmpeg per i formati compressi con perdita
+_FFMPEG_CODECS = {
+    "opus": "libopus",
+    "mp3": "libmp3lame"
+}
+
+class StemExporter:
+    """Esportazione stems in FLAC/Opus/MP3 con cache delle versioni generate"""
+
+    def __init__(self, max_workers: Optional[int] = None):
+        # Encoder (ffmpeg/libsndfile) rilasciano il GIL: un thread per core
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or int(os.getenv("EXPORT_WORKERS", os.cpu_count() or 2))
+        )
+
+        # Evita codifiche duplicate della stessa versione in parallelo
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    @staticmethod
+    def resolve_format(export_format: str, bitrate: Optional[int] = None):
+        """Valida formato e bitrate richiesti"""
+
+        export_format = (export_format or "wav").lower()
+
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(
+                f"Formato non supportato: {export_format}. "
+                f"Formati accettati: {', '.join(EXPORT_FORMATS)}"
+            )
+
+        default_bitrate = EXPORT_FORMATS[export_format]["default_bitrate"]
+        if default_bitrate is None:
+            return export_format, None
+
+        bitrate = int(bitrate or default_bitrate)
+        if not 32 <= bitrate <= 320:
+            raise ValueError(f"Bitrate non valido: {bitrate} kbps (range 32-320)")
+
+        return export_format, bitrate
+
+    @staticmethod
+    def rendition_path(stem_path: str, export_format: str, bitrate: Optional[int]) -> Path:
+        """Percorso in cache per (stem, formato, bitrate)"""
+
+        stem_path = Path(stem_path)
+        quality = f"{bitrate}k" if bitrate else "lossless"
+        extension = EXPORT_FORMATS[export_format]["extension"]
+
+        return stem_path.parent / "renditions" / f"{stem_path.stem}_{quality}.{extension}"
+
+    async def get_rendition(self, stem_path: str, export_format: str,
+                          bitrate: Optional[int] = None) -> str:
+        """Ritorna la versione richiesta dello stem, generandola alla prima richiesta"""
+
+        export_format, bitrate = self.resolve_format(export_format, bitrate)
+
+        if export_format == "wav":
+            return stem_path
+
+        output_path = self.rendition_path(stem_path, export_format, bitrate)
+
+        if output_path.exists():
+            record_cache("rendition", True)
+            return str(output_path)
+
+        record_cache("rendition", False)
+        lock = self._locks.setdefault(str(output_path), asyncio.Lock())
+
+        async with lock:
+            # Generata nel frattempo da un'altra richiesta
+            if not output_path.exists():
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(
+                    self.executor,
+                    self._encode_sync,
+                    stem_path, str(output_path), export_format, bitrate
+                )
+
+        self._locks.pop(str(output_path), None)
+
+        return str(output_path)
+
+    async def export_stems(self, stems_paths: Dict[str, str], export_format: str,
+                         bitrate: Optional[int] = None) -> Dict[str, str]:
+        """Codifica in parallelo tutti gli stems nel formato richiesto"""
+
+        names = list(stems_paths.keys())
+        results = await asyncio.gather(*[
+            self.get_rendition(stems_paths[name], export_format, bitrate)
+            for name in names
+        ])
+
+        return dict(zip(names, results))
+
+    @staticmethod
+    def _encode_sync(input_path: str, output_path: str, export_format: str,
+                     bitrate: Optional[int]):
+        """Codifica sincrona su file temporaneo e rinomina atomica"""
+
+        output = Path(output_path)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = output.with_name(f".{output.name}.tmp")
+
+        try:
+            if export_format == "flac":
+                # FLAC non supporta float: PCM 24 bit, conversione a blocchi
+                with sf.SoundFile(input_path, 'r') as src, \
+                        sf.SoundFile(str(tmp_path), 'w', samplerate=src.samplerate,
+                                     channels=src.channels, format="FLAC",
+                                     subtype="PCM_24") as dst:
+                    for block in src.blocks(blocksize=65536, dtype='float32'):
+                        dst.write(block)
+            else:
+                subprocess.run(
+                    [
+                        "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+                        "-i", input_path,
+                        "-c:a", _FFMPEG_CODECS[export_format],
+                        "-b:a", f"{bitrate}k",
+                        "-f", "ogg" if export_format == "opus" else export_format,
+                        str(tmp_path)
+                    ],
+                    check=True,
+                    capture_output=True
+                )
+
+            tmp_path.replace(output)
+            record_file_bytes("read", "export", input_path)
+            record_file_bytes("write", "export", output)
+            logger.debug(f"Versione generata: {output}")
+
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Errore codifica {export_format} {input_path}: {e.stderr.decode(errors='ignore')}")
+            raise
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
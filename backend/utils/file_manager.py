@@ -1,81 +1,522 @@
 import os
+import uuid
 import shutil
+import hashlib
 import zipfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, List
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
 import aiofiles
-from fastapi import UploadFile
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 import asyncio
 
+from utils.metrics import record_bytes, record_cache, DISK_USAGE, SESSIONS_REMOVED
+from utils.blob_store import create_blob_store
+from utils.checkpoint import checkpoint_key
+from utils.session_index import SessionIndex
+from utils.stems import ALL_STEMS
+
 logger = logging.getLogger(__name__)
 
+# Limiti upload (configurabili da ambiente)
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(100 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+# Durata dei file di sessione (come le sessioni in Redis) e intervallo dei controlli
+SESSION_FILES_TTL = float(os.getenv("SESSION_FILES_TTL", "86400"))
+CLEANUP_INTERVAL = float(os.getenv("CLEANUP_INTERVAL", "60"))
+
+# Indice degli stems già separati in Redis (hash contenuto + modello -> percorsi)
+STEMS_INDEX_PREFIX = "stems:index:"
+
+# Eviction LRU sotto pressione: oltre la soglia alta di utilizzo del disco si
+# liberano cache e sessioni meno usate fino alla soglia bassa. Le sessioni
+# usate di recente (o in elaborazione) non sono mai rimosse
+DISK_HIGH_WATERMARK = float(os.getenv("DISK_HIGH_WATERMARK", "0.90"))
+DISK_LOW_WATERMARK = float(os.getenv("DISK_LOW_WATERMARK", "0.80"))
+EVICTION_MIN_IDLE = float(os.getenv("EVICTION_MIN_IDLE", "600"))
+EVICTION_BATCH = 20
+
+class UploadTooLargeError(Exception):
+    """Upload oltre la dimensione massima consentita"""
+    
+    def __init__(self, max_size: int):
+        super().__init__(f"File troppo grande. Dimensione massima: {max_size // (1024 * 1024)}MB")
+        self.max_size = max_size
+
+class UploadWriter:
+    """Upload scritto su disco durante la ricezione, con hash e limite dimensione
+    
+    write() accumula fino a UPLOAD_CHUNK_SIZE (memoria O(blocco)) e solleva
+    UploadTooLargeError appena il limite è superato; close() archivia il file
+    nella blob store e ritorna percorso del blob, hash e dimensione.
+    """
+    
+    def __init__(self, file_manager: "FileManager", session_id: str, filename: str, max_size: int):
+        self.file_manager = file_manager
+        self.session_id = session_id
+        self.filename = filename
+        self.max_size = max_size
+        self.path = file_manager.session_dir(session_id) / f"original{Path(filename).suffix}"
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._buffer = bytearray()
+        self._file = None
+    
+    async def open(self):
+        self._file = await aiofiles.open(self.path, 'wb')
+    
+    async def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise UploadTooLargeError(self.max_size)
+        
+        self._digest.update(data)
+        self._buffer += data
+        if len(self._buffer) >= UPLOAD_CHUNK_SIZE:
+            await self._flush()
+    
+    async def _flush(self):
+        if self._buffer:
+            await self._file.write(bytes(self._buffer))
+            self._buffer.clear()
+    
+    async def close(self) -> Dict[str, any]:
+        try:
+            await self._flush()
+        finally:
+            await self._file.close()
+        record_bytes("write", "upload", self.size)
+        
+        # Stesso audio caricato più volte: un solo blob
+        digest = self._digest.hexdigest()
+        blob_path = await self.file_manager.blobs.put(self.session_id, "original", str(self.path), digest)
+        logger.info(f"File salvato: {blob_path} ({self.size} bytes)")
+        
+        return {
+            "session_id": self.session_id,
+            "filename": self.filename,
+            "file_path": blob_path,
+            "content_hash": digest,
+            "size": self.size
+        }
+    
+    async def abort(self):
+        """Chiude e rimuove il file parziale"""
+        
+        if self._file is not None:
+            await self._file.close()
+        self.path.unlink(missing_ok=True)
+
+class _ArchiveStreamWriter:
+    """File-like non posizionabile: scrive su file di cache e inoltra i blocchi al client
+    
+    Senza tell()/seek() zipfile usa i data descriptor e scrive in un solo passaggio.
+    """
+    
+    def __init__(self, cache_file, queue: asyncio.Queue, loop, cancelled: threading.Event,
+                 chunk_size: int = 256 * 1024):
+        self.cache_file = cache_file
+        self.queue = queue
+        self.loop = loop
+        self.cancelled = cancelled
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+    
+    def write(self, data) -> int:
+        if self.cancelled.is_set():
+            raise IOError("Download archivio interrotto dal client")
+        
+        self.cache_file.write(data)
+        self._buffer += data
+        
+        if len(self._buffer) >= self.chunk_size:
+            self._push()
+        
+        return len(data)
+    
+    def flush(self):
+        if self._buffer and not self.cancelled.is_set():
+            self._push()
+    
+    def _push(self):
+        chunk = bytes(self._buffer)
+        self._buffer.clear()
+        # Bloccante se il client è lento (coda limitata): backpressure
+        asyncio.run_coroutine_threadsafe(self.queue.put(chunk), self.loop).result()
+
 class FileManager:
-    """Gestione file temporanei e cleanup automatico"""
+    """Gestione file temporanei e cleanup automatico
+    
+    Upload, stems, mix e segmenti di inferenza sono archiviati nella blob
+    store content-addressed; indice degli stems e checkpoint sono in Redis.
+    API e worker non condividono il disco: la directory della sessione
+    contiene solo file di lavoro locali (archivi, copie in elaborazione).
+    """
     
-    def __init__(self, temp_dir: str = "/app/temp_files"):
+    def __init__(self, temp_dir: str = "/app/temp_files", redis_client=None):
         self.temp_dir = Path(temp_dir)
         self.temp_dir.mkdir(exist_ok=True)
         
-        # Avvia task di cleanup automatico
-        asyncio.create_task(self._auto_cleanup_task())
+        # Blob store dei file delle sessioni (riferimenti in Redis se disponibile)
+        self.blobs = create_blob_store(self.temp_dir, redis_client)
+        
+        # Indice stems e checkpoint condivisi (senza Redis: nessun riuso)
+        self.redis_client = redis_client
+        
+        # Indice delle sessioni per scadenza ed eviction; gli accessi sono
+        # accumulati in memoria e scritti a ogni ciclo di cleanup
+        self.sessions = SessionIndex(self.temp_dir / ".sessions.db")
+        self._accesses: Dict[str, float] = {}
+        self._in_use: Counter = Counter()
+        
+        # Avvia task di cleanup automatico (subito se c'è già un event loop,
+        # altrimenti da start_cleanup() all'avvio dell'applicazione)
+        self._cleanup_task = None
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            self.start_cleanup()
+    
+    def start_cleanup(self):
+        """Avvia il task di cleanup automatico (una sola volta)"""
+        
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._auto_cleanup_task())
+    
+    async def open_upload(self, session_id: str, filename: str,
+                          max_size: int = MAX_UPLOAD_SIZE) -> "UploadWriter":
+        """File caricato da scrivere a blocchi man mano che arriva"""
+        
+        writer = UploadWriter(self, session_id, filename, max_size)
+        await writer.open()
+        return writer
+    
+    async def compute_file_hash(self, file_path: str) -> str:
+        """Calcola hash SHA-256 del contenuto di un file"""
+        
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._hash_file_sync, file_path)
+    
+    @staticmethod
+    def _hash_file_sync(file_path: str) -> str:
+        """Hash sincrono a blocchi (memoria costante)"""
+        
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
     
-    async def save_uploaded_file(self, file: UploadFile, session_id: str) -> str:
-        """Salva file caricato dall'utente"""
+    def session_dir(self, session_id: str) -> Path:
+        """Directory di lavoro locale della sessione"""
         
-        # Crea directory sessione
         session_dir = self.temp_dir / session_id
-        session_dir.mkdir(exist_ok=True)
+        session_dir.mkdir(parents=True, exist_ok=True)
+        self.touch_session(session_id)
+        return session_dir
+    
+    def touch_session(self, session_id: str):
+        """Registra un accesso alla sessione (ordine LRU dell'eviction)"""
         
-        # Determina percorso file
-        file_ext = Path(file.filename).suffix
-        file_path = session_dir / f"original{file_ext}"
+        self._accesses[session_id] = time.time()
+    
+    @contextmanager
+    def in_use(self, session_id: str):
+        """Sessione in elaborazione: esclusa dall'eviction finché il blocco è attivo"""
         
+        self._in_use[session_id] += 1
         try:
-            # Salva file in modo asincrono
-            async with aiofiles.open(file_path, 'wb') as f:
-                content = await file.read()
-                await f.write(content)
+            yield
+        finally:
+            self._in_use[session_id] -= 1
+            if self._in_use[session_id] <= 0:
+                del self._in_use[session_id]
+            self.touch_session(session_id)
+    
+    async def publish_files(self, session_id: str, paths: Dict[str, str],
+                            prefix: str = "") -> Dict[str, str]:
+        """Archivia i file prodotti dalla sessione; ritorna nome -> percorso del blob"""
+        
+        names = [name for name, path in paths.items() if path]
+        blob_paths = await asyncio.gather(*(
+            self.blobs.put(session_id, f"{prefix}{name}", paths[name], companions=(".peaks",))
+            for name in names
+        ))
+        return dict(zip(names, blob_paths))
+    
+    async def retain_files(self, session_id: str, paths: Dict[str, str], prefix: str = ""):
+        """Aggiunge al manifest della sessione blob prodotti da altre sessioni"""
+        
+        await asyncio.gather(*(
+            self.blobs.retain(session_id, f"{prefix}{name}", path)
+            for name, path in paths.items() if path
+        ))
+    
+    async def localize(self, path: str) -> str:
+        """Percorso locale di un file (i blob sono scaricati alla prima lettura)"""
+        
+        return await self.blobs.localize(path)
+    
+    async def localize_all(self, paths: Dict[str, Optional[str]]) -> Dict[str, Optional[str]]:
+        present = {name: path for name, path in paths.items() if path}
+        local_paths = await asyncio.gather(*(self.blobs.localize(path) for path in present.values()))
+        return {**paths, **dict(zip(present, local_paths))}
+    
+    async def restore_files(self, session_id: str, prefix: str, target_dir: Path) -> int:
+        """Copia in target_dir i blob della sessione con il prefisso dato
+
+        Ripresa su qualsiasi nodo di file intermedi pubblicati man mano (es.
+        segmenti di inferenza); ritorna il numero di file ripristinati.
+        """
+        
+        manifest = await self.blobs.manifest(session_id)
+        entries = {
+            name[len(prefix):]: path for name, path in manifest.items() if name.startswith(prefix)
+        }
+        if not entries:
+            return 0
+        
+        target_dir.mkdir(parents=True, exist_ok=True)
+        loop = asyncio.get_event_loop()
+        
+        for name, path in entries.items():
+            local_path = await self.blobs.localize(path)
+            await loop.run_in_executor(None, self._link_or_copy, local_path, target_dir / name)
+        
+        return len(entries)
+    
+    @staticmethod
+    def _link_or_copy(source: str, target: Path):
+        if target.exists():
+            return
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+    
+    async def release_files(self, session_id: str, prefix: str) -> int:
+        """Rilascia i blob intermedi della sessione con il prefisso dato"""
+        
+        manifest = await self.blobs.manifest(session_id)
+        names = [name for name in manifest if name.startswith(prefix)]
+        return await self.blobs.release(session_id, names)
+    
+    @staticmethod
+    def _stems_index_key(content_hash: str, model_name: str) -> str:
+        return f"{STEMS_INDEX_PREFIX}{content_hash}:{model_name}"
+    
+    async def register_stems(self, content_hash: str, model_name: str, 
+                           stems_paths: Dict[str, str]):
+        """Registra stems separati per riutilizzo tra sessioni (e tra nodi)"""
+        
+        if self.redis_client is None:
+            return
+        
+        # Unisce con stems già noti (es. separazioni parziali)
+        entry = {name: path for name, path in stems_paths.items() if path}
+        if not entry:
+            return
+        
+        key = self._stems_index_key(content_hash, model_name)
+        
+        try:
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(key, mapping=entry)
+                pipe.expire(key, int(SESSION_FILES_TTL))
+                await pipe.execute()
             
-            logger.info(f"File salvato: {file_path} ({len(content)} bytes)")
-            return str(file_path)
+            logger.debug(f"Stems registrati per riutilizzo: {content_hash[:12]} ({len(entry)})")
             
         except Exception as e:
-            logger.error(f"Errore salvataggio file: {str(e)}")
-            # Cleanup in caso di errore
-            if file_path.exists():
-                file_path.unlink()
-            raise
+            logger.warning(f"Errore registrazione stems {content_hash[:12]}: {str(e)}")
     
-    async def create_stems_archive(self, session_id: str, stems_paths: Dict[str, str]) -> str:
-        """Crea archivio ZIP con tutte le tracce separate"""
+    async def find_cached_stems(self, content_hash: str, model_name: str,
+                              required: Optional[List[str]] = None) -> Optional[Dict[str, str]]:
+        """Cerca stems già separati per lo stesso audio"""
         
-        session_dir = self.temp_dir / session_id
-        zip_path = session_dir / "stems_archive.zip"
+        if self.redis_client is None:
+            return None
         
         try:
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for stem_name, stem_path in stems_paths.items():
-                    if os.path.exists(stem_path):
-                        # Aggiungi file allo ZIP con nome pulito
-                        arcname = f"{stem_name}.wav"
-                        zipf.write(stem_path, arcname)
-                        logger.debug(f"Aggiunto a ZIP: {stem_name}")
+            entry = {
+                (name.decode() if isinstance(name, bytes) else name):
+                    (path.decode() if isinstance(path, bytes) else path)
+                for name, path in (
+                    await self.redis_client.hgetall(self._stems_index_key(content_hash, model_name))
+                ).items()
+            }
+            if not entry:
+                return None
+            
+            # Considera solo file ancora presenti (in locale o nella blob store)
+            present = await asyncio.gather(*(self.blobs.exists(path) for path in entry.values()))
+            available = {name: path for (name, path), ok in zip(entry.items(), present) if ok}
+            
+            # Senza richiesta esplicita serve la separazione completa: un indice
+            # parziale (mashup, blob già raccolti) non basta
+            if required is None:
+                required = ALL_STEMS
+            
+            if all(name in available for name in required):
+                return {name: available[name] for name in required}
+            
+            return None
+            
+        except Exception as e:
+            logger.warning(f"Errore lettura indice stems {content_hash[:12]}: {str(e)}")
+            return None
+    
+    def get_cached_archive(self, session_id: str,
+                           archive_name: str = "stems_archive.zip") -> Optional[str]:
+        """Archivio già generato per la sessione (gli stems non cambiano più)"""
+        
+        zip_path = self.temp_dir / session_id / archive_name
+        if not zip_path.exists():
+            return None
+        
+        self.touch_session(session_id)
+        return str(zip_path)
+    
+    async def create_stems_archive(self, session_id: str, stems_paths: Dict[str, str],
+                                 archive_name: str = "stems_archive.zip") -> str:
+        """Crea archivio ZIP con tutte le tracce separate (riusato se già presente)"""
+        
+        cached = self.get_cached_archive(session_id, archive_name)
+        record_cache("archive", cached is not None)
+        if cached:
+            return cached
+        
+        zip_path = self.session_dir(session_id) / archive_name
+        tmp_path = zip_path.with_name(f".{archive_name}.{uuid.uuid4().hex}.tmp")
+        
+        try:
+            # Scrittura fuori dall'event loop
+            loop = asyncio.get_event_loop()
+            with open(tmp_path, 'wb') as f:
+                await loop.run_in_executor(None, self._write_stems_zip, f, stems_paths)
+            tmp_path.replace(zip_path)
             
             logger.info(f"Archivio ZIP creato: {zip_path}")
             return str(zip_path)
             
         except Exception as e:
             logger.error(f"Errore creazione archivio: {str(e)}")
-            if zip_path.exists():
-                zip_path.unlink()
+            if tmp_path.exists():
+                tmp_path.unlink()
             raise
     
+    async def stream_stems_archive(self, session_id: str, stems_paths: Dict[str, str],
+                                 archive_name: str = "stems_archive.zip",
+                                 prepare: Optional[Callable[[str], Awaitable[str]]] = None
+                                 ) -> AsyncIterator[bytes]:
+        """Genera l'archivio ZIP in streaming, salvandolo in cache mentre viene inviato
+        
+        Gli stems sono già compressi o comprimibili poco: ZIP_STORED, nessun costo CPU.
+        prepare(path) (es. codifica in un altro formato) parte subito per tutti gli
+        stems, ma ogni voce attende solo il proprio: la prima è inviata mentre le
+        successive sono ancora in codifica.
+        """
+        
+        record_cache("archive", False)
+        
+        loop = asyncio.get_event_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=8)
+        cancelled = threading.Event()
+        
+        zip_path = self.session_dir(session_id) / archive_name
+        tmp_path = zip_path.with_name(f".{archive_name}.{uuid.uuid4().hex}.tmp")
+        
+        pending = {}
+        if prepare is not None:
+            pending = {name: asyncio.ensure_future(prepare(path)) for name, path in stems_paths.items()}
+        
+        async def ready(name: str) -> str:
+            return await pending[name]
+        
+        def resolve(name: str) -> str:
+            if name not in pending:
+                return stems_paths[name]
+            return asyncio.run_coroutine_threadsafe(ready(name), loop).result()
+        
+        def produce():
+            try:
+                with open(tmp_path, 'wb') as cache_file:
+                    writer = _ArchiveStreamWriter(cache_file, queue, loop, cancelled)
+                    self._write_stems_zip(writer, stems_paths, resolve)
+                    writer.flush()
+                
+                # Archivio completo: disponibile per le richieste successive
+                tmp_path.replace(zip_path)
+                logger.info(f"Archivio ZIP creato: {zip_path}")
+                
+            except Exception as e:
+                if not cancelled.is_set():
+                    logger.error(f"Errore creazione archivio: {str(e)}")
+                if tmp_path.exists():
+                    tmp_path.unlink()
+                if not cancelled.is_set():
+                    asyncio.run_coroutine_threadsafe(queue.put(e), loop).result()
+                    return
+            
+            if not cancelled.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+        
+        producer = loop.run_in_executor(None, produce)
+        
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            # Client disconnesso: sblocca e interrompe il produttore e le codifiche in attesa
+            cancelled.set()
+            for task in pending.values():
+                task.cancel()
+            while not queue.empty():
+                queue.get_nowait()
+            await producer
+            await asyncio.gather(*pending.values(), return_exceptions=True)
+    
+    @staticmethod
+    def _write_stems_zip(fileobj, stems_paths: Dict[str, str],
+                         resolve: Optional[Callable[[str], str]] = None):
+        """Scrive gli stems in un archivio ZIP non compresso"""
+        
+        with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_STORED, allowZip64=True) as zipf:
+            for stem_name in stems_paths:
+                stem_path = resolve(stem_name) if resolve else stems_paths[stem_name]
+                if os.path.exists(stem_path):
+                    # Aggiungi file allo ZIP con nome pulito
+                    arcname = f"{stem_name}{Path(stem_path).suffix}"
+                    zipf.write(stem_path, arcname)
+                    logger.debug(f"Aggiunto a ZIP: {stem_name}")
+    
     async def cleanup_session(self, session_id: str) -> bool:
         """Elimina tutti i file di una sessione"""
         
         session_dir = self.temp_dir / session_id
+        self._accesses.pop(session_id, None)
+        
+        # I blob restano finché referenziati da altre sessioni
+        try:
+            await self.blobs.release_session(session_id)
+            if self.redis_client is not None:
+                await self.redis_client.delete(checkpoint_key(session_id))
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.sessions.remove, [session_id])
+        except Exception as e:
+            logger.error(f"Errore rilascio blob sessione {session_id}: {str(e)}")
         
         if not session_dir.exists():
             logger.warning(f"Directory sessione non trovata: {session_id}")
@@ -83,7 +524,8 @@ class FileManager:
         
         try:
             # Elimina ricorsivamente tutta la directory
-            shutil.rmtree(session_dir)
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, shutil.rmtree, session_dir)
             logger.info(f"Sessione pulita: {session_id}")
             return True
             
@@ -140,49 +582,137 @@ class FileManager:
             return []
     
     async def _auto_cleanup_task(self):
-        """Task automatico per pulizia file scaduti"""
+        """Task automatico: scadenza sessioni, eviction sotto pressione e raccolta blob"""
+        
+        await self._index_existing_sessions()
         
         while True:
             try:
-                await self._cleanup_expired_sessions()
-                # Esegui cleanup ogni ora
-                await asyncio.sleep(3600)
+                await self._flush_accesses()
+                await self._expire_sessions()
+                await self._evict_for_space()
+                await self.blobs.collect_garbage()
+                await self.blobs.trim_cache()
+                await asyncio.sleep(CLEANUP_INTERVAL)
                 
             except Exception as e:
                 logger.error(f"Errore auto-cleanup: {str(e)}")
                 await asyncio.sleep(300)  # Riprova dopo 5 minuti
     
-    async def _cleanup_expired_sessions(self):
-        """Elimina sessioni scadute (>24 ore)"""
+    async def _index_existing_sessions(self):
+        """Indicizza le directory di sessione precedenti all'indice (una volta all'avvio)"""
         
-        if not self.temp_dir.exists():
-            return
+        def scan():
+            known = self.sessions.known()
+            found = {
+                item.name: item.stat().st_ctime
+                for item in self.temp_dir.iterdir()
+                if item.is_dir() and not item.name.startswith(".") and item.name not in known
+            }
+            self.sessions.add_existing(found)
+            return len(found)
         
-        current_time = datetime.now()
-        cutoff_time = current_time - timedelta(hours=24)
+        try:
+            loop = asyncio.get_event_loop()
+            added = await loop.run_in_executor(None, scan)
+            if added:
+                logger.info(f"Sessioni esistenti aggiunte all'indice: {added}")
+        except Exception as e:
+            logger.error(f"Errore indicizzazione sessioni esistenti: {str(e)}")
+    
+    async def _flush_accesses(self):
+        """Scrive nell'indice gli accessi accumulati (e rinnova le sessioni in uso)"""
         
-        cleaned_count = 0
+        now = time.time()
+        accesses, self._accesses = self._accesses, {}
+        accesses.update({session_id: now for session_id in self._in_use})
         
-        try:
-            for session_dir in self.temp_dir.iterdir():
-                if session_dir.is_dir():
-                    # Controlla data creazione directory
-                    created_time = datetime.fromtimestamp(session_dir.stat().st_ctime)
-                    
-                    if created_time < cutoff_time:
-                        try:
-                            shutil.rmtree(session_dir)
-                            cleaned_count += 1
-                            logger.info(f"Sessione scaduta eliminata: {session_dir.name}")
-                            
-                        except Exception as e:
-                            logger.error(f"Errore eliminazione sessione scaduta {session_dir.name}: {str(e)}")
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.sessions.touch, accesses)
+    
+    async def _expire_sessions(self) -> int:
+        """Elimina le sessioni oltre SESSION_FILES_TTL (costo proporzionale alle scadute)"""
+        
+        loop = asyncio.get_event_loop()
+        cutoff = time.time() - SESSION_FILES_TTL
+        removed = 0
+        
+        while True:
+            expired = await loop.run_in_executor(None, self.sessions.expired, cutoff, EVICTION_BATCH)
+            expired = [session_id for session_id in expired if session_id not in self._in_use]
+            if not expired:
+                break
             
-            if cleaned_count > 0:
-                logger.info(f"Auto-cleanup completato: {cleaned_count} sessioni eliminate")
-                
-        except Exception as e:
-            logger.error(f"Errore durante auto-cleanup: {str(e)}")
+            removed += await self._remove_sessions(expired, "expired")
+        
+        if removed:
+            logger.info(f"Auto-cleanup completato: {removed} sessioni scadute eliminate")
+        
+        return removed
+    
+    def _disk_pressure(self) -> int:
+        """Byte da liberare per tornare alla soglia bassa (0 sotto la soglia alta)"""
+        
+        usage = shutil.disk_usage(self.temp_dir)
+        DISK_USAGE.set(usage.used / usage.total)
+        
+        if usage.used / usage.total < DISK_HIGH_WATERMARK:
+            return 0
+        
+        return int(usage.used - DISK_LOW_WATERMARK * usage.total)
+    
+    async def _evict_for_space(self) -> int:
+        """Sotto pressione libera prima la cache blob, poi le sessioni meno usate"""
+        
+        loop = asyncio.get_event_loop()
+        needed = await loop.run_in_executor(None, self._disk_pressure)
+        if needed <= 0:
+            return 0
+        
+        logger.warning(f"Disco oltre la soglia: da liberare {needed // (1024 * 1024)} MB")
+        
+        # Cache read-through: i blob restano nel backend
+        await self.blobs.evict(needed)
+        
+        evicted = 0
+        while await loop.run_in_executor(None, self._disk_pressure) > 0:
+            candidates = await loop.run_in_executor(
+                None, self.sessions.least_recent, time.time() - EVICTION_MIN_IDLE, EVICTION_BATCH
+            )
+            candidates = [session_id for session_id in candidates if session_id not in self._in_use]
+            if not candidates:
+                logger.error("Disco oltre la soglia senza sessioni inattive da rimuovere")
+                break
+            
+            evicted += await self._remove_sessions(candidates, "disk_pressure")
+            # Spazio effettivo solo dopo la rimozione dei blob senza riferimenti
+            await self.blobs.collect_garbage(grace=0)
+        
+        if evicted:
+            logger.warning(f"Sessioni rimosse per spazio su disco: {evicted}")
+        
+        return evicted
+    
+    async def _remove_sessions(self, session_ids: List[str], reason: str) -> int:
+        """Rilascia i blob, elimina le directory e toglie le sessioni dall'indice"""
+        
+        loop = asyncio.get_event_loop()
+        
+        for session_id in session_ids:
+            self._accesses.pop(session_id, None)
+            try:
+                await self.blobs.release_session(session_id)
+                await loop.run_in_executor(
+                    None, shutil.rmtree, self.temp_dir / session_id, True
+                )
+                logger.info(f"Sessione rimossa ({reason}): {session_id}")
+            except Exception as e:
+                logger.error(f"Errore eliminazione sessione {session_id}: {str(e)}")
+        
+        await loop.run_in_executor(None, self.sessions.remove, session_ids)
+        SESSIONS_REMOVED.labels(reason=reason).inc(len(session_ids))
+        
+        return len(session_ids)
     
     async def get_disk_usage(self) -> Dict[str, any]:
         """Statistiche utilizzo disco"""
@@ -195,7 +725,7 @@ class FileManager:
             
             if self.temp_dir.exists():
                 for item in self.temp_dir.iterdir():
-                    if item.is_dir():
+                    if item.is_dir() and not item.name.startswith("."):
                         session_count += 1
                         for file_path in item.rglob('*'):
                             if file_path.is_file():
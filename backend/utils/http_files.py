@@ -0,0 +1,164 @@
+import hashlib
+import logging
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import AsyncIterator, Optional, Tuple
+
+import aiofiles
+from fastapi import HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+# Offload del body al proxy: "" (disattivo), "x-accel" (nginx) o "x-sendfile" (apache/lighttpd)
+SENDFILE_MODE = os.getenv("SENDFILE_MODE", "").lower()
+SENDFILE_ROOT = os.getenv("SENDFILE_ROOT", "/app/temp_files")
+SENDFILE_PREFIX = os.getenv("SENDFILE_PREFIX", "/protected_files")
+
+# Cache per risorse che non cambiano più (stems completati)
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_CHUNK_SIZE = 256 * 1024
+
+def file_etag(stat_result: os.stat_result) -> str:
+    """ETag forte: i file serviti non vengono mai riscritti sul posto"""
+
+    token = f"{stat_result.st_ino}-{stat_result.st_size}-{stat_result.st_mtime_ns}"
+    return f'"{hashlib.sha1(token.encode()).hexdigest()[:20]}"'
+
+def _etag_matches(header: str, etag: str) -> bool:
+    candidates = [value.strip() for value in header.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+def _not_modified_since(header: Optional[str], mtime: float) -> bool:
+    if not header:
+        return False
+    try:
+        return int(mtime) <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Intervallo richiesto (inclusivo) o None se da ignorare
+
+    Supporta un singolo intervallo; richieste multi-range ricevono il file intero.
+    Solleva 416 per intervalli non soddisfacibili.
+    """
+
+    unit, _, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+
+    start_text, _, end_text = ranges.strip().partition("-")
+
+    try:
+        if start_text == "":
+            # Suffisso: ultimi N byte
+            length = int(end_text)
+            if length <= 0:
+                raise ValueError
+            start, end = max(0, size - length), size - 1
+        else:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+            end = min(end, size - 1)
+    except ValueError:
+        return None
+
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Intervallo richiesto non valido",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+
+    return start, end
+
+async def _iter_file(path: str, start: int, end: int) -> AsyncIterator[bytes]:
+    async with aiofiles.open(path, 'rb') as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def _accel_redirect(path: str) -> Optional[str]:
+    """URI interna nginx del file, o None se è fuori da SENDFILE_ROOT
+
+    I file fuori dalla location protetta (es. blob store su un altro volume)
+    non sono raggiungibili dal proxy: vengono serviti in streaming.
+    """
+
+    try:
+        relative = Path(path).resolve().relative_to(Path(SENDFILE_ROOT).resolve())
+    except ValueError:
+        logger.warning(f"File fuori da SENDFILE_ROOT ({SENDFILE_ROOT}), servito in streaming: {path}")
+        return None
+
+    return f"{SENDFILE_PREFIX.rstrip('/')}/{relative.as_posix()}"
+
+def file_response(request: Request, path: str, media_type: str, filename: str,
+                  immutable: bool = True) -> Response:
+    """Risposta file con Range (206), ETag/Last-Modified condizionali e offload al proxy"""
+
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File non trovato")
+
+    etag = file_etag(stat_result)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else "no-cache",
+        "Content-Disposition": f'attachment; filename="{filename}"'
+    }
+
+    # Richieste condizionali: If-None-Match ha precedenza su If-Modified-Since
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    elif _not_modified_since(request.headers.get("if-modified-since"), stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    # Il proxy legge e invia i byte (gestendo anche i Range)
+    if SENDFILE_MODE == "x-sendfile":
+        headers["X-Sendfile"] = str(Path(path).resolve())
+        return Response(media_type=media_type, headers=headers)
+
+    if SENDFILE_MODE == "x-accel":
+        redirect = _accel_redirect(path)
+        if redirect is not None:
+            headers["X-Accel-Redirect"] = redirect
+            return Response(media_type=media_type, headers=headers)
+
+    size = stat_result.st_size
+    byte_range = None
+
+    range_header = request.headers.get("range")
+    if range_header and size > 0:
+        # If-Range: il Range vale solo se la risorsa non è cambiata
+        if_range = request.headers.get("if-range")
+        if if_range is None or if_range.strip() == etag or \
+                _not_modified_since(if_range, stat_result.st_mtime):
+            byte_range = _parse_range(range_header, size)
+
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(
+            _iter_file(path, 0, size - 1), media_type=media_type, headers=headers
+        )
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    return StreamingResponse(
+        _iter_file(path, start, end), status_code=206, media_type=media_type, headers=headers
+    )
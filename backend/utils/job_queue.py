@@ -0,0 +1,417 @@
+import json
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from redis.exceptions import ResponseError, WatchError
+
+logger = logging.getLogger(__name__)
+
+# Stream di separazione per priorità (consumati da worker.AIWorker); i client
+# identificati hanno uno stream per priorità ("{stream}:{tenant}")
+QUEUES = {
+    "priority": "stream:separation:priority",
+    "normal": "stream:separation:normal"
+}
+
+# Registro degli stream per tenant: stream -> {"priority", "tenant", "enqueued_at"}
+STREAMS_REGISTRY = "streams:separation"
+
+# Stream di tenant vuoti e senza accodamenti da questo tempo vengono eliminati
+IDLE_STREAM_TTL = int(os.getenv("JOB_STREAM_IDLE_TTL", "3600"))
+
+DEFAULT_TENANT = "default"
+
+# Job che hanno esaurito i tentativi o sono falliti definitivamente
+DEAD_LETTER_STREAM = "stream:separation:dead"
+
+# Liste della versione precedente (migrate negli stream all'avvio dei worker)
+LEGACY_QUEUES = {
+    "priority": "queue:separation:priority",
+    "normal": "queue:separation:normal"
+}
+
+CONSUMER_GROUP = "separation-workers"
+
+# Dopo questo tempo senza rinnovo un job in elaborazione è considerato perso
+VISIBILITY_TIMEOUT = int(os.getenv("JOB_VISIBILITY_TIMEOUT", "120"))
+
+# Consegne massime di un job (crash/OOM del worker inclusi)
+MAX_DELIVERIES = int(os.getenv("JOB_MAX_DELIVERIES", "3"))
+
+@dataclass
+class Delivery:
+    """Job consegnato a un consumer, da confermare con ack()"""
+    stream: str
+    message_id: str
+    job: Dict
+    deliveries: int = 1
+
+class JobQueue:
+    """Coda job affidabile su Redis Streams (consegna at-least-once)
+
+    I produttori aggiungono job agli stream; i worker li leggono con un
+    consumer group e li confermano solo a fine elaborazione. I job di un
+    worker morto restano pendenti e vengono riassegnati dopo il visibility
+    timeout; oltre MAX_DELIVERIES finiscono nello stream dead-letter.
+    """
+
+    def __init__(self, redis_client):
+        # Client redis.asyncio condiviso (es. SessionStore.client)
+        self.client = redis_client
+        self._ready_streams = set()
+
+    @staticmethod
+    def resolve_priority(priority: Optional[str]) -> str:
+        priority = (priority or "normal").lower()
+
+        if priority not in QUEUES:
+            raise ValueError(
+                f"Priorità non valida: {priority}. Valori accettati: {', '.join(QUEUES)}"
+            )
+
+        return priority
+
+    @staticmethod
+    def stream_key(priority: str, tenant: Optional[str] = None) -> str:
+        if not tenant or tenant == DEFAULT_TENANT:
+            return QUEUES[priority]
+        return f"{QUEUES[priority]}:{tenant}"
+
+    async def ensure_groups(self, streams: Optional[List[str]] = None):
+        """Crea stream e consumer group se mancanti (idempotente)"""
+
+        for stream in streams or QUEUES.values():
+            if stream in self._ready_streams:
+                continue
+
+            try:
+                await self.client.xgroup_create(stream, CONSUMER_GROUP, id="0", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+            self._ready_streams.add(stream)
+
+    async def streams(self) -> Dict[str, Dict]:
+        """Tutti gli stream di separazione con priorità e tenant"""
+
+        streams = {
+            stream: {"priority": priority, "tenant": DEFAULT_TENANT}
+            for priority, stream in QUEUES.items()
+        }
+
+        for stream, info in (await self.client.hgetall(STREAMS_REGISTRY)).items():
+            if isinstance(stream, bytes):
+                stream = stream.decode()
+            streams[stream] = json.loads(info)
+
+        return streams
+
+    async def enqueue(self, job: Dict, priority: str = "normal") -> Dict:
+        """Accoda un job e ritorna il job completo di id e timestamp"""
+
+        priority = self.resolve_priority(priority)
+
+        job = {
+            **job,
+            "job_id": job.get("job_id") or str(uuid.uuid4()),
+            "priority": priority,
+            "enqueued_at": time.time()
+        }
+
+        # Uno stream per tenant: lo scheduler dei worker li serve in modo equo
+        tenant = job.get("client_id") or DEFAULT_TENANT
+        stream = self.stream_key(priority, tenant)
+
+        if stream in QUEUES.values():
+            await self.ensure_groups([stream])
+            await self.client.xadd(stream, {"job": json.dumps(job)})
+        else:
+            # Gruppo creato nella stessa transazione dell'accodamento: lo stream
+            # può essere appena stato eliminato da prune_idle_streams()
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.xgroup_create(stream, CONSUMER_GROUP, id="0", mkstream=True)
+                pipe.xadd(stream, {"job": json.dumps(job)})
+                pipe.hset(STREAMS_REGISTRY, stream, json.dumps({
+                    "priority": priority, "tenant": tenant, "enqueued_at": job["enqueued_at"]
+                }))
+                results = await pipe.execute(raise_on_error=False)
+
+            for result in results:
+                if isinstance(result, ResponseError) and "BUSYGROUP" not in str(result):
+                    raise result
+            self._ready_streams.add(stream)
+
+        logger.info(f"Job accodato: {job['job_id']} ({job.get('type')}, {priority}, {tenant})")
+        return job
+
+    async def depth(self) -> Dict[str, int]:
+        """Job in attesa per coda di priorità (esclusi quelli già in elaborazione)"""
+
+        streams = await self.streams()
+        await self.ensure_groups(list(streams))
+
+        async with self.client.pipeline(transaction=False) as pipe:
+            for stream in streams:
+                pipe.xlen(stream)
+                pipe.xpending(stream, CONSUMER_GROUP)
+            results = await pipe.execute()
+
+        # I job confermati vengono rimossi: lunghezza - pendenti = non ancora consegnati
+        depth = {stream: 0 for stream in QUEUES.values()}
+        for i, (stream, info) in enumerate(streams.items()):
+            waiting = max(0, results[i * 2] - results[i * 2 + 1]["pending"])
+            depth[QUEUES[info["priority"]]] += waiting
+
+        return depth
+
+    async def heads(self, streams: List[str]) -> List[Delivery]:
+        """Primo job non ancora consegnato di ogni stream (senza consegnarlo)"""
+
+        await self.ensure_groups(streams)
+
+        async with self.client.pipeline(transaction=False) as pipe:
+            for stream in streams:
+                pipe.xinfo_groups(stream)
+            groups = await pipe.execute()
+
+        async with self.client.pipeline(transaction=False) as pipe:
+            for stream, stream_groups in zip(streams, groups):
+                last_id = next(
+                    (group["last-delivered-id"] for group in stream_groups
+                     if group["name"] in (CONSUMER_GROUP, CONSUMER_GROUP.encode())),
+                    b"0-0"
+                )
+                if isinstance(last_id, bytes):
+                    last_id = last_id.decode()
+                pipe.xrange(stream, min=f"({last_id}", max="+", count=1)
+            ranges = await pipe.execute()
+
+        return [
+            self._delivery(stream, entries[0][0], entries[0][1])
+            for stream, entries in zip(streams, ranges)
+            if entries
+        ]
+
+    async def read_stream(self, consumer: str, stream: str) -> Optional[Delivery]:
+        """Consegna al consumer il prossimo job di uno stream (non bloccante)"""
+
+        response = await self.client.xreadgroup(
+            CONSUMER_GROUP, consumer, {stream: ">"}, count=1
+        )
+
+        for stream_name, messages in response or []:
+            for message_id, fields in messages:
+                return self._delivery(stream_name, message_id, fields)
+
+        return None
+
+    async def read(self, consumer: str, streams: Optional[List[str]] = None,
+                   block_ms: int = 5000) -> Optional[Delivery]:
+        """Attende il primo job disponibile su tutti gli stream"""
+
+        streams = streams or list(await self.streams())
+        await self.ensure_groups(streams)
+
+        response = await self.client.xreadgroup(
+            CONSUMER_GROUP, consumer, {stream: ">" for stream in streams},
+            count=1, block=block_ms
+        )
+
+        for stream, messages in response or []:
+            for message_id, fields in messages:
+                return self._delivery(stream, message_id, fields)
+
+        return None
+
+    async def reclaim(self, consumer: str) -> Tuple[Optional[Delivery], List[Delivery]]:
+        """Riassegna al consumer un job di un worker che non rinnova più il lease
+
+        Ritorna (job da rielaborare o None, job spostati nel dead-letter).
+        Un solo job alla volta: quelli non ancora riassegnati restano
+        disponibili per gli altri worker.
+        """
+
+        streams = list(await self.streams())
+        await self.ensure_groups(streams)
+
+        dead: List[Delivery] = []
+
+        for stream in streams:
+            start_id = "0-0"
+            while True:
+                result = await self.client.xautoclaim(
+                    stream, CONSUMER_GROUP, consumer,
+                    min_idle_time=VISIBILITY_TIMEOUT * 1000, start_id=start_id, count=1
+                )
+                next_id, messages = result[0], result[1]
+                if not messages:
+                    break
+
+                message_id, fields = messages[0]
+                if not fields:
+                    # Voce già eliminata dallo stream: resta solo il riferimento pendente
+                    await self.client.xack(stream, CONSUMER_GROUP, message_id)
+                else:
+                    delivery = self._delivery(stream, message_id, fields)
+                    delivery.deliveries = await self._delivery_count(stream, message_id)
+
+                    if delivery.deliveries <= MAX_DELIVERIES:
+                        logger.warning(
+                            f"Job riassegnato: {delivery.job.get('job_id')} "
+                            f"(consegna {delivery.deliveries}/{MAX_DELIVERIES})"
+                        )
+                        return delivery, dead
+
+                    await self.dead_letter(
+                        delivery, f"Consegne esaurite ({MAX_DELIVERIES}) senza conferma"
+                    )
+                    dead.append(delivery)
+
+                if next_id in (b"0-0", "0-0"):
+                    break
+                start_id = next_id
+
+        return None, dead
+
+    async def prune_idle_streams(self) -> int:
+        """Elimina gli stream dei tenant vuoti e inattivi da IDLE_STREAM_TTL
+
+        Uno stream viene rimosso (con la voce del registro) solo se non ha job
+        in coda né pendenti; un accodamento concorrente annulla la transazione
+        e lo stream resta. Ritorna il numero di stream eliminati.
+        """
+
+        cutoff = time.time() - IDLE_STREAM_TTL
+        pruned = 0
+
+        for stream, info in (await self.streams()).items():
+            if stream in QUEUES.values() or info.get("enqueued_at", 0) > cutoff:
+                continue
+
+            async with self.client.pipeline(transaction=True) as pipe:
+                try:
+                    await pipe.watch(stream)
+                    if await pipe.xlen(stream):
+                        continue
+                    if await pipe.exists(stream):
+                        if (await pipe.xpending(stream, CONSUMER_GROUP))["pending"]:
+                            continue
+
+                    pipe.multi()
+                    pipe.delete(stream)
+                    pipe.hdel(STREAMS_REGISTRY, stream)
+                    await pipe.execute()
+                except WatchError:
+                    continue
+
+            self._ready_streams.discard(stream)
+            pruned += 1
+
+        if pruned:
+            logger.info(f"Eliminati {pruned} stream di tenant inattivi")
+
+        return pruned
+
+    async def extend(self, delivery: Delivery, consumer: str):
+        """Rinnova il lease di un job in elaborazione (azzera il tempo di inattività)"""
+
+        await self.client.xclaim(
+            delivery.stream, CONSUMER_GROUP, consumer, 0, [delivery.message_id], justid=True
+        )
+
+    async def ack(self, delivery: Delivery):
+        """Conferma un job completato e lo rimuove dallo stream"""
+
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.xack(delivery.stream, CONSUMER_GROUP, delivery.message_id)
+            pipe.xdel(delivery.stream, delivery.message_id)
+            await pipe.execute()
+
+    async def requeue(self, delivery: Delivery, reason: str) -> Dict:
+        """Riaccoda un job interrotto (es. drain del worker) per un altro consumer
+
+        La nuova voce e la conferma della precedente sono atomiche: il job non
+        può andare perso né risultare due volte in coda.
+        """
+
+        job = {
+            **delivery.job,
+            "handoffs": int(delivery.job.get("handoffs", 0)) + 1,
+            "handoff_reason": reason,
+            "requeued_at": time.time()
+        }
+
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.xadd(delivery.stream, {"job": json.dumps(job)})
+            pipe.xack(delivery.stream, CONSUMER_GROUP, delivery.message_id)
+            pipe.xdel(delivery.stream, delivery.message_id)
+            await pipe.execute()
+
+        logger.info(f"Job riaccodato: {job['job_id']} ({reason}, passaggio {job['handoffs']})")
+        return job
+
+    async def dead_letter(self, delivery: Delivery, reason: str):
+        """Sposta un job nello stream dead-letter e lo conferma"""
+
+        await self.client.xadd(DEAD_LETTER_STREAM, {
+            "job": json.dumps(delivery.job),
+            "reason": reason,
+            "source": delivery.stream,
+            "deliveries": delivery.deliveries,
+            "failed_at": time.time()
+        })
+        await self.ack(delivery)
+
+        logger.error(f"Job in dead-letter: {delivery.job.get('job_id')} ({reason})")
+
+    async def remove_consumer(self, consumer: str):
+        """Rimuove il consumer dal gruppo se non ha job pendenti (arresto pulito)"""
+
+        streams = list(await self.streams())
+        await self.ensure_groups(streams)
+
+        for stream in streams:
+            pending = await self.client.xpending_range(
+                stream, CONSUMER_GROUP, min="-", max="+", count=1, consumername=consumer
+            )
+            if not pending:
+                await self.client.xgroup_delconsumer(stream, CONSUMER_GROUP, consumer)
+
+    async def migrate_legacy_lists(self) -> int:
+        """Sposta negli stream i job rimasti nelle liste della versione precedente"""
+
+        migrated = 0
+        for priority, legacy in LEGACY_QUEUES.items():
+            while True:
+                job_json = await self.client.lpop(legacy)
+                if job_json is None:
+                    break
+                await self.enqueue(json.loads(job_json), priority)
+                migrated += 1
+
+        if migrated:
+            logger.info(f"Migrati {migrated} job dalle code legacy")
+
+        return migrated
+
+    async def _delivery_count(self, stream: str, message_id) -> int:
+        entries = await self.client.xpending_range(
+            stream, CONSUMER_GROUP, min=message_id, max=message_id, count=1
+        )
+        return entries[0]["times_delivered"] if entries else 1
+
+    @staticmethod
+    def _delivery(stream, message_id, fields: Dict) -> Delivery:
+        if isinstance(stream, bytes):
+            stream = stream.decode()
+        if isinstance(message_id, bytes):
+            message_id = message_id.decode()
+
+        job_json = fields.get(b"job", fields.get("job"))
+
+        return Delivery(stream=stream, message_id=message_id, job=json.loads(job_json))
@@ -0,0 +1,175 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Fasi della pipeline di separazione
+PIPELINE_STAGES = [
+    "decode", "analysis", "separation", "derived_stems",
+    "post_process", "quality", "export", "save", "peaks"
+]
+
+# Bucket da decimi di secondo a diversi minuti (inferenza su CPU)
+_DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+
+STAGE_DURATION = Histogram(
+    "musicai_stage_duration_seconds",
+    "Durata delle fasi della pipeline",
+    ["stage"],
+    buckets=_DURATION_BUCKETS
+)
+
+JOB_DURATION = Histogram(
+    "musicai_job_duration_seconds",
+    "Durata totale dei job",
+    ["type"],
+    buckets=_DURATION_BUCKETS
+)
+
+JOBS_TOTAL = Counter(
+    "musicai_jobs_processed_total",
+    "Job elaborati per tipo ed esito",
+    ["type", "status"]
+)
+
+JOBS_KILLED = Counter(
+    "musicai_jobs_killed_total",
+    "Job terminati dal watchdog del worker per motivo (deadline, stalled, memory)",
+    ["type", "reason"]
+)
+
+ACTIVE_JOBS = Gauge(
+    "musicai_active_jobs_total",
+    "Job attualmente in elaborazione"
+)
+
+QUEUE_LENGTH = Gauge(
+    "musicai_queue_length_total",
+    "Job in attesa per coda",
+    ["queue"]
+)
+
+WORKERS_LIVE = Gauge(
+    "musicai_workers_live",
+    "Worker attivi con heartbeat recente"
+)
+
+WORKERS_DESIRED = Gauge(
+    "musicai_workers_desired",
+    "Worker necessari per l'attesa in coda obiettivo (segnale di autoscaling)"
+)
+
+CLUSTER_THROUGHPUT = Gauge(
+    "musicai_cluster_throughput_audio_seconds",
+    "Secondi di audio separati al secondo dal cluster (finestra mobile)"
+)
+
+QUEUE_OLDEST_WAIT = Gauge(
+    "musicai_queue_oldest_wait_seconds",
+    "Attesa del job più vecchio non ancora consegnato"
+)
+
+STARTUP_DURATION = Gauge(
+    "musicai_startup_duration_seconds",
+    "Durata avvio del processo per fase (import, startup, model_load)",
+    ["phase"]
+)
+
+EVENT_LOOP_LAG = Histogram(
+    "musicai_event_loop_lag_seconds",
+    "Ritardo dell'event loop rispetto al risveglio programmato",
+    ["process"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+HEARTBEAT_AGE = Gauge(
+    "musicai_worker_heartbeat_age_seconds",
+    "Secondi trascorsi dall'ultimo heartbeat riuscito del worker"
+)
+
+QUEUE_WAIT = Histogram(
+    "musicai_queue_wait_seconds",
+    "Attesa in coda prima dell'elaborazione",
+    ["queue"],
+    buckets=_DURATION_BUCKETS
+)
+
+REALTIME_FACTOR = Histogram(
+    "musicai_realtime_factor",
+    "Tempo di elaborazione / durata audio",
+    ["type"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10)
+)
+
+DISK_USAGE = Gauge(
+    "musicai_temp_disk_usage_ratio",
+    "Frazione del disco dei file temporanei in uso"
+)
+
+SESSIONS_REMOVED = Counter(
+    "musicai_sessions_removed_total",
+    "Sessioni rimosse dal disco per motivo (expired, disk_pressure)",
+    ["reason"]
+)
+
+BYTES_READ = Counter(
+    "musicai_bytes_read_total",
+    "Byte letti da disco per fase",
+    ["stage"]
+)
+
+BYTES_WRITTEN = Counter(
+    "musicai_bytes_written_total",
+    "Byte scritti su disco per fase",
+    ["stage"]
+)
+
+CACHE_REQUESTS = Counter(
+    "musicai_cache_requests_total",
+    "Accessi alle cache (hit/miss)",
+    ["cache", "result"]
+)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "musicai_http_request_duration_seconds",
+    "Latenza richieste HTTP",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+@contextmanager
+def stage_timer(stage: str):
+    """Misura la durata di una fase della pipeline"""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.labels(stage=stage).observe(time.perf_counter() - start)
+
+def record_cache(cache: str, hit: bool):
+    """Registra hit/miss di una cache"""
+
+    CACHE_REQUESTS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+def record_bytes(direction: str, stage: str, size: int):
+    """Registra byte letti ("read") o scritti ("write") da una fase"""
+
+    counter = BYTES_READ if direction == "read" else BYTES_WRITTEN
+    counter.labels(stage=stage).inc(max(0, int(size)))
+
+def record_file_bytes(direction: str, stage: str, *paths):
+    """Registra la dimensione dei file indicati"""
+
+    total = 0
+    for path in paths:
+        try:
+            total += os.path.getsize(str(path))
+        except OSError:
+            continue
+
+    record_bytes(direction, stage, total)
@@ -0,0 +1,280 @@
+import logging
+import math
+import struct
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import soundfile as sf
+from numpy.lib.stride_tricks import sliding_window_view
+
+logger = logging.getLogger(__name__)
+
+# Bit per campione dei formati supportati in uscita
+_SUBTYPE_BITS = {"PCM_16": 16, "PCM_24": 24, "FLOAT": 32}
+
+def build_mix_tracks(stems: Dict[str, str], options: Dict) -> List[Dict]:
+    """Costruisce la lista tracce per il mixer da stems e opzioni per-stem"""
+
+    gains = options.get("stem_gains", {})
+    pans = options.get("stem_pans", {})
+    offsets = options.get("stem_offsets", {})
+
+    return [
+        {
+            "path": stem_path,
+            "gain_db": float(gains.get(stem_name, 0.0)),
+            "pan": float(pans.get(stem_name, 0.0)),
+            "offset": float(offsets.get(stem_name, 0.0))
+        }
+        for stem_name, stem_path in stems.items()
+        if stem_path
+    ]
+
+class StreamingMixer:
+    """Mixer a blocchi: combina stems con memoria costante e limiter look-ahead"""
+
+    def __init__(self, block_size: int = 65536, ceiling: float = 0.95,
+                 lookahead_ms: float = 5.0, release_ms: float = 80.0):
+        self.block_size = block_size
+        self.ceiling = ceiling
+        self.lookahead_ms = lookahead_ms
+        self.release_ms = release_ms
+
+    def mix_to_file(self, tracks: List[Dict], output_path: str, subtype: str = "FLOAT") -> str:
+        """Mixa le tracce scrivendo il risultato su disco blocco per blocco
+
+        Ogni traccia è un dict con chiavi: path, gain_db, pan (-1..1), offset (secondi)
+        """
+
+        sources, sample_rate, total_frames = self._open_sources(tracks)
+
+        try:
+            output_path = Path(output_path)
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+
+            with sf.SoundFile(str(output_path), 'w', samplerate=sample_rate,
+                              channels=2, subtype=subtype, format="WAV") as out:
+                for block in self._iter_mixed_blocks(sources, sample_rate, total_frames):
+                    out.write(block)
+
+            logger.info(f"Mixdown completato: {output_path} ({total_frames} frames)")
+            return str(output_path)
+
+        finally:
+            self._close_sources(sources)
+
+    def iter_wav(self, tracks: List[Dict], subtype: str = "PCM_16") -> Iterator[bytes]:
+        """Genera il mix come stream WAV (header + blocchi PCM) per risposte HTTP"""
+
+        sources, sample_rate, total_frames = self._open_sources(tracks)
+
+        try:
+            yield self._wav_header(sample_rate, 2, total_frames, subtype)
+
+            for block in self._iter_mixed_blocks(sources, sample_rate, total_frames):
+                yield self._encode_pcm(block, subtype)
+
+        finally:
+            self._close_sources(sources)
+
+    def _open_sources(self, tracks: List[Dict]):
+        """Apre gli stems in lettura a blocchi e calcola durata del mix"""
+
+        sources = []
+        sample_rate = None
+        total_frames = 0
+
+        try:
+            for track in tracks:
+                path = track.get("path")
+                if not path or not Path(path).exists():
+                    continue
+
+                handle = sf.SoundFile(path, 'r')
+
+                if sample_rate is None:
+                    sample_rate = handle.samplerate
+                elif handle.samplerate != sample_rate:
+                    handle.close()
+                    raise ValueError(f"Sample rate non coerente per {path}: "
+                                     f"{handle.samplerate} != {sample_rate}")
+
+                offset_frames = max(0, int(round(track.get("offset", 0.0) * sample_rate)))
+                left_gain, right_gain = self._pan_gains(
+                    track.get("pan", 0.0), handle.channels
+                )
+                gain = 10 ** (track.get("gain_db", 0.0) / 20)
+
+                sources.append({
+                    "handle": handle,
+                    "offset": offset_frames,
+                    "frames": handle.frames,
+                    "gains": np.array([left_gain * gain, right_gain * gain], dtype=np.float32)
+                })
+
+                total_frames = max(total_frames, offset_frames + handle.frames)
+
+        except Exception:
+            self._close_sources(sources)
+            raise
+
+        if not sources:
+            raise ValueError("Nessun stem valido trovato per il mix")
+
+        return sources, sample_rate, total_frames
+
+    @staticmethod
+    def _close_sources(sources: List[Dict]):
+        for source in sources:
+            try:
+                source["handle"].close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _pan_gains(pan: float, channels: int):
+        """Guadagni L/R a potenza costante"""
+
+        pan = max(-1.0, min(1.0, float(pan)))
+        angle = (pan + 1) * math.pi / 4
+        left, right = math.cos(angle), math.sin(angle)
+
+        # Per sorgenti stereo il pan è un bilanciamento: unitario al centro
+        if channels >= 2:
+            left, right = left * math.sqrt(2), right * math.sqrt(2)
+
+        return left, right
+
+    def _read_block(self, source: Dict, start: int, frames: int) -> Optional[np.ndarray]:
+        """Legge la porzione di uno stem che cade nel blocco [start, start + frames)"""
+
+        begin = max(start, source["offset"])
+        end = min(start + frames, source["offset"] + source["frames"])
+
+        if begin >= end:
+            return None
+
+        handle = source["handle"]
+        position = begin - source["offset"]
+        if handle.tell() != position:
+            handle.seek(position)
+
+        data = handle.read(end - begin, dtype='float32', always_2d=True)
+
+        # Mono -> stereo, multicanale -> primi due canali
+        if data.shape[1] == 1:
+            data = np.repeat(data, 2, axis=1)
+        elif data.shape[1] > 2:
+            data = data[:, :2]
+
+        block = np.zeros((frames, 2), dtype=np.float32)
+        block[begin - start:begin - start + len(data)] = data * source["gains"]
+
+        return block
+
+    def _iter_mixed_blocks(self, sources: List[Dict], sample_rate: int,
+                           total_frames: int) -> Iterator[np.ndarray]:
+        """Somma gli stems blocco per blocco e applica il limiter in un unico passaggio"""
+
+        lookahead = max(1, int(sample_rate * self.lookahead_ms / 1000))
+        release_samples = max(1.0, sample_rate * self.release_ms / 1000)
+
+        # Stato del limiter tra un blocco e l'altro
+        delay_line = np.zeros((lookahead, 2), dtype=np.float32)
+        gain_history = np.ones(lookahead, dtype=np.float64)
+        reduction = 0.0
+        to_skip = lookahead
+
+        position = 0
+        while position < total_frames + lookahead:
+            frames = min(self.block_size, total_frames + lookahead - position)
+
+            mixed = np.zeros((frames, 2), dtype=np.float32)
+            if position < total_frames:
+                for source in sources:
+                    block = self._read_block(source, position, frames)
+                    if block is not None:
+                        mixed += block
+
+            limited, delay_line, gain_history, reduction = self._limit_block(
+                mixed, delay_line, gain_history, reduction, release_samples
+            )
+
+            # Il primo tratto in uscita è il ritardo iniziale del look-ahead
+            if to_skip:
+                skipped = min(to_skip, len(limited))
+                limited = limited[skipped:]
+                to_skip -= skipped
+
+            if len(limited):
+                yield limited
+
+            position += frames
+
+    def _limit_block(self, block: np.ndarray, delay_line: np.ndarray,
+                     gain_history: np.ndarray, reduction: float, release_samples: float):
+        """Limiter look-ahead: attacco istantaneo sul picco futuro, rilascio esponenziale"""
+
+        lookahead = len(delay_line)
+        frames = len(block)
+
+        # Guadagno necessario per ogni campione in ingresso
+        peaks = np.max(np.abs(block), axis=1).astype(np.float64)
+        required = np.minimum(1.0, self.ceiling / np.maximum(peaks, 1e-12))
+
+        # Minimo sulla finestra di look-ahead (campioni ritardati + nuovi)
+        window = np.concatenate([gain_history, required])
+        target = sliding_window_view(window, lookahead + 1).min(axis=1)[:frames]
+
+        # Rilascio: inviluppo della riduzione con decadimento esponenziale,
+        # calcolato in forma vettoriale nel dominio logaritmico
+        decay = 1.0 / release_samples
+        index = np.arange(frames, dtype=np.float64)
+        with np.errstate(divide='ignore'):
+            log_reduction = np.log(1.0 - target) + index * decay
+            carried = math.log(reduction) - decay if reduction > 0 else -np.inf
+        envelope = np.exp(np.maximum(np.maximum.accumulate(log_reduction), carried) - index * decay)
+        gains = 1.0 - envelope
+
+        delayed = np.concatenate([delay_line, block])
+        output = delayed[:frames] * gains[:, None].astype(np.float32)
+        np.clip(output, -self.ceiling, self.ceiling, out=output)
+
+        return (
+            output,
+            delayed[frames:],
+            window[frames:],
+            float(envelope[-1]) if frames else reduction
+        )
+
+    @staticmethod
+    def _wav_header(sample_rate: int, channels: int, frames: int, subtype: str) -> bytes:
+        """Header RIFF/WAVE con dimensioni note in anticipo"""
+
+        bits = _SUBTYPE_BITS[subtype]
+        audio_format = 3 if subtype == "FLOAT" else 1
+        block_align = channels * bits // 8
+        data_size = frames * block_align
+
+        return struct.pack(
+            '<4sI4s4sIHHIIHH4sI',
+            b'RIFF', 36 + data_size, b'WAVE',
+            b'fmt ', 16, audio_format, channels, sample_rate,
+            sample_rate * block_align, block_align, bits,
+            b'data', data_size
+        )
+
+    @staticmethod
+    def _encode_pcm(block: np.ndarray, subtype: str) -> bytes:
+        """Converte un blocco float in PCM little-endian"""
+
+        if subtype == "FLOAT":
+            return block.astype('<f4').tobytes()
+
+        if subtype == "PCM_16":
+            return (np.clip(block, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+        # PCM_24: tre byte meno significativi di un intero a 32 bit
+        samples = (np.clip(block, -1.0, 1.0) * 8388607).astype('<i4')
+        return samples.reshape(-1, 1).view(np.uint8)[:, :3].tobytes()
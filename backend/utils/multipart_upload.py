@@ -0,0 +1,122 @@
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+
+import multipart
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import parse_options_header
+
+logger = logging.getLogger(__name__)
+
+class MultipartUploadError(ValueError):
+    """Richiesta multipart non valida (400)"""
+
+class MultipartFileReceiver:
+    """Parsing multipart in streaming: ogni file è scritto mentre arriva
+
+    A differenza di UploadFile/File(...) il corpo non viene accumulato su un
+    file temporaneo prima dell'handler: i blocchi di ogni parte sono passati
+    subito al writer restituito da open_file(filename), quindi un limite di
+    dimensione o un formato non valido interrompono la ricezione al primo
+    blocco in eccesso. Campi non file sono ignorati.
+
+    open_file(filename) ritorna un writer con write(chunk), close() -> risultato
+    e abort(); receive() ritorna i risultati nell'ordine delle parti.
+    """
+
+    def __init__(self, content_type: Optional[str], open_file: Callable[[str], Awaitable[Any]],
+                 max_files: int):
+        _, params = parse_options_header(content_type or "")
+        boundary = params.get(b"boundary")
+        if not boundary:
+            raise MultipartUploadError("Richiesta multipart/form-data senza boundary")
+
+        self.open_file = open_file
+        self.max_files = max_files
+
+        # Eventi del parser (sincrono) elaborati dopo ogni blocco ricevuto
+        self._events: List[Tuple[str, bytes]] = []
+        self._header_field = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._finished = False
+
+        self._parser = multipart.MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": lambda data, start, end: self._events.append(("data", data[start:end])),
+            "on_part_end": lambda: self._events.append(("end", b"")),
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": lambda: self._events.append(("headers", self._disposition)),
+            "on_end": self._on_end
+        })
+
+    def _on_part_begin(self):
+        self._disposition = b""
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        if self._header_field.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_end(self):
+        self._finished = True
+
+    async def receive(self, stream: AsyncIterator[bytes]) -> List[Any]:
+        results = []
+        writer = None
+        files = 0
+
+        try:
+            async for chunk in stream:
+                try:
+                    self._parser.write(chunk)
+                except MultipartParseError as e:
+                    raise MultipartUploadError(f"Richiesta multipart non valida: {str(e)}")
+
+                events, self._events = self._events, []
+                for event, data in events:
+                    if event == "headers":
+                        _, options = parse_options_header(data)
+                        if b"filename" not in options:
+                            writer = None
+                            continue
+
+                        files += 1
+                        if files > self.max_files:
+                            raise MultipartUploadError(
+                                f"Troppi file nella richiesta. Massimo: {self.max_files}"
+                            )
+                        writer = await self.open_file(options[b"filename"].decode("utf-8", "replace"))
+
+                    elif event == "data" and writer is not None:
+                        await writer.write(data)
+
+                    elif event == "end" and writer is not None:
+                        current, writer = writer, None
+                        results.append(await current.close())
+
+            try:
+                self._parser.finalize()
+            except MultipartParseError as e:
+                raise MultipartUploadError(f"Richiesta multipart non valida: {str(e)}")
+
+        except Exception:
+            if writer is not None:
+                await writer.abort()
+            raise
+
+        # Corpo troncato (client disconnesso o Content-Length falso)
+        if writer is not None or not self._finished:
+            if writer is not None:
+                await writer.abort()
+            raise MultipartUploadError("Richiesta multipart incompleta")
+
+        return results
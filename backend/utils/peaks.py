@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import os
+import struct
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+
+from utils.metrics import record_bytes, stage_timer
+
+logger = logging.getLogger(__name__)
+
+# File piramide (accanto allo stem): header, tabella livelli, coppie min/max int16
+PEAKS_MAGIC = b"MPKS"
+PEAKS_VERSION = 1
+_FILE_HEADER = struct.Struct("<4sHHIQII")     # magic, versione, livelli, sr, frames, spp base, fattore
+_LEVEL_ENTRY = struct.Struct("<IIQ")          # campioni per picco, numero picchi, offset dati
+
+# Risposta HTTP: header fisso seguito da count coppie (min, max) int16
+RESPONSE_MAGIC = b"MPKR"
+_RESPONSE_HEADER = struct.Struct("<4sHHIQIQI")  # magic, versione, riservato, sr, frames, spp, frame iniziale, count
+
+# Livello più fine e riduzione tra livelli consecutivi
+BASE_SAMPLES_PER_PEAK = 256
+LEVEL_FACTOR = 4
+MAX_LEVELS = 8
+
+# Limite di punti per richiesta (circa la larghezza di uno schermo 4K x2)
+MAX_PEAKS_PER_REQUEST = 16384
+
+_READ_BLOCK = BASE_SAMPLES_PER_PEAK * 1024
+
+def peaks_path(stem_path: str) -> Path:
+    return Path(stem_path).with_suffix(".peaks")
+
+def _quantize(values: np.ndarray) -> np.ndarray:
+    return np.round(np.clip(values, -1.0, 1.0) * 32767).astype('<i2')
+
+def _block_peaks(samples: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Min/max per gruppi di BASE_SAMPLES_PER_PEAK campioni (canali uniti)"""
+
+    if samples.ndim == 2:
+        low_source, high_source = samples.min(axis=1), samples.max(axis=1)
+    else:
+        low_source = high_source = samples
+
+    full = len(samples) // BASE_SAMPLES_PER_PEAK * BASE_SAMPLES_PER_PEAK
+    lows = [low_source[:full].reshape(-1, BASE_SAMPLES_PER_PEAK).min(axis=1)]
+    highs = [high_source[:full].reshape(-1, BASE_SAMPLES_PER_PEAK).max(axis=1)]
+
+    if full < len(samples):
+        lows.append(low_source[full:].min(keepdims=True))
+        highs.append(high_source[full:].max(keepdims=True))
+
+    return np.concatenate(lows), np.concatenate(highs)
+
+def _reduce(lows: np.ndarray, highs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Livello successivo: un picco ogni LEVEL_FACTOR del livello corrente"""
+
+    pad = (-len(lows)) % LEVEL_FACTOR
+    if pad:
+        lows = np.concatenate([lows, np.full(pad, lows[-1])])
+        highs = np.concatenate([highs, np.full(pad, highs[-1])])
+
+    return (
+        lows.reshape(-1, LEVEL_FACTOR).min(axis=1),
+        highs.reshape(-1, LEVEL_FACTOR).max(axis=1)
+    )
+
+def _encode_pyramid(lows: np.ndarray, highs: np.ndarray, sample_rate: int,
+                    total_frames: int) -> bytes:
+    """Serializza tutti i livelli a partire dal più fine"""
+
+    levels: List[bytes] = []
+    samples_per_peak = BASE_SAMPLES_PER_PEAK
+
+    while True:
+        pairs = np.empty(len(lows) * 2, dtype='<i2')
+        pairs[0::2] = _quantize(lows)
+        pairs[1::2] = _quantize(highs)
+        levels.append((samples_per_peak, len(lows), pairs.tobytes()))
+
+        if len(lows) <= 1 or len(levels) >= MAX_LEVELS:
+            break
+
+        lows, highs = _reduce(lows, highs)
+        samples_per_peak *= LEVEL_FACTOR
+
+    header = _FILE_HEADER.pack(
+        PEAKS_MAGIC, PEAKS_VERSION, len(levels), sample_rate, total_frames,
+        BASE_SAMPLES_PER_PEAK, LEVEL_FACTOR
+    )
+
+    offset = _FILE_HEADER.size + _LEVEL_ENTRY.size * len(levels)
+    table = b""
+    for spp, count, data in levels:
+        table += _LEVEL_ENTRY.pack(spp, count, offset)
+        offset += len(data)
+
+    return header + table + b"".join(data for _, _, data in levels)
+
+def _write_atomic(path: Path, payload: bytes):
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        tmp_path.replace(path)
+    except Exception:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+
+    record_bytes("write", "peaks", len(payload))
+
+class WaveformPeaks:
+    """Piramidi min/max multi-risoluzione per il disegno rapido delle waveform"""
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def build_from_array(self, stem_path: str, samples: np.ndarray, sample_rate: int) -> str:
+        """Piramide da audio già in memoria (durante il salvataggio dello stem)"""
+
+        with stage_timer("peaks"):
+            samples = np.asarray(samples, dtype=np.float32)
+            # Layout (canali, campioni) come torchaudio -> (campioni, canali)
+            if samples.ndim == 2 and samples.shape[0] < samples.shape[1]:
+                samples = samples.T
+
+            lows, highs = _block_peaks(samples)
+            payload = _encode_pyramid(lows, highs, sample_rate, len(samples))
+
+            path = peaks_path(stem_path)
+            _write_atomic(path, payload)
+
+        return str(path)
+
+    def build_from_file(self, stem_path: str) -> str:
+        """Piramide leggendo lo stem a blocchi (memoria costante)"""
+
+        with stage_timer("peaks"):
+            lows, highs = [], []
+
+            with sf.SoundFile(stem_path, 'r') as handle:
+                sample_rate, total_frames = handle.samplerate, handle.frames
+                for block in handle.blocks(blocksize=_READ_BLOCK, dtype='float32', always_2d=True):
+                    block_lows, block_highs = _block_peaks(block)
+                    lows.append(block_lows)
+                    highs.append(block_highs)
+
+            record_bytes("read", "peaks", os.path.getsize(stem_path))
+
+            if not lows:
+                lows, highs = [np.zeros(1, dtype=np.float32)], [np.zeros(1, dtype=np.float32)]
+
+            payload = _encode_pyramid(
+                np.concatenate(lows), np.concatenate(highs), sample_rate, total_frames
+            )
+
+            path = peaks_path(stem_path)
+            _write_atomic(path, payload)
+
+        return str(path)
+
+    async def ensure(self, stem_path: str) -> str:
+        """Percorso della piramide, generata al volo se mancante (una sola volta)"""
+
+        path = peaks_path(stem_path)
+        if path.exists():
+            return str(path)
+
+        lock = self._locks.setdefault(str(path), asyncio.Lock())
+        async with lock:
+            if not path.exists():
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, self.build_from_file, stem_path)
+            self._locks.pop(str(path), None)
+
+        return str(path)
+
+    def read_range(self, stem_path: str, start: float = 0.0, end: Optional[float] = None,
+                   width: int = 1000) -> bytes:
+        """Picchi dell'intervallo [start, end) in secondi con circa width punti
+
+        Sceglie il livello più grossolano che fornisce almeno width punti e
+        legge dal file solo la porzione richiesta.
+        """
+
+        width = max(1, min(int(width), MAX_PEAKS_PER_REQUEST))
+
+        with open(peaks_path(stem_path), 'rb') as f:
+            magic, version, level_count, sample_rate, total_frames, _, _ = \
+                _FILE_HEADER.unpack(f.read(_FILE_HEADER.size))
+
+            if magic != PEAKS_MAGIC or version != PEAKS_VERSION:
+                raise ValueError("Formato piramide non supportato")
+
+            levels = [
+                _LEVEL_ENTRY.unpack(f.read(_LEVEL_ENTRY.size))
+                for _ in range(level_count)
+            ]
+
+            start_frame = max(0, int(start * sample_rate))
+            end_frame = total_frames if end is None else min(total_frames, int(end * sample_rate))
+            if end_frame <= start_frame:
+                raise ValueError("Intervallo non valido")
+
+            wanted = (end_frame - start_frame) / width
+            samples_per_peak, count, offset = levels[0]
+            for level in levels[1:]:
+                if level[0] > wanted:
+                    break
+                samples_per_peak, count, offset = level
+
+            first = start_frame // samples_per_peak
+            last = min(count, -(-end_frame // samples_per_peak))
+
+            f.seek(offset + first * 4)
+            data = f.read((last - first) * 4)
+
+        header = _RESPONSE_HEADER.pack(
+            RESPONSE_MAGIC, PEAKS_VERSION, 0, sample_rate, total_frames,
+            samples_per_peak, first * samples_per_peak, len(data) // 4
+        )
+
+        return header + data
@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from utils.job_queue import JobQueue, Delivery
+
+logger = logging.getLogger(__name__)
+
+# Pesi delle classi di priorità e dei tenant (client_id come nei log, JSON)
+PRIORITY_WEIGHTS: Dict[str, float] = json.loads(
+    os.getenv("SCHEDULER_PRIORITY_WEIGHTS", '{"priority": 4, "normal": 1}')
+)
+TENANT_WEIGHTS: Dict[str, float] = json.loads(os.getenv("SCHEDULER_TENANT_WEIGHTS", "{}"))
+
+# Aging: riduzione del tag virtuale per secondo di attesa in testa alla coda
+# (in unità di costo di un job; 1/60 = un job "guadagnato" ogni minuto)
+AGING_RATE = float(os.getenv("SCHEDULER_AGING_RATE", str(1 / 60)))
+
+# Costo proporzionale alla durata attesa (shortest job first tra le teste delle code)
+SHORTEST_JOB_FIRST = os.getenv("SCHEDULER_SJF", "false").lower() == "true"
+REFERENCE_DURATION = float(os.getenv("SCHEDULER_REFERENCE_DURATION", "180"))
+
+# Tag di inizio per stream e orologio virtuale globale (condivisi tra i worker)
+VTIME_KEY = "sched:separation:vtime"
+VCLOCK_KEY = "sched:separation:vclock"
+
+class FairScheduler:
+    """Weighted fair queuing tra classi di priorità e tenant, con aging
+
+    Ogni stream (priorità, tenant) è un flusso con tempo virtuale proprio:
+    servire un job lo avanza di costo / peso. Tra le teste delle code vince
+    il tag di fine più basso, ridotto in proporzione all'attesa, così nessun
+    flusso resta fermo a lungo anche sotto carico prioritario costante.
+    Se tutte le code sono vuote il worker attende su tutti gli stream insieme.
+    """
+
+    def __init__(self, job_queue: JobQueue):
+        self.job_queue = job_queue
+        self.client = job_queue.client
+
+    @staticmethod
+    def weight(info: Dict) -> float:
+        return (
+            float(PRIORITY_WEIGHTS.get(info["priority"], 1.0))
+            * float(TENANT_WEIGHTS.get(info["tenant"], 1.0))
+        )
+
+    @staticmethod
+    def cost(job: Dict) -> float:
+        """Costo di un job in unità di "job standard" """
+
+        if not SHORTEST_JOB_FIRST:
+            return 1.0
+
+        duration = job.get("expected_duration")
+        if not duration:
+            return 1.0
+
+        return max(0.1, float(duration) / REFERENCE_DURATION)
+
+    async def next(self, consumer: str, block_ms: int = 5000) -> Optional[Delivery]:
+        """Consegna al consumer il job con priorità di servizio più alta"""
+
+        streams = await self.job_queue.streams()
+        heads = await self.job_queue.heads(list(streams))
+
+        if not heads:
+            # Nessun job in attesa: blocca su tutti gli stream contemporaneamente
+            delivery = await self.job_queue.read(consumer, list(streams), block_ms)
+            if delivery is not None:
+                vclock, _ = await self._virtual_times()
+                await self._account(delivery, streams, vclock)
+            return delivery
+
+        vclock, tags = await self._virtual_times()
+        await self._refresh_tags(heads, vclock, tags)
+        now = time.time()
+
+        def score(head: Delivery) -> float:
+            finish = tags[head.stream] + self.cost(head.job) / self.weight(streams[head.stream])
+            # L'id dello stream contiene il timestamp di accodamento in ms
+            waited = max(0.0, now - int(head.message_id.split("-")[0]) / 1000)
+            return finish - AGING_RATE * waited
+
+        for head in sorted(heads, key=score):
+            # Un altro worker può aver preso la stessa testa: si passa alla successiva
+            delivery = await self.job_queue.read_stream(consumer, head.stream)
+            if delivery is not None:
+                await self._account(delivery, streams, tags[head.stream])
+                return delivery
+
+        return None
+
+    async def _virtual_times(self):
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.get(VCLOCK_KEY)
+            pipe.hgetall(VTIME_KEY)
+            vclock, tags = await pipe.execute()
+
+        return (
+            float(vclock or 0.0),
+            {
+                (stream.decode() if isinstance(stream, bytes) else stream): float(value)
+                for stream, value in tags.items()
+            }
+        )
+
+    async def _refresh_tags(self, heads: List[Delivery], vclock: float, tags: Dict[str, float]):
+        """Tag di inizio dei flussi: fissato quando il flusso diventa attivo
+
+        Un flusso che torna ad avere job parte dall'orologio globale (nessun
+        credito accumulato da fermo); un flusso senza job perde il proprio tag.
+        """
+
+        backlogged = {head.stream for head in heads}
+        new_tags = {stream: vclock for stream in backlogged if stream not in tags}
+        idle = [stream for stream in tags if stream not in backlogged]
+
+        if not new_tags and not idle:
+            return
+
+        async with self.client.pipeline(transaction=False) as pipe:
+            for stream, tag in new_tags.items():
+                pipe.hsetnx(VTIME_KEY, stream, tag)
+            if idle:
+                pipe.hdel(VTIME_KEY, *idle)
+            await pipe.execute()
+
+        tags.update(new_tags)
+        for stream in idle:
+            tags.pop(stream, None)
+
+    async def _account(self, delivery: Delivery, streams: Dict[str, Dict], start: float):
+        """Avanza il tag del flusso servito e l'orologio virtuale globale"""
+
+        info = streams.get(delivery.stream, {"priority": "normal", "tenant": "default"})
+        finish = start + self.cost(delivery.job) / self.weight(info)
+
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.hset(VTIME_KEY, delivery.stream, finish)
+            # L'orologio globale segue il tag di inizio dell'ultimo job servito
+            pipe.set(VCLOCK_KEY, start)
+            await pipe.execute()
+
+        logger.debug(
+            f"Job schedulato: {delivery.job.get('job_id')} da {delivery.stream} "
+            f"(start {start:.2f}, finish {finish:.2f})"
+        )
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+from typing import Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Canale pub/sub degli eventi di una sessione
+EVENTS_CHANNEL_PREFIX = "session_events:"
+
+# Stati finali: dopo questi non arrivano altri eventi
+TERMINAL_STATUSES = {"completed", "error", "failed", "killed"}
+
+def events_channel(session_id: str) -> str:
+    return f"{EVENTS_CHANNEL_PREFIX}{session_id}"
+
+def status_payload(session_data: Dict) -> Dict:
+    """Vista compatta dello stato sessione (usata da /status e dagli eventi)"""
+
+    return {
+        "session_id": session_data.get("session_id"),
+        "status": session_data.get("status"),
+        "progress": session_data.get("progress", 1.0 if session_data.get("status") == "completed" else 0.0),
+        "stage": session_data.get("stage"),
+        "created_at": session_data.get("created_at"),
+        "queued_at": session_data.get("queued_at"),
+        "processing_started_at": session_data.get("processing_started_at"),
+        "processing_completed_at": session_data.get("processing_completed_at"),
+        "error": session_data.get("error")
+    }
+
+def batch_status_payload(batch: Dict, sessions: Dict[str, Optional[Dict]]) -> Dict:
+    """Stato aggregato di un batch a partire dalle sue sessioni"""
+
+    items = [status_payload(data) if data else {"session_id": sid, "status": "expired", "progress": 0.0}
+             for sid, data in sessions.items()]
+
+    counts: Dict[str, int] = {}
+    for item in items:
+        counts[item["status"]] = counts.get(item["status"], 0) + 1
+
+    total = len(items)
+    finished = sum(counts.get(status, 0) for status in TERMINAL_STATUSES)
+    completed = counts.get("completed", 0)
+
+    if total and completed == total:
+        status = "completed"
+    elif total and finished == total:
+        status = "partial" if completed else "error"
+    elif any(counts.get(status) for status in ("processing", "completed", "error", "failed")):
+        status = "processing"
+    else:
+        status = batch.get("status", "uploaded")
+
+    return {
+        "batch_id": batch["batch_id"],
+        "status": status,
+        "progress": sum(item["progress"] or 0.0 for item in items) / total if total else 0.0,
+        "total": total,
+        "completed": completed,
+        "failed": finished - completed,
+        "counts": counts,
+        "job_id": batch.get("job_id"),
+        "created_at": batch.get("created_at"),
+        "queued_at": batch.get("queued_at"),
+        "sessions": items
+    }
+
+class SessionEventHub:
+    """Smista gli eventi Redis pub/sub ai client locali
+
+    Una sola sottoscrizione Redis per processo (pattern su tutte le sessioni),
+    inoltrata a code asyncio per ogni stream client aperto.
+    """
+
+    def __init__(self, redis_client, pubsub_client=None, queue_size: int = 64):
+        self.client = redis_client
+        # La sottoscrizione resta in ascolto a tempo indeterminato: serve un
+        # client senza socket_timeout
+        self.pubsub_client = pubsub_client or redis_client
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def publish(self, session_id: str, event: Dict):
+        await self.client.publish(events_channel(session_id), json.dumps(event))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def subscribe(self, session_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(session_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, session_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(session_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[session_id]
+
+    async def _dispatch_loop(self):
+        """Riceve eventi da Redis e li inoltra, con riconnessione automatica"""
+
+        while True:
+            pubsub = self.pubsub_client.pubsub()
+            try:
+                await pubsub.psubscribe(f"{EVENTS_CHANNEL_PREFIX}*")
+
+                async for message in pubsub.listen():
+                    if message.get("type") != "pmessage":
+                        continue
+
+                    channel = message["channel"]
+                    if isinstance(channel, bytes):
+                        channel = channel.decode()
+
+                    session_id = channel[len(EVENTS_CHANNEL_PREFIX):]
+                    self._deliver(session_id, json.loads(message["data"]))
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Errore sottoscrizione eventi sessione: {str(e)}")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
+
+    def _deliver(self, session_id: str, event: Dict):
+        for queue in self._subscribers.get(session_id, ()):
+            if queue.full():
+                # Client lento: conta solo lo stato più recente
+                try:
+                    queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+            queue.put_nowait(event)
@@ -0,0 +1,90 @@
+import logging
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, List, Set
+
+logger = logging.getLogger(__name__)
+
+class SessionIndex:
+    """Indice delle directory di sessione del nodo: creazione e ultimo accesso
+
+    SQLite nella directory temporanea (condiviso dai processi che usano lo
+    stesso disco, es. API e worker sullo stesso host). Gli indici su
+    created_at e accessed_at rendono scadenza ed eviction LRU proporzionali
+    alle sessioni selezionate, non a tutte quelle presenti su disco.
+    Metodi sincroni: da eseguire fuori dall'event loop.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_created ON sessions (created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_accessed ON sessions (accessed_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Una connessione per operazione: sicuro tra i thread degli executor
+        return sqlite3.connect(self.path, timeout=30)
+
+    def touch(self, accesses: Dict[str, float]):
+        """Registra creazione (prima volta) e ultimo accesso delle sessioni"""
+
+        if not accesses:
+            return
+
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT INTO sessions (session_id, created_at, accessed_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET "
+                "accessed_at = max(accessed_at, excluded.accessed_at)",
+                [(session_id, at, at) for session_id, at in accesses.items()]
+            )
+
+    def add_existing(self, created: Dict[str, float]):
+        """Aggiunge sessioni già su disco ma non ancora indicizzate"""
+
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO sessions (session_id, created_at, accessed_at) VALUES (?, ?, ?)",
+                [(session_id, at, at) for session_id, at in created.items()]
+            )
+
+    def expired(self, created_before: float, limit: int) -> List[str]:
+        """Sessioni create prima del limite, dalla più vecchia"""
+
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT session_id FROM sessions WHERE created_at < ? ORDER BY created_at LIMIT ?",
+                (created_before, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def least_recent(self, accessed_before: float, limit: int) -> List[str]:
+        """Sessioni non usate dal limite, dalla meno recente"""
+
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT session_id FROM sessions WHERE accessed_at < ? ORDER BY accessed_at LIMIT ?",
+                (accessed_before, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def remove(self, session_ids: List[str]):
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "DELETE FROM sessions WHERE session_id = ?", [(session_id,) for session_id in session_ids]
+            )
+
+    def known(self) -> Set[str]:
+        with closing(self._connect()) as conn:
+            return {row[0] for row in conn.execute("SELECT session_id FROM sessions")}
+
+    def count(self) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+from typing import Collection, Dict, List, Optional
+
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
+
+from utils.session_events import events_channel, status_payload
+
+logger = logging.getLogger(__name__)
+
+# Durata sessioni (24 ore)
+SESSION_TTL = 86400
+
+# Tentativi dell'aggiornamento ottimistico (WATCH/MULTI) sotto scritture concorrenti
+UPDATE_RETRIES = 50
+
+def session_key(session_id: str) -> str:
+    return f"session:{session_id}"
+
+async def update_session(client, session_id: str, fields: Dict, ttl: int = SESSION_TTL,
+                         create: bool = False, publish: bool = False,
+                         skip_statuses: Collection[str] = ()) -> Optional[Dict]:
+    """Aggiornamento atomico dei campi di una sessione
+
+    API, worker e notifiche dei job condivisi scrivono la stessa chiave: una
+    GET seguita da SETEX perde le scritture avvenute nel mezzo. La transazione
+    (WATCH/MULTI) fallisce se la sessione cambia tra lettura e scrittura e
+    l'aggiornamento viene ripetuto sui dati nuovi.
+
+    Ritorna None (nessuna scrittura) se la sessione non esiste e create è
+    falso, o se il suo stato è in skip_statuses. Con publish lo stato
+    aggiornato è pubblicato agli ascoltatori nella stessa transazione.
+    """
+
+    key = session_key(session_id)
+
+    async with client.pipeline(transaction=True) as pipe:
+        for _ in range(UPDATE_RETRIES):
+            try:
+                await pipe.watch(key)
+
+                data = await pipe.get(key)
+                if data is None and not create:
+                    return None
+
+                session_data = json.loads(data) if data else {"session_id": session_id}
+                if session_data.get("status") in skip_statuses:
+                    return None
+
+                session_data.update(fields)
+
+                pipe.multi()
+                pipe.setex(key, ttl, json.dumps(session_data))
+                if publish:
+                    pipe.publish(events_channel(session_id), json.dumps(status_payload(session_data)))
+                await pipe.execute()
+
+                return session_data
+
+            except WatchError:
+                continue
+
+    raise WatchError(f"Aggiornamento sessione {session_id} non riuscito: troppe scritture concorrenti")
+
+class SessionStore:
+    """Archivio sessioni su Redis asincrono con connection pool condiviso"""
+
+    def __init__(self, redis_url: Optional[str] = None):
+        redis_url = redis_url or os.getenv("REDIS_URL", "redis://localhost:6379")
+
+        # Pool bloccante: sotto carico le richieste attendono una connessione
+        # libera invece di aprirne di nuove senza limite
+        self.pool = aioredis.BlockingConnectionPool.from_url(
+            redis_url,
+            max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", "64")),
+            timeout=float(os.getenv("REDIS_POOL_TIMEOUT", "5")),
+            socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", "2")),
+            socket_connect_timeout=float(os.getenv("REDIS_CONNECT_TIMEOUT", "2")),
+            socket_keepalive=True,
+            health_check_interval=30
+        )
+        self.client = aioredis.Redis(connection_pool=self.pool)
+
+        # Connessione dedicata per pub/sub (letture bloccanti senza timeout)
+        self.pubsub_client = aioredis.Redis.from_url(
+            redis_url,
+            socket_connect_timeout=float(os.getenv("REDIS_CONNECT_TIMEOUT", "2")),
+            socket_keepalive=True
+        )
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return session_key(session_id)
+
+    @staticmethod
+    def _batch_key(batch_id: str) -> str:
+        return f"batch:{batch_id}"
+
+    async def ping(self) -> bool:
+        return await self.client.ping()
+
+    async def get(self, session_id: str) -> Optional[Dict]:
+        """Dati sessione o None se inesistente/scaduta"""
+
+        data = await self.client.get(self._key(session_id))
+        return json.loads(data) if data else None
+
+    async def set(self, session_id: str, session_data: Dict, ttl: int = SESSION_TTL):
+        await self.client.setex(self._key(session_id), ttl, json.dumps(session_data))
+
+    async def update(self, session_id: str, fields: Dict, ttl: int = SESSION_TTL,
+                     publish: bool = False) -> Optional[Dict]:
+        """Aggiorna atomicamente campi di una sessione esistente (vedi update_session)"""
+
+        return await update_session(self.client, session_id, fields, ttl, publish=publish)
+
+    async def delete(self, session_id: str):
+        await self.client.delete(self._key(session_id))
+
+    async def get_many(self, session_ids: List[str]) -> Dict[str, Optional[Dict]]:
+        """Lettura di più sessioni in un solo round-trip (MGET)"""
+
+        if not session_ids:
+            return {}
+
+        values = await self.client.mget([self._key(sid) for sid in session_ids])
+
+        return {
+            sid: json.loads(value) if value else None
+            for sid, value in zip(session_ids, values)
+        }
+
+    async def set_many(self, sessions: Dict[str, Dict], ttl: int = SESSION_TTL,
+                       batch: Optional[Dict] = None):
+        """Scrittura di più sessioni (ed eventuale batch) in una pipeline (un solo round-trip)"""
+
+        if not sessions and batch is None:
+            return
+
+        async with self.client.pipeline(transaction=False) as pipe:
+            for session_id, session_data in sessions.items():
+                pipe.setex(self._key(session_id), ttl, json.dumps(session_data))
+            if batch is not None:
+                pipe.setex(self._batch_key(batch["batch_id"]), ttl, json.dumps(batch))
+            await pipe.execute()
+
+    async def get_batch(self, batch_id: str) -> Optional[Dict]:
+        """Dati batch o None se inesistente/scaduto"""
+
+        data = await self.client.get(self._batch_key(batch_id))
+        return json.loads(data) if data else None
+
+    async def set_batch(self, batch: Dict, ttl: int = SESSION_TTL):
+        await self.client.setex(self._batch_key(batch["batch_id"]), ttl, json.dumps(batch))
+
+    async def close(self):
+        """Chiude le connessioni del pool"""
+
+        try:
+            await self.client.close()
+            await self.pool.disconnect()
+            await self.pubsub_client.close()
+        except Exception as e:
+            logger.warning(f"Errore chiusura pool Redis: {str(e)}")
@@ -0,0 +1,14 @@
+from typing import Dict, List
+
+# Stems base prodotti direttamente da Demucs
+BASE_STEMS: List[str] = ["drums", "bass", "other", "vocals"]
+
+# Stems derivati generati dal post-processing di ogni stem base
+DERIVED_STEMS: Dict[str, List[str]] = {
+    "drums": ["kick", "snare", "hihat", "percussion"],
+    "vocals": ["vocals_lead", "vocals_backing", "vocals_choir"],
+    "other": ["piano", "guitar", "synth", "strings", "brass", "atmosphere", "effects"]
+}
+
+# Separazione completa (nessuno stem richiesto esplicitamente)
+ALL_STEMS: List[str] = BASE_STEMS + [name for names in DERIVED_STEMS.values() for name in names]
@@ -0,0 +1,225 @@
+import json
+import logging
+import math
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from utils.admission import DEFAULT_JOB_SECONDS, JOB_DURATIONS_KEY, JOB_DURATIONS_WINDOW
+
+logger = logging.getLogger(__name__)
+
+# Registrazioni dei worker (scritte dall'heartbeat di worker.AIWorker)
+WORKER_KEY_PREFIX = "worker:"
+
+# Job completati di recente: sorted set (score = timestamp) per il throughput
+THROUGHPUT_KEY = "stats:separation:throughput"
+THROUGHPUT_WINDOW = float(os.getenv("REGISTRY_THROUGHPUT_WINDOW", "300"))
+
+# Heartbeat mancati prima di considerare un worker non più vivo
+STALE_HEARTBEATS = 3
+
+# Segnale di autoscaling: attesa in coda obiettivo e limiti sul numero di worker
+AUTOSCALE_TARGET_WAIT = float(os.getenv("AUTOSCALE_TARGET_WAIT", "300"))
+AUTOSCALE_MIN_WORKERS = int(os.getenv("AUTOSCALE_MIN_WORKERS", "1"))
+AUTOSCALE_MAX_WORKERS = int(os.getenv("AUTOSCALE_MAX_WORKERS", "16"))
+
+def worker_key(worker_id: str) -> str:
+    return f"{WORKER_KEY_PREFIX}{worker_id}"
+
+def throughput_sample(worker_id: str, job_id: Optional[str], audio_seconds: float,
+                      processing_time: float) -> Tuple[str, float]:
+    """Voce del sorted set del throughput: (membro, score)"""
+
+    member = json.dumps({
+        "worker_id": worker_id,
+        "job_id": job_id,
+        "audio_seconds": audio_seconds,
+        "processing_time": processing_time
+    })
+    return member, time.time()
+
+class WorkerRegistry:
+    """Vista aggregata dei worker attivi, del throughput e della coda
+
+    Fornisce anche il segnale di autoscaling: worker necessari per smaltire
+    la coda entro AUTOSCALE_TARGET_WAIT mantenendo il ritmo degli arrivi.
+    """
+
+    def __init__(self, redis_client, job_queue):
+        self.client = redis_client
+        self.job_queue = job_queue
+
+    async def workers(self) -> List[Dict]:
+        """Worker registrati con stato, job correnti e memoria"""
+
+        keys = [key async for key in self.client.scan_iter(match=f"{WORKER_KEY_PREFIX}*", count=100)]
+        if not keys:
+            return []
+
+        now = time.time()
+        workers = []
+
+        for raw in await self.client.mget(keys):
+            if raw is None:
+                # Registrazione scaduta tra SCAN e MGET
+                continue
+
+            try:
+                info = json.loads(raw)
+            except ValueError:
+                continue
+
+            stats = info.get("stats", {})
+            heartbeat_at = info.get("heartbeat_at")
+            interval = float(info.get("heartbeat_interval") or 60)
+            heartbeat_age = now - heartbeat_at if heartbeat_at else None
+
+            status = info.get("status", "active")
+            if heartbeat_age is not None and heartbeat_age > interval * STALE_HEARTBEATS:
+                status = "stale"
+
+            workers.append({
+                "worker_id": info.get("worker_id"),
+                "status": status,
+                "started_at": info.get("started_at"),
+                "last_heartbeat": info.get("last_heartbeat"),
+                "heartbeat_age": round(heartbeat_age, 1) if heartbeat_age is not None else None,
+                "pipeline_depth": int(info.get("pipeline_depth", 1)),
+                "current_jobs": stats.get("current_jobs", []),
+                "jobs_processed": stats.get("jobs_processed", 0),
+                "jobs_failed": stats.get("jobs_failed", 0),
+                "jobs_killed": stats.get("jobs_killed", 0),
+                "memory_rss": stats.get("memory_rss"),
+                "gpu_available": stats.get("gpu_available", info.get("gpu_available", False)),
+                "gpu_memory_used": stats.get("gpu_memory_used"),
+                "gpu_memory_total": stats.get("gpu_memory_total"),
+                "event_loop_lag": stats.get("event_loop_lag")
+            })
+
+        return sorted(workers, key=lambda worker: worker["worker_id"] or "")
+
+    async def throughput(self) -> Dict:
+        """Job e secondi di audio completati nella finestra, totali e per worker"""
+
+        now = time.time()
+
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(THROUGHPUT_KEY, "-inf", now - THROUGHPUT_WINDOW)
+            pipe.zrangebyscore(THROUGHPUT_KEY, now - THROUGHPUT_WINDOW, "+inf")
+            _, samples = await pipe.execute()
+
+        jobs = 0
+        audio_seconds = 0.0
+        per_worker: Dict[str, Dict] = {}
+
+        for raw in samples:
+            sample = json.loads(raw)
+            seconds = float(sample.get("audio_seconds") or 0.0)
+
+            jobs += 1
+            audio_seconds += seconds
+
+            worker = per_worker.setdefault(sample.get("worker_id"), {"jobs": 0, "audio_seconds": 0.0})
+            worker["jobs"] += 1
+            worker["audio_seconds"] += seconds
+
+        return {
+            "window": THROUGHPUT_WINDOW,
+            "jobs": jobs,
+            "jobs_per_second": jobs / THROUGHPUT_WINDOW,
+            "audio_seconds_per_second": audio_seconds / THROUGHPUT_WINDOW,
+            "per_worker": {
+                worker_id: {
+                    **worker,
+                    "audio_seconds_per_second": worker["audio_seconds"] / THROUGHPUT_WINDOW
+                }
+                for worker_id, worker in per_worker.items()
+            }
+        }
+
+    async def queue_lag(self) -> Dict:
+        """Job in attesa e attesa del job più vecchio non ancora consegnato"""
+
+        streams = list(await self.job_queue.streams())
+        heads = await self.job_queue.heads(streams)
+        depth = await self.job_queue.depth()
+
+        now = time.time()
+        # L'id dello stream contiene il timestamp di accodamento in ms
+        oldest = min((int(head.message_id.split("-")[0]) / 1000 for head in heads), default=None)
+
+        return {
+            "depth": sum(depth.values()),
+            "per_queue": depth,
+            "oldest_wait": round(max(0.0, now - oldest), 1) if oldest is not None else 0.0
+        }
+
+    async def job_seconds(self) -> float:
+        """Durata media recente di un job (stessa finestra dell'admission control)"""
+
+        durations = await self.client.lrange(JOB_DURATIONS_KEY, 0, JOB_DURATIONS_WINDOW - 1)
+        samples = [float(value) for value in durations]
+        return sum(samples) / len(samples) if samples else DEFAULT_JOB_SECONDS
+
+    @staticmethod
+    def desired_workers(depth: int, arrival_rate: float, job_seconds: float,
+                        slots_per_worker: float) -> int:
+        """Worker necessari per tenere il ritmo degli arrivi e smaltire la coda
+        entro AUTOSCALE_TARGET_WAIT"""
+
+        per_worker_rate = max(slots_per_worker, 1.0) / max(job_seconds, 1e-6)
+        needed_rate = arrival_rate + depth / max(AUTOSCALE_TARGET_WAIT, 1.0)
+
+        desired = math.ceil(needed_rate / per_worker_rate) if needed_rate > 0 else 0
+        return max(AUTOSCALE_MIN_WORKERS, min(AUTOSCALE_MAX_WORKERS, desired))
+
+    async def autoscaling(self, workers: List[Dict], throughput: Dict, queue: Dict) -> Dict:
+        live = [worker for worker in workers if worker["status"] == "active"]
+        job_seconds = await self.job_seconds()
+        slots_per_worker = (
+            sum(worker["pipeline_depth"] for worker in live) / len(live) if live else 1.0
+        )
+
+        # A regime i completamenti approssimano gli arrivi; l'eccesso di
+        # arrivi si accumula in coda ed è coperto dal termine sulla profondità
+        desired = self.desired_workers(
+            queue["depth"], throughput["jobs_per_second"], job_seconds, slots_per_worker
+        )
+
+        if desired > len(live):
+            action = "scale_up"
+        elif desired < len(live):
+            action = "scale_down"
+        else:
+            action = "steady"
+
+        return {
+            "live_workers": len(live),
+            "desired_workers": desired,
+            "action": action,
+            "target_wait": AUTOSCALE_TARGET_WAIT,
+            "job_seconds": round(job_seconds, 1),
+            "min_workers": AUTOSCALE_MIN_WORKERS,
+            "max_workers": AUTOSCALE_MAX_WORKERS
+        }
+
+    async def snapshot(self) -> Dict:
+        """Stato complessivo del cluster di worker"""
+
+        workers = await self.workers()
+        throughput = await self.throughput()
+        queue = await self.queue_lag()
+
+        for worker in workers:
+            recent = throughput["per_worker"].get(worker["worker_id"], {})
+            worker["audio_seconds_per_second"] = recent.get("audio_seconds_per_second", 0.0)
+
+        return {
+            "workers": workers,
+            "throughput": {
+                key: value for key, value in throughput.items() if key != "per_worker"
+            },
+            "queue": queue,
+            "autoscaling": await self.autoscaling(workers, throughput, queue)
+        }
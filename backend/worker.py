@@ -5,22 +5,42 @@ Gestisce code Redis e processa richieste di separazione
 """
 
 import asyncio
+import contextlib
 import json
 import logging
 import os
 import signal
 import sys
+import threading
+import time
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
+import psutil
 import redis
+import redis.asyncio as aioredis
+import socket
 import torch
 from pathlib import Path
+from prometheus_client import start_http_server
 
 # Import moduli locali
 from models.demucs_model import DemucsModel
 from audio_processor import AudioProcessor
 from utils.file_manager import FileManager
+from utils.metrics import (
+    ACTIVE_JOBS, EVENT_LOOP_LAG, HEARTBEAT_AGE, JOB_DURATION, JOBS_KILLED, JOBS_TOTAL, QUEUE_WAIT,
+    STARTUP_DURATION
+)
+from utils.session_events import TERMINAL_STATUSES
+from utils.session_store import update_session
+from utils.admission import JOB_DURATIONS_KEY, JOB_DURATIONS_WINDOW, inflight_key
+from utils.job_queue import JobQueue, Delivery, VISIBILITY_TIMEOUT
+from utils.scheduler import FairScheduler
+from utils.coalescing import JobCoalescer
+from utils.cancellation import CancelToken, JobInterrupted
+from utils.worker_registry import THROUGHPUT_KEY, THROUGHPUT_WINDOW, throughput_sample, worker_key
 
 # Configurazione logging
 logging.basicConfig(
@@ -33,17 +53,103 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Tracce di un batch elaborate in parallelo (la separazione resta limitata
+# da SEPARATION_CONCURRENCY nell'AudioProcessor)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", os.getenv("SEPARATION_CONCURRENCY", "2")))
+
+# Job in corso contemporaneamente nello stesso worker: con più di uno il job
+# successivo viene prelevato e decodificato/analizzato mentre il modello separa
+# il precedente (l'inferenza resta limitata da SEPARATION_CONCURRENCY)
+PIPELINE_DEPTH = max(1, int(os.getenv("WORKER_PIPELINE_DEPTH", "1")))
+
+# Heartbeat del worker (thread dedicato: non dipende dall'event loop) e TTL
+# della registrazione in Redis
+HEARTBEAT_INTERVAL = float(os.getenv("WORKER_HEARTBEAT_INTERVAL", "15"))
+WORKER_TTL = int(os.getenv("WORKER_TTL", "300"))
+
+# Campionamento del ritardo dell'event loop e soglia di avviso
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_WARNING = float(os.getenv("WORKER_LOOP_LAG_WARNING", "1.0"))
+
+# Tempo massimo di arresto (SIGTERM): i job si fermano al primo confine di
+# fase/segmento e vengono riaccodati; allo scadere si riaccoda comunque
+DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", "25"))
+
+# Limiti per job: scadenza proporzionale alla durata dell'audio, assenza di
+# avanzamento (fasi/segmenti) e memoria del processo; il job oltre limite viene
+# terminato e segnalato senza fermare il worker
+JOB_DEADLINE_BASE = float(os.getenv("JOB_DEADLINE_BASE", "300"))
+JOB_DEADLINE_PER_AUDIO_SECOND = float(os.getenv("JOB_DEADLINE_PER_AUDIO_SECOND", "10"))
+JOB_DEADLINE_MAX = float(os.getenv("JOB_DEADLINE_MAX", "14400"))
+JOB_DEFAULT_AUDIO_SECONDS = 600.0
+JOB_STALL_TIMEOUT = float(os.getenv("JOB_STALL_TIMEOUT", "900"))
+# 0 = 90% della memoria fisica; limite GPU disattivo se 0
+WORKER_MEMORY_LIMIT_MB = float(os.getenv("WORKER_MEMORY_LIMIT_MB", "0"))
+WORKER_GPU_MEMORY_LIMIT_MB = float(os.getenv("WORKER_GPU_MEMORY_LIMIT_MB", "0"))
+
+# Controllo del watchdog e attesa prima di abbandonare un job che non si ferma
+WATCHDOG_INTERVAL = 5.0
+JOB_KILL_GRACE = float(os.getenv("JOB_KILL_GRACE", "30"))
+
+# Uscita dopo il drain quando i thread di inferenza abbandonati occupano tutto
+# l'executor: il supervisore (restart: unless-stopped) riavvia il processo
+RESTART_EXIT_CODE = 75
+
+# Motivi di terminazione: il job non viene riaccodato (fallirebbe di nuovo)
+KILL_REASONS = ("deadline", "stalled", "memory")
+
+# Intervallo di ricerca dei job abbandonati da worker non più attivi
+RECLAIM_INTERVAL = int(os.getenv("JOB_RECLAIM_INTERVAL", "30"))
+
+@dataclass
+class RunningJob:
+    """Job in corso nel worker, sorvegliato dal watchdog"""
+    delivery: Delivery
+    cancel: CancelToken
+    task: asyncio.Task
+    started_at: float
+    deadline: float
+    killed_at: Optional[float] = None
+
 class AIWorker:
     """Worker per elaborazione AI in background"""
     
     def __init__(self):
         self.redis_client = None
+        self.heartbeat_client = None
+        self.job_queue = None
+        self.scheduler = None
+        self.coalescer = None
         self.audio_processor = None
         self.demucs_model = None
         self.file_manager = None
         
         self.running = False
-        self.worker_id = f"worker_{os.getpid()}"
+        # Host + pid: nei container il pid è spesso lo stesso per tutti i worker
+        self.worker_id = f"worker_{socket.gethostname()}_{os.getpid()}"
+        self._last_reclaim = 0.0
+        
+        # Posti della pipeline e job in corso
+        self._pipeline_slots = asyncio.Semaphore(PIPELINE_DEPTH)
+        self._pipeline_tasks = set()
+        
+        # Job in corso (per message id) con richiesta di interruzione e scadenza
+        self._running: Dict[str, RunningJob] = {}
+        self._watchdog_task = None
+        self._memory_limit = (
+            WORKER_MEMORY_LIMIT_MB * 1024 * 1024 if WORKER_MEMORY_LIMIT_MB > 0
+            else psutil.virtual_memory().total * 0.9
+        )
+        self._draining = False
+        self._drain_task = None
+        self.restart_required = False
+        self._loop = None
+        
+        # Heartbeat su thread dedicato
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread = None
+        self._last_heartbeat = time.time()
+        self._loop_lag_task = None
         
         # Statistiche worker
         self.stats = {
@@ -51,10 +157,14 @@ class AIWorker:
             "jobs_processed": 0,
             "jobs_failed": 0,
             "total_processing_time": 0.0,
-            "current_job": None,
+            "current_jobs": [],
+            "pipeline_depth": PIPELINE_DEPTH,
             "gpu_available": torch.cuda.is_available(),
             "gpu_memory_total": 0,
-            "gpu_memory_used": 0
+            "gpu_memory_used": 0,
+            "memory_rss": 0,
+            "jobs_killed": 0,
+            "event_loop_lag": 0.0
         }
         
         if torch.cuda.is_available():
@@ -65,17 +175,32 @@ class AIWorker:
         try:
             logger.info(f"Inizializzazione {self.worker_id}...")
             
-            # Connessione Redis
+            # Connessione Redis (asincrona: nessuna chiamata blocca l'event loop)
             redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
-            self.redis_client = redis.Redis.from_url(redis_url)
+            self.redis_client = aioredis.Redis.from_url(redis_url)
             
             # Test connessione
-            self.redis_client.ping()
+            await self.redis_client.ping()
             logger.info("Connessione Redis stabilita")
             
+            # Client sincrono riservato al thread di heartbeat
+            self.heartbeat_client = redis.Redis.from_url(
+                redis_url, socket_timeout=HEARTBEAT_INTERVAL, socket_connect_timeout=HEARTBEAT_INTERVAL
+            )
+            
+            # Coda job su Redis Streams (letture bloccanti su connessioni del pool)
+            self.job_queue = JobQueue(self.redis_client)
+            self.scheduler = FairScheduler(self.job_queue)
+            self.coalescer = JobCoalescer(self.redis_client)
+            await self.job_queue.ensure_groups()
+            await self.job_queue.migrate_legacy_lists()
+            
             # Inizializza componenti AI
-            self.audio_processor = AudioProcessor()
+            started = time.perf_counter()
+            # Stesso client Redis per riferimenti e manifest della blob store
+            self.audio_processor = AudioProcessor(self.redis_client)
             await self.audio_processor.initialize()
+            STARTUP_DURATION.labels(phase="model_load").set(time.perf_counter() - started)
             
             self.demucs_model = self.audio_processor.demucs_model
             self.file_manager = self.audio_processor.file_manager
@@ -83,6 +208,9 @@ class AIWorker:
             # Registra worker in Redis
             await self._register_worker()
             
+            # Endpoint metriche Prometheus del worker
+            start_http_server(int(os.getenv("METRICS_PORT", "8001")))
+            
             logger.info(f"{self.worker_id} inizializzato con successo")
             
         except Exception as e:
@@ -92,16 +220,24 @@ class AIWorker:
     async def start(self):
         """Avvia il worker"""
         self.running = True
+        self._loop = asyncio.get_running_loop()
         logger.info(f"{self.worker_id} avviato")
         
         # Setup signal handlers
         signal.signal(signal.SIGTERM, self._signal_handler)
         signal.signal(signal.SIGINT, self._signal_handler)
         
+        self._loop_lag_task = asyncio.create_task(self._monitor_loop_lag())
+        self._watchdog_task = asyncio.create_task(self._watchdog())
+        
         try:
             while self.running:
+                # Lettura bloccante sugli stream: nessun polling
                 await self._process_queue()
-                await asyncio.sleep(1)  # Polling interval
+            
+            # Arresto: i job in corso vengono fermati e passati ad altri worker
+            self._begin_drain()
+            await self._drain_task
                 
         except Exception as e:
             logger.error(f"Errore nel loop principale: {str(e)}")
@@ -109,68 +245,399 @@ class AIWorker:
             await self._cleanup()
     
     async def _process_queue(self):
-        """Processa code di elaborazione"""
+        """Preleva il prossimo job non appena la pipeline ha un posto libero"""
+        await self._pipeline_slots.acquire()
+        
         try:
-            # Controlla coda prioritaria
-            job_data = self.redis_client.blpop(["queue:separation:priority"], timeout=1)
+            delivery = await self._next_delivery() if self.running else None
+        except redis.RedisError as e:
+            self._pipeline_slots.release()
+            logger.error(f"Errore Redis: {str(e)}")
+            await asyncio.sleep(5)  # Attendi prima di riprovare
+            return
+        except Exception as e:
+            self._pipeline_slots.release()
+            logger.error(f"Errore processamento coda: {str(e)}")
+            return
+        
+        if delivery is None:
+            self._pipeline_slots.release()
+            return
+        
+        cancel = CancelToken()
+        task = asyncio.create_task(self._process_delivery(delivery, cancel))
+        self._pipeline_tasks.add(task)
+        task.add_done_callback(self._pipeline_tasks.discard)
+        
+        now = time.monotonic()
+        self._running[delivery.message_id] = RunningJob(
+            delivery=delivery, cancel=cancel, task=task,
+            started_at=now, deadline=now + self._job_deadline(delivery.job)
+        )
+    
+    async def _process_delivery(self, delivery: Delivery, cancel: CancelToken):
+        """Elabora un job consegnato e lo conferma (libera il posto in pipeline)"""
+        try:
+            job = delivery.job
             
-            if not job_data:
-                # Controlla coda normale
-                job_data = self.redis_client.blpop(["queue:separation:normal"], timeout=1)
+            # Consegnato mentre il worker si stava già fermando
+            if self._draining:
+                cancel.cancel("drain")
+                cancel.raise_if_cancelled()
             
-            if job_data:
-                queue_name, job_json = job_data
-                job = json.loads(job_json)
-                
-                await self._process_job(job)
-                
+            # Tempo di attesa in coda (se registrato dal produttore, solo prima
+            # consegna; i job riaccodati hanno già atteso)
+            if job.get("enqueued_at") and delivery.deliveries == 1 and not job.get("handoffs"):
+                QUEUE_WAIT.labels(queue=delivery.stream).observe(
+                    max(0.0, datetime.now().timestamp() - float(job["enqueued_at"]))
+                )
+            
+            # Il lease viene rinnovato finché il job è in elaborazione: se il worker
+            # muore il job torna disponibile dopo il visibility timeout
+            lease = asyncio.create_task(self._renew_lease(delivery))
+            try:
+                # File delle sessioni esclusi dall'eviction per disco pieno
+                with contextlib.ExitStack() as in_use:
+                    for session_id in self._job_sessions(job):
+                        in_use.enter_context(self.file_manager.in_use(session_id))
+                    error = await self._process_job(job, cancel)
+            finally:
+                lease.cancel()
+            
+            if error:
+                await self.job_queue.dead_letter(delivery, error)
+            else:
+                await self.job_queue.ack(delivery)
+        
+        except JobInterrupted as e:
+            await self._job_interrupted(delivery, e.reason)
+        except asyncio.CancelledError:
+            # Job che non si è fermato in tempo (scadenza del drain o del watchdog)
+            reason = cancel.reason or "drain_timeout"
+            await self._job_interrupted(delivery, reason)
+            if reason not in KILL_REASONS:
+                raise
         except redis.RedisError as e:
+            # Job non confermato: torna disponibile dopo il visibility timeout
             logger.error(f"Errore Redis: {str(e)}")
-            await asyncio.sleep(5)  # Attendi prima di riprovare
         except Exception as e:
             logger.error(f"Errore processamento coda: {str(e)}")
+        finally:
+            self._running.pop(delivery.message_id, None)
+            self._pipeline_slots.release()
+    
+    async def _job_interrupted(self, delivery: Delivery, reason: str):
+        """Job terminato dal watchdog o fermato dal drain"""
+        if reason in KILL_REASONS:
+            await self._kill_job(delivery, reason)
+        else:
+            await self._hand_off(delivery, reason)
     
-    async def _process_job(self, job: Dict):
-        """Processa singolo job di separazione"""
+    @staticmethod
+    def _job_deadline(job: Dict) -> float:
+        """Tempo massimo di elaborazione, proporzionale alla durata dell'audio"""
+        if job.get("type") == "batch_separation":
+            audio_seconds = sum(
+                item.get("duration") or JOB_DEFAULT_AUDIO_SECONDS for item in job.get("items", [])
+            )
+        else:
+            audio_seconds = job.get("expected_duration") or JOB_DEFAULT_AUDIO_SECONDS
+        
+        return min(JOB_DEADLINE_MAX, JOB_DEADLINE_BASE + JOB_DEADLINE_PER_AUDIO_SECOND * float(audio_seconds))
+    
+    async def _watchdog(self):
+        """Termina i job oltre scadenza, senza avanzamento o con memoria eccessiva"""
+        process = psutil.Process()
+        
+        while True:
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            try:
+                now = time.monotonic()
+                
+                for run in list(self._running.values()):
+                    if run.killed_at is not None:
+                        # Non si è fermato al confine successivo: abbandonato
+                        if now - run.killed_at > JOB_KILL_GRACE and not run.task.done():
+                            logger.error(f"Job {run.delivery.job.get('job_id')} non risponde, abbandonato")
+                            run.task.cancel()
+                        continue
+                    
+                    if now > run.deadline:
+                        self._kill(run, "deadline", f"oltre {run.deadline - run.started_at:.0f}s")
+                    elif run.cancel.idle_seconds > JOB_STALL_TIMEOUT and not self._draining:
+                        self._kill(run, "stalled", f"nessun avanzamento da {run.cancel.idle_seconds:.0f}s")
+                
+                self._check_memory(process)
+                self._check_orphaned_threads()
+                
+            except Exception as e:
+                logger.error(f"Errore watchdog: {str(e)}")
+    
+    def _check_memory(self, process: psutil.Process):
+        """Oltre il limite di memoria termina il job con l'audio più lungo"""
+        rss = process.memory_info().rss
+        over = rss > self._memory_limit
+        
+        if WORKER_GPU_MEMORY_LIMIT_MB > 0 and torch.cuda.is_available():
+            over = over or torch.cuda.memory_allocated(0) > WORKER_GPU_MEMORY_LIMIT_MB * 1024 * 1024
+        
+        if not over:
+            return
+        
+        # Un job alla volta: si attende che la memoria del precedente sia liberata
+        if any(run.killed_at is not None for run in self._running.values()):
+            return
+        
+        candidates = list(self._running.values())
+        if not candidates:
+            return
+        
+        victim = max(candidates, key=lambda run: (run.deadline - run.started_at, run.started_at))
+        self._kill(victim, "memory", f"RSS {rss / 1024 / 1024:.0f} MB oltre il limite")
+    
+    def _check_orphaned_threads(self):
+        """Executor del modello occupato da inferenze abbandonate: drain e riavvio
+        
+        Il task di un job che non si ferma viene cancellato, ma il thread
+        dell'inferenza continua; con tutti i thread occupati i job successivi
+        resterebbero in attesa, quindi il worker passa i job ad altri ed esce.
+        """
+        if self.demucs_model is None or self.restart_required:
+            return
+        
+        orphaned = self.demucs_model.orphaned_threads
+        if orphaned < self.demucs_model.max_workers:
+            return
+        
+        logger.error(f"{orphaned} thread di inferenza abbandonati non terminano: drain e riavvio")
+        self.restart_required = True
+        self._begin_drain()
+    
+    def _kill(self, run: RunningJob, reason: str, detail: str):
+        logger.warning(f"Terminazione job {run.delivery.job.get('job_id')} ({reason}): {detail}")
+        run.killed_at = time.monotonic()
+        run.cancel.cancel(reason)
+    
+    async def _kill_job(self, delivery: Delivery, reason: str):
+        """Segnala il job terminato: sessioni "killed", dead-letter, posti liberati"""
+        job = delivery.job
+        job_type = job.get("type", "separation")
+        error = {
+            "deadline": "Tempo massimo di elaborazione superato",
+            "stalled": "Elaborazione bloccata (nessun avanzamento)",
+            "memory": "Memoria massima del worker superata"
+        }[reason]
+        
+        killed_data = {
+            "error": error,
+            "kill_reason": reason,
+            "failed_at": datetime.now().isoformat(),
+            "worker_id": self.worker_id
+        }
+        
+        for session_id in self._job_sessions(job):
+            # Tracce già concluse (completate o in errore) hanno già liberato il posto
+            if await self._update_job_status(session_id, "killed", killed_data,
+                                             skip_statuses=TERMINAL_STATUSES):
+                await self._release_admission({"client_id": job.get("client_id")})
+        
+        await self._notify_coalesced(job, "killed", killed_data)
+        
+        try:
+            await self.job_queue.dead_letter(delivery, f"{error} ({reason})")
+        except Exception as e:
+            logger.error(f"Errore dead-letter job terminato: {str(e)}")
+        
+        self.stats["jobs_killed"] += 1
+        JOBS_KILLED.labels(type=job_type, reason=reason).inc()
+        JOBS_TOTAL.labels(type=job_type, status="killed").inc()
+    
+    async def _hand_off(self, delivery: Delivery, reason: str):
+        """Riaccoda un job interrotto: un altro worker riparte dai checkpoint"""
+        job = delivery.job
+        
+        try:
+            await self.job_queue.requeue(delivery, reason)
+        except Exception as e:
+            # Resta pendente: sarà riassegnato dopo il visibility timeout
+            logger.error(f"Errore riaccodamento job {job.get('job_id')}: {str(e)}")
+            return
+        
+        for session_id in self._job_sessions(job):
+            await self._update_job_status(session_id, "queued", {
+                "handoff_reason": reason,
+                "handed_off_at": datetime.now().isoformat()
+            }, skip_statuses=("completed",))
+        
+        JOBS_TOTAL.labels(type=job.get("type", "separation"), status="handed_off").inc()
+    
+    @staticmethod
+    def _job_sessions(job: Dict) -> List[str]:
+        """Sessioni aggiornate da un job (singola o tracce di un batch)"""
+        if job.get("type") == "batch_separation":
+            session_ids = [item["session_id"] for item in job.get("items", [])]
+        else:
+            session_ids = [job.get("session_id")]
+        return [session_id for session_id in session_ids if session_id]
+    
+    def _begin_drain(self):
+        """Avvia (una sola volta) il drain con la sua scadenza"""
+        self.running = False
+        self._draining = True
+        for run in list(self._running.values()):
+            run.cancel.cancel("drain")
+        
+        if self._drain_task is None:
+            self._drain_task = asyncio.create_task(self._drain())
+    
+    async def _drain(self):
+        """Ferma i job in corso entro DRAIN_TIMEOUT e li passa ad altri worker"""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + DRAIN_TIMEOUT
+        
+        if self._pipeline_tasks:
+            logger.info(f"Drain: {len(self._pipeline_tasks)} job in corso (max {DRAIN_TIMEOUT:.0f}s)")
+        
+        # Include i job consegnati durante il drain (riaccodati subito)
+        while self._pipeline_tasks and loop.time() < deadline:
+            await asyncio.wait(set(self._pipeline_tasks), timeout=deadline - loop.time())
+        
+        pending = set(self._pipeline_tasks)
+        if pending:
+            # Fase bloccante più lunga della scadenza: riaccodati senza attendere
+            logger.warning(f"Drain scaduto: {len(pending)} job riaccodati durante l'elaborazione")
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending, timeout=5)
+    
+    async def _next_delivery(self) -> Optional[Delivery]:
+        """Job riassegnati da worker non più attivi, altrimenti nuovi job"""
+        
+        now = asyncio.get_event_loop().time()
+        if now - self._last_reclaim >= RECLAIM_INTERVAL:
+            self._last_reclaim = now
+            
+            delivery, dead = await self.job_queue.reclaim(self.worker_id)
+            for abandoned in dead:
+                await self._abandon_job(abandoned)
+            
+            # Il registro non cresce con ogni client visto: stream inattivi rimossi
+            await self.job_queue.prune_idle_streams()
+            
+            if delivery is not None:
+                return delivery
+        
+        # Fair share tra priorità e tenant (attesa bloccante se tutto vuoto)
+        return await self.scheduler.next(self.worker_id, block_ms=5000)
+    
+    async def _renew_lease(self, delivery: Delivery):
+        """Rinnova periodicamente il lease del job in elaborazione"""
+        while True:
+            await asyncio.sleep(VISIBILITY_TIMEOUT / 3)
+            try:
+                await self.job_queue.extend(delivery, self.worker_id)
+                if delivery.job.get("coalesce_key"):
+                    await self.coalescer.touch(delivery.job["coalesce_key"], delivery.job["job_id"])
+            except Exception as e:
+                logger.error(f"Errore rinnovo lease job: {str(e)}")
+    
+    async def _abandon_job(self, delivery: Delivery):
+        """Segna come falliti i job che hanno esaurito le consegne"""
+        job = delivery.job
+        
+        for session_id in self._job_sessions(job):
+            # Tracce già concluse hanno già liberato il posto del client
+            if await self._update_job_status(session_id, "failed", {
+                "error": "Elaborazione interrotta ripetutamente (worker terminato)",
+                "failed_at": datetime.now().isoformat()
+            }, skip_statuses=TERMINAL_STATUSES):
+                await self._release_admission({"client_id": job.get("client_id")})
+        
+        await self._notify_coalesced(job, "failed", {
+            "error": "Elaborazione interrotta ripetutamente (worker terminato)",
+            "failed_at": datetime.now().isoformat()
+        })
+        
+        JOBS_TOTAL.labels(type=job.get("type", "separation"), status="dead_letter").inc()
+    
+    async def _process_job(self, job: Dict, cancel: Optional[CancelToken] = None) -> Optional[str]:
+        """Processa singolo job di separazione; ritorna l'errore in caso di fallimento
+        
+        Un'interruzione richiesta tramite cancel solleva JobInterrupted: il job non
+        è concluso e il posto del client resta occupato.
+        """
         session_id = job.get("session_id")
         job_type = job.get("type", "separation")
         
+        # Batch: un job che raggruppa più sessioni, ognuna con il proprio stato
+        if job_type == "batch_separation":
+            await self._process_batch_job(job, cancel)
+            return None
+        
         start_time = asyncio.get_event_loop().time()
+        interrupted = False
+        
+        ACTIVE_JOBS.inc()
         
         try:
             logger.info(f"Inizio elaborazione job: {session_id} (tipo: {job_type})")
             
             # Aggiorna stato in Redis
-            self.stats["current_job"] = session_id
+            self.stats["current_jobs"].append(session_id)
             await self._update_job_status(session_id, "processing", {
                 "worker_id": self.worker_id,
-                "started_at": datetime.now().isoformat()
+                "job_id": job.get("job_id"),
+                "started_at": datetime.now().isoformat(),
+                "processing_started_at": datetime.now().isoformat()
             })
             
             # Processa in base al tipo
             if job_type == "separation":
-                result = await self._process_separation_job(job)
+                result = await self._process_separation_job(job, cancel)
             elif job_type == "mashup":
                 result = await self._process_mashup_job(job)
             else:
                 raise ValueError(f"Tipo job non supportato: {job_type}")
             
+            if result.get("status") == "error":
+                raise RuntimeError(result.get("error", "Elaborazione fallita"))
+            
             # Aggiorna stato completato
             processing_time = asyncio.get_event_loop().time() - start_time
             
-            await self._update_job_status(session_id, "completed", {
+            completion_data = {
                 "result": result,
                 "processing_time": processing_time,
                 "completed_at": datetime.now().isoformat(),
+                "processing_completed_at": datetime.now().isoformat(),
                 "worker_id": self.worker_id
-            })
+            }
+            
+            # Percorsi stems letti dagli endpoint di download dell'API
+            if "stems_paths" in result:
+                completion_data["stems_paths"] = result["stems_paths"]
+            
+            await self._update_job_status(session_id, "completed", completion_data)
+            await self._notify_coalesced(job, "completed", completion_data)
             
             # Aggiorna statistiche
             self.stats["jobs_processed"] += 1
             self.stats["total_processing_time"] += processing_time
-            self.stats["current_job"] = None
+            JOB_DURATION.labels(type=job_type).observe(processing_time)
+            JOBS_TOTAL.labels(type=job_type, status="completed").inc()
+            if job_type == "separation":
+                audio_seconds = (
+                    result.get("original_analysis", {}).get("duration")
+                    or job.get("expected_duration") or 0.0
+                )
+                await self._record_job_duration(processing_time, audio_seconds, job.get("job_id"))
             
             logger.info(f"Job completato: {session_id} ({processing_time:.2f}s)")
+            return None
+            
+        except (JobInterrupted, asyncio.CancelledError):
+            interrupted = True
+            raise
             
         except Exception as e:
             processing_time = asyncio.get_event_loop().time() - start_time
@@ -178,29 +645,191 @@ class AIWorker:
             logger.error(f"Errore elaborazione job {session_id}: {str(e)}")
             
             # Aggiorna stato errore
-            await self._update_job_status(session_id, "error", {
+            error_data = {
                 "error": str(e),
                 "processing_time": processing_time,
                 "failed_at": datetime.now().isoformat(),
                 "worker_id": self.worker_id
-            })
+            }
+            await self._update_job_status(session_id, "error", error_data)
+            await self._notify_coalesced(job, "error", error_data)
             
             self.stats["jobs_failed"] += 1
-            self.stats["current_job"] = None
+            JOBS_TOTAL.labels(type=job_type, status="error").inc()
+            return str(e)
+        
+        finally:
+            ACTIVE_JOBS.dec()
+            if session_id in self.stats["current_jobs"]:
+                self.stats["current_jobs"].remove(session_id)
+            if not interrupted:
+                await self._release_admission(job)
     
-    async def _process_separation_job(self, job: Dict) -> Dict:
+    async def _process_separation_job(self, job: Dict, cancel: Optional[CancelToken] = None) -> Dict:
         """Processa job di separazione audio"""
         session_id = job["session_id"]
         audio_path = job["audio_path"]
         options = job.get("options", {})
         
+        async def report_progress(stage: str, progress: float):
+            if cancel is not None:
+                cancel.mark_progress()
+            progress_data = {"stage": stage, "progress": progress}
+            await self._update_job_status(session_id, "processing", progress_data)
+            
+            # Anche le sessioni unite al job seguono l'avanzamento
+            if job.get("coalesce_key"):
+                for waiter in await self.coalescer.waiters(job["coalesce_key"], job["job_id"]):
+                    await self._update_job_status(waiter["session_id"], "processing", progress_data)
+        
         # Elaborazione completa
         result = await self.audio_processor.process_full_separation(
-            audio_path, session_id, options
+            audio_path, session_id, options, progress_callback=report_progress, cancel=cancel
         )
         
         return result
     
+    async def _process_batch_job(self, job: Dict, cancel: Optional[CancelToken] = None):
+        """Processa un batch di separazioni con concorrenza limitata
+        
+        Le tracce più lunghe partono per prime (riduce il tempo totale del batch);
+        tracce con lo stesso contenuto sono elaborate in sequenza, così le copie
+        successive riusano gli stems dall'indice invece di separare di nuovo.
+        """
+        batch_id = job["batch_id"]
+        items = job.get("items", [])
+        
+        start_time = asyncio.get_event_loop().time()
+        
+        await self._update_batch_status(batch_id, {
+            "status": "processing",
+            "worker_id": self.worker_id,
+            "processing_started_at": datetime.now().isoformat()
+        })
+        
+        groups: Dict[str, List[Dict]] = {}
+        for item in items:
+            groups.setdefault(item.get("content_hash") or item["session_id"], []).append(item)
+        
+        ordered = sorted(
+            groups.values(),
+            key=lambda group: max(item.get("duration") or 0.0 for item in group),
+            reverse=True
+        )
+        
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+        
+        async def run_group(group: List[Dict]):
+            async with semaphore:
+                for item in group:
+                    # Riconsegna dopo un crash: le tracce già concluse (completate o in
+                    # errore, posto del client già liberato) non si rifanno
+                    existing_data = await self.redis_client.get(f"session:{item['session_id']}")
+                    if existing_data and json.loads(existing_data).get("status") in TERMINAL_STATUSES:
+                        continue
+                    
+                    await self._process_job({
+                        "type": "separation",
+                        "job_id": job.get("job_id"),
+                        "batch_id": batch_id,
+                        "session_id": item["session_id"],
+                        "audio_path": item["audio_path"],
+                        "options": job.get("options", {}),
+                        "client_id": job.get("client_id")
+                    }, cancel)
+        
+        results = await asyncio.gather(
+            *(run_group(group) for group in ordered), return_exceptions=True
+        )
+        
+        # Tracce interrotte: il batch viene riaccodato, quelle completate non si rifanno
+        for outcome in results:
+            if isinstance(outcome, BaseException):
+                raise outcome
+        
+        processing_time = asyncio.get_event_loop().time() - start_time
+        
+        await self._update_batch_status(batch_id, {
+            "status": "finished",
+            "processing_time": processing_time,
+            "processing_completed_at": datetime.now().isoformat()
+        })
+        
+        JOB_DURATION.labels(type="batch_separation").observe(processing_time)
+        JOBS_TOTAL.labels(type="batch_separation", status="completed").inc()
+        
+        logger.info(f"Batch completato: {batch_id} ({len(items)} tracce, {processing_time:.2f}s)")
+    
+    async def _notify_coalesced(self, job: Dict, status: str, data: Dict):
+        """Chiude il gruppo di richieste identiche e inoltra l'esito a ogni sessione"""
+        if not job.get("coalesce_key"):
+            return
+        
+        try:
+            waiters = await self.coalescer.complete(job["coalesce_key"], job["job_id"])
+        except Exception as e:
+            logger.error(f"Errore chiusura job condiviso {job.get('job_id')}: {str(e)}")
+            return
+        
+        for waiter in waiters:
+            waiter_data = {**data, "coalesced_with": job.get("session_id")}
+            if isinstance(data.get("result"), dict):
+                waiter_data["result"] = {**data["result"], "session_id": waiter["session_id"]}
+            
+            # Riferimenti propri agli stems: restano disponibili anche se la
+            # sessione del leader viene eliminata o scade
+            stems_paths = data.get("stems_paths") or {}
+            if stems_paths:
+                try:
+                    await self.file_manager.retain_files(waiter["session_id"], stems_paths, "stems/")
+                except Exception as e:
+                    logger.error(f"Errore riferimenti stems sessione {waiter['session_id']}: {str(e)}")
+            
+            await self._update_job_status(waiter["session_id"], status, waiter_data)
+            await self._release_admission(waiter)
+            JOBS_TOTAL.labels(type="separation", status="coalesced").inc()
+        
+        if waiters:
+            logger.info(f"Esito del job {job.get('job_id')} inoltrato a {len(waiters)} sessioni unite")
+    
+    async def _record_job_duration(self, processing_time: float, audio_seconds: float,
+                                   job_id: Optional[str] = None):
+        """Durata job per l'admission control e throughput per il registro worker (API)"""
+        try:
+            member, completed_at = throughput_sample(
+                self.worker_id, job_id, float(audio_seconds), processing_time
+            )
+            
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.lpush(JOB_DURATIONS_KEY, processing_time)
+                pipe.ltrim(JOB_DURATIONS_KEY, 0, JOB_DURATIONS_WINDOW - 1)
+                pipe.zadd(THROUGHPUT_KEY, {member: completed_at})
+                pipe.zremrangebyscore(THROUGHPUT_KEY, "-inf", completed_at - THROUGHPUT_WINDOW)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Errore registrazione durata job: {str(e)}")
+    
+    async def _release_admission(self, job: Dict):
+        """Libera il posto del client occupato all'ammissione del job"""
+        if not job.get("client_id"):
+            return
+        try:
+            await self.redis_client.decr(inflight_key(job["client_id"]))
+        except Exception as e:
+            logger.error(f"Errore rilascio ammissione: {str(e)}")
+    
+    async def _update_batch_status(self, batch_id: str, data: Dict):
+        """Aggiorna il record del batch (l'avanzamento si ricava dalle sessioni)"""
+        try:
+            existing_data = await self.redis_client.get(f"batch:{batch_id}")
+            batch = json.loads(existing_data) if existing_data else {"batch_id": batch_id}
+            batch.update(data)
+            
+            await self.redis_client.setex(f"batch:{batch_id}", 86400, json.dumps(batch))
+            
+        except Exception as e:
+            logger.error(f"Errore aggiornamento stato batch: {str(e)}")
+    
     async def _process_mashup_job(self, job: Dict) -> Dict:
         """Processa job di mashup"""
         session_id = job["session_id"]
@@ -215,93 +844,134 @@ class AIWorker:
         
         return result
     
-    async def _update_job_status(self, session_id: str, status: str, data: Dict):
-        """Aggiorna stato job in Redis"""
+    async def _update_job_status(self, session_id: str, status: str, data: Dict,
+                                 skip_statuses=()) -> Optional[Dict]:
+        """Aggiorna stato job in Redis (atomico) e notifica i client in ascolto (SSE)
+        
+        Ritorna None se la sessione era già in uno degli skip_statuses (nessuna
+        scrittura) o in caso di errore.
+        """
         try:
-            # Recupera dati esistenti
-            existing_data = self.redis_client.get(f"session:{session_id}")
-            if existing_data:
-                session_data = json.loads(existing_data)
-            else:
-                session_data = {"session_id": session_id}
-            
-            # Aggiorna stato
-            session_data["status"] = status
-            session_data.update(data)
-            
-            # Salva in Redis
-            self.redis_client.setex(
-                f"session:{session_id}",
-                86400,  # 24 ore
-                json.dumps(session_data)
+            return await update_session(
+                self.redis_client, session_id, {**data, "status": status},
+                create=True, publish=True, skip_statuses=skip_statuses
             )
-            
         except Exception as e:
             logger.error(f"Errore aggiornamento stato job: {str(e)}")
+            return None
     
     async def _register_worker(self):
-        """Registra worker in Redis"""
+        """Registra worker in Redis e avvia il thread di heartbeat"""
         try:
             worker_info = {
                 "worker_id": self.worker_id,
                 "started_at": self.stats["started_at"],
                 "gpu_available": self.stats["gpu_available"],
+                "pipeline_depth": PIPELINE_DEPTH,
+                "heartbeat_at": time.time(),
+                "heartbeat_interval": HEARTBEAT_INTERVAL,
                 "status": "active"
             }
             
-            self.redis_client.setex(
-                f"worker:{self.worker_id}",
-                300,  # 5 minuti TTL
+            await self.redis_client.setex(
+                worker_key(self.worker_id),
+                WORKER_TTL,
                 json.dumps(worker_info)
             )
             
-            # Heartbeat task
-            asyncio.create_task(self._heartbeat_task())
-            
         except Exception as e:
             logger.error(f"Errore registrazione worker: {str(e)}")
+        
+        # Il thread continua a battere anche se l'event loop è occupato:
+        # un job lungo non fa scadere la registrazione di un worker sano
+        HEARTBEAT_AGE.set_function(lambda: time.time() - self._last_heartbeat)
+        self._heartbeat_thread = threading.Thread(
+            target=self._heartbeat_loop, name="worker-heartbeat", daemon=True
+        )
+        self._heartbeat_thread.start()
     
-    async def _heartbeat_task(self):
-        """Task heartbeat per mantenere worker registrato"""
-        while self.running:
+    def _heartbeat_loop(self):
+        """Heartbeat periodico (thread dedicato, client Redis sincrono proprio)"""
+        process = psutil.Process()
+        while not self._heartbeat_stop.is_set():
             try:
                 # Aggiorna statistiche GPU
                 if torch.cuda.is_available():
                     self.stats["gpu_memory_used"] = torch.cuda.memory_allocated(0)
+                self.stats["memory_rss"] = process.memory_info().rss
+                
+                # Copia: le statistiche sono aggiornate in parallelo dall'event loop
+                stats = {**self.stats, "current_jobs": list(self.stats["current_jobs"])}
                 
                 # Aggiorna info worker
                 worker_info = {
                     "worker_id": self.worker_id,
                     "started_at": self.stats["started_at"],
                     "last_heartbeat": datetime.now().isoformat(),
-                    "stats": self.stats,
+                    "heartbeat_at": time.time(),
+                    "heartbeat_interval": HEARTBEAT_INTERVAL,
+                    "pipeline_depth": PIPELINE_DEPTH,
+                    "stats": stats,
                     "status": "active" if self.running else "stopping"
                 }
                 
-                self.redis_client.setex(
-                    f"worker:{self.worker_id}",
-                    300,  # 5 minuti TTL
+                self.heartbeat_client.setex(
+                    worker_key(self.worker_id),
+                    WORKER_TTL,
                     json.dumps(worker_info)
                 )
-                
-                await asyncio.sleep(60)  # Heartbeat ogni minuto
+                self._last_heartbeat = time.time()
                 
             except Exception as e:
                 logger.error(f"Errore heartbeat: {str(e)}")
-                await asyncio.sleep(30)
+            
+            self._heartbeat_stop.wait(HEARTBEAT_INTERVAL)
+    
+    async def _monitor_loop_lag(self):
+        """Misura il ritardo dell'event loop (CPU o I/O bloccante nel loop)"""
+        loop = asyncio.get_event_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+            
+            EVENT_LOOP_LAG.labels(process="worker").observe(lag)
+            self.stats["event_loop_lag"] = lag
+            if lag > LOOP_LAG_WARNING:
+                logger.warning(f"Event loop bloccato per {lag:.2f}s")
     
     def _signal_handler(self, signum, frame):
-        """Handler per segnali di terminazione"""
+        """Handler per segnali di terminazione: avvia il drain"""
         logger.info(f"Ricevuto segnale {signum}, arresto worker...")
         self.running = False
+        
+        # I job in corso si fermano al prossimo confine di fase o segmento; la
+        # scadenza parte subito anche se il loop principale attende un posto libero
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._begin_drain)
     
     async def _cleanup(self):
         """Cleanup risorse worker"""
         try:
             logger.info(f"Cleanup {self.worker_id}...")
             
-            # Rimuovi worker da Redis
-            self.redis_client.delete(f"worker:{self.worker_id}")
+            for task in (self._loop_lag_task, self._watchdog_task):
+                if task is not None:
+                    task.cancel()
+            
+            # Ferma l'heartbeat prima di rimuovere la registrazione
+            self._heartbeat_stop.set()
+            if self._heartbeat_thread is not None:
+                self._heartbeat_thread.join(timeout=HEARTBEAT_INTERVAL)
+            
+            if self.redis_client is not None:
+                # Rimuovi worker da Redis
+                await self.redis_client.delete(worker_key(self.worker_id))
+                await self.job_queue.remove_consumer(self.worker_id)
+                await self.redis_client.close()
+            
+            if self.heartbeat_client is not None:
+                self.heartbeat_client.close()
             
             # Cleanup modelli AI
             if hasattr(self.demucs_model, '__del__'):
@@ -328,6 +998,12 @@ async def main():
     except Exception as e:
         logger.error(f"Errore fatale worker: {str(e)}")
         sys.exit(1)
+    
+    if worker.restart_required:
+        # I thread dell'executor non sono daemon: l'uscita normale li attenderebbe
+        logger.info(f"Riavvio richiesto, uscita con codice {RESTART_EXIT_CODE}")
+        logging.shutdown()
+        os._exit(RESTART_EXIT_CODE)
 
 if __name__ == "__main__":
     # Crea directory logs se non esiste
@@ -20,6 +20,7 @@ import { motion } from 'framer-motion';
 // Types
 import { AudioTrack, PlaybackState, EditorState } from '../../store/appStore';
 import { useAppStore } from '../../store/appStore';
+import { AudioAPI } from '../../services/api';
 
 interface WaveformEditorProps {
   tracks: AudioTrack[];
@@ -68,7 +69,8 @@ const WaveformEditor: React.FC<WaveformEditorProps> = ({
         responsive: true,
         height: 80,
         normalize: true,
-        backend: 'WebAudio',
+        // Audio in streaming: la waveform arriva dai picchi precalcolati
+        backend: 'MediaElement',
         mediaControls: false,
         interact: true,
         scrollParent: true,
@@ -108,7 +110,23 @@ const WaveformEditor: React.FC<WaveformEditorProps> = ({
       // Carica il primo track disponibile
       const firstTrack = tracks.find(track => track.url);
       if (firstTrack) {
-        wavesurfer.load(firstTrack.url);
+        if (firstTrack.peaksUrl) {
+          // Picchi alla risoluzione dello schermo: niente download/decodifica del WAV
+          const width = containerRef.current.clientWidth || 1000;
+          AudioAPI.fetchPeaks(firstTrack.peaksUrl, { width: width * 2 })
+            .then((data) => {
+              if (wavesurferRef.current !== wavesurfer) return;
+              const duration = data.totalFrames / data.sampleRate;
+              wavesurfer.load(firstTrack.url, [data.peaks], duration);
+            })
+            .catch(() => {
+              if (wavesurferRef.current === wavesurfer) {
+                wavesurfer.load(firstTrack.url);
+              }
+            });
+        } else {
+          wavesurfer.load(firstTrack.url);
+        }
       }
 
     } catch (err) {
@@ -23,6 +23,11 @@ api.interceptors.response.use(
     }
     
     if (error.response?.status === 429) {
+      const retryAfter = Number(error.response.headers?.['retry-after']);
+      if (retryAfter > 0) {
+        const minutes = Math.ceil(retryAfter / 60);
+        throw new Error(`Server occupato. Riprova tra ${minutes} ${minutes === 1 ? 'minuto' : 'minuti'}.`);
+      }
       throw new Error('Troppi tentativi. Riprova tra qualche minuto.');
     }
     
@@ -64,6 +69,7 @@ export interface StatusResponse {
     [key: string]: {
       filename: string;
       url: string;
+      peaks_url?: string;
       duration: number;
     };
   };
@@ -75,6 +81,59 @@ export interface StatusResponse {
   };
 }
 
+export interface SessionStatusEvent {
+  session_id: string;
+  status: string;
+  progress: number;
+  stage?: string;
+  created_at?: string;
+  queued_at?: string;
+  processing_started_at?: string;
+  processing_completed_at?: string;
+  error?: string;
+}
+
+export interface WaveformPeaks {
+  sampleRate: number;
+  totalFrames: number;
+  samplesPerPeak: number;
+  startFrame: number;
+  // Coppie (min, max) normalizzate in [-1, 1]
+  peaks: Float32Array;
+}
+
+export interface PeaksRequest {
+  start?: number;
+  end?: number;
+  width?: number;
+}
+
+// Header binario della risposta /peaks (vedi backend/utils/peaks.py)
+const PEAKS_HEADER_SIZE = 36;
+
+const parsePeaks = (buffer: ArrayBuffer): WaveformPeaks => {
+  const view = new DataView(buffer);
+  const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+  if (magic !== 'MPKR') {
+    throw new Error('Formato picchi non valido');
+  }
+  
+  const count = view.getUint32(32, true);
+  const samples = new Int16Array(buffer, PEAKS_HEADER_SIZE, count * 2);
+  const peaks = new Float32Array(samples.length);
+  for (let i = 0; i < samples.length; i++) {
+    peaks[i] = samples[i] / 32767;
+  }
+  
+  return {
+    sampleRate: view.getUint32(8, true),
+    totalFrames: Number(view.getBigUint64(12, true)),
+    samplesPerPeak: view.getUint32(20, true),
+    startFrame: Number(view.getBigUint64(24, true)),
+    peaks,
+  };
+};
+
 export interface MashupRequest {
   session_id: string;
   track1_stem: string;
@@ -142,6 +201,36 @@ export class AudioAPI {
     return response.data;
   }
   
+  /**
+   * Sottoscrizione push allo stato di una sessione (Server-Sent Events).
+   * Ritorna una funzione per chiudere la connessione.
+   */
+  static subscribeJobStatus(
+    sessionId: string,
+    onUpdate: (status: SessionStatusEvent) => void,
+    onError?: (error: Event) => void
+  ): () => void {
+    const source = new EventSource(`${API_BASE_URL}/status/${sessionId}/stream`);
+    
+    source.addEventListener('status', (event) => {
+      const status: SessionStatusEvent = JSON.parse((event as MessageEvent).data);
+      onUpdate(status);
+      
+      // Stato finale: nessun altro aggiornamento in arrivo
+      if (['completed', 'error', 'failed', 'killed'].includes(status.status)) {
+        source.close();
+      }
+    });
+    
+    source.onerror = (error) => {
+      if (onError) {
+        onError(error);
+      }
+    };
+    
+    return () => source.close();
+  }
+  
   /**
    * Download di una singola traccia separata
    */
@@ -159,6 +248,32 @@ export class AudioAPI {
     return response.data;
   }
   
+  /**
+   * Picchi min/max di una traccia per intervallo (secondi) e larghezza in punti
+   */
+  static async getStemPeaks(
+    sessionId: string,
+    stemName: string,
+    request: PeaksRequest = {}
+  ): Promise<WaveformPeaks> {
+    return AudioAPI.fetchPeaks(`/peaks/${sessionId}/${stemName}`, request);
+  }
+  
+  /**
+   * Picchi da un URL già noto (es. peaks_url dello stato)
+   */
+  static async fetchPeaks(
+    peaksUrl: string,
+    request: PeaksRequest = {}
+  ): Promise<WaveformPeaks> {
+    const response = await api.get(peaksUrl, {
+      params: request,
+      responseType: 'arraybuffer',
+    });
+    
+    return parsePeaks(response.data);
+  }
+  
   /**
    * Download di tutte le tracce separate come ZIP
    */
@@ -219,8 +334,10 @@ export const useAudioAPI = () => {
     uploadAudio: AudioAPI.uploadAudio,
     startSeparation: AudioAPI.startSeparation,
     getJobStatus: AudioAPI.getJobStatus,
+    subscribeJobStatus: AudioAPI.subscribeJobStatus,
     downloadStem: AudioAPI.downloadStem,
     downloadAllStems: AudioAPI.downloadAllStems,
+    getStemPeaks: AudioAPI.getStemPeaks,
     createMashup: AudioAPI.createMashup,
     getSessionInfo: AudioAPI.getSessionInfo,
     deleteSession: AudioAPI.deleteSession,
@@ -255,6 +372,7 @@ export const convertStatusToJob = (
         id: `${status.job_id}_${stemName}`,
         name: stemName,
         url: stemInfo.url,
+        peaksUrl: stemInfo.peaks_url,
         duration: stemInfo.duration,
         volume: 0.8,
         pan: 0,
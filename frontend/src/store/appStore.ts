@@ -13,6 +13,7 @@ export interface AudioTrack {
   solo: boolean;
   color: string;
   waveformData?: number[];
+  peaksUrl?: string;
 }
 
 export interface SeparationJob {